@@ -20,6 +20,9 @@ import sounddevice as sd
 import soundfile as sf
 import numpy as np
 
+# Add project root to sys.path for the shared protocol package
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
 # Project imports
 try:
     from managers.p2p_manager import P2PManager
@@ -376,7 +379,8 @@ class CoreClient:
     async def _init_p2p_mode(self, mode_type='internet'):
         """Initialize P2P mode"""
         p2p_mode_type = 'local' if mode_type == 'p2p_local' else 'internet'
-        self.p2p_manager = P2PManager(self.username, self.chat_history, mode=p2p_mode_type)
+        self.p2p_manager = P2PManager(self.username, self.chat_history, mode=p2p_mode_type,
+                                      zstd_dictionary=self.config_manager.load_zstd_dictionary())
         self.webrtc_manager = WebRTCManager(self.p2p_manager, self.audio_manager, self.callback_queue)
         self.webrtc_manager.start() # Start WebRTC manager now that P2PManager is available
         
@@ -416,7 +420,8 @@ class CoreClient:
     
     async def _init_server_mode(self, host: str, port: int, password: str = None):
         """Initialize server mode"""
-        self.server_manager = ServerManager(host, port, self.username, password, self.chat_history)
+        self.server_manager = ServerManager(host, port, self.username, password, self.chat_history,
+                                            zstd_dictionary=self.config_manager.load_zstd_dictionary())
         
         callbacks = {
             'login_failed': lambda p: self.add_message(f"Login failed: {p.get('reason')}", 'global'),
@@ -435,6 +440,7 @@ class CoreClient:
             'user_joined_call': self.on_user_joined_call,
             'user_left_call': self.on_user_left_call,
             'user_kicked': self.on_user_kicked,
+            'zstd_dictionary_received': self.config_manager.save_zstd_dictionary,
         }
         
         for event, func in callbacks.items():
@@ -820,11 +826,13 @@ class CoreClient:
             self.add_message("Starting P2P group call...", group_id)
             self.join_group_call(group_id) # Creator joins their own call automatically
         elif self.mode == 'server':
-            self.server_manager.start_group_call(group_id, supported_rate)
-            self.add_message("Requesting server to start group call...", group_id)
-            # In server mode, after requesting to start, we also join.
-            # The server will then inform us of our public UDP address to use for the call.
-            self.join_server_group_call(group_id)
+            # Start and join travel in one frame and are applied together.
+            with self.server_manager.batch():
+                self.server_manager.start_group_call(group_id, supported_rate)
+                self.add_message("Requesting server to start group call...", group_id)
+                # In server mode, after requesting to start, we also join.
+                # The server will then inform us of our public UDP address to use for the call.
+                self.join_server_group_call(group_id)
     
     def join_group_call(self, group_id):
         """Join group call (P2P mode) - for server mode, use join_server_group_call"""
@@ -7,6 +7,7 @@ class ConfigManager:
         self.key_path = key_path
         self.config_path = config_path
         self.chat_history_path = 'chat_history.dat'  # Separate file for chat history
+        self.zstd_dictionary_path = 'zstd_dictionary.dict'  # Trained zstd dictionary shipped by the server
         self.key = self.load_or_generate_key()
         self.cipher = Fernet(self.key)
 
@@ -86,6 +87,30 @@ class ConfigManager:
             # Если расшифровка не удалась, возвращаем пустую историю
             return {}
 
+    def save_zstd_dictionary(self, dictionary_bytes):
+        """
+        Сохраняет словарь zstd, полученный от сервера.
+        Словарь не секретный, поэтому хранится без шифрования.
+        """
+        try:
+            with open(self.zstd_dictionary_path, 'wb') as f:
+                f.write(dictionary_bytes)
+            return True
+        except OSError as e:
+            print(f"Ошибка при сохранении словаря zstd: {e}")
+            return False
+
+    def load_zstd_dictionary(self):
+        """Загружает сохранённый словарь zstd или возвращает None."""
+        if not os.path.exists(self.zstd_dictionary_path):
+            return None
+        try:
+            with open(self.zstd_dictionary_path, 'rb') as f:
+                return f.read()
+        except OSError as e:
+            print(f"Ошибка при загрузке словаря zstd: {e}")
+            return None
+
 
 # Пример использования:
 if __name__ == '__main__':
@@ -5,10 +5,10 @@ import json
 import asyncio
 import stun
 import msgpack
-import zstandard as zstd
 import sys
 from kademlia.network import Server as KademliaServer
 from .encryption_manager import EncryptionManager
+from common.dictionary import dictionary_from_bytes, make_compressor, make_decompressor
 
 P2P_PORT = 12346
 BROADCAST_ADDR = '<broadcast>'
@@ -17,7 +17,7 @@ STUN_PORT = 19302
 
 
 class P2PManager:
-    def __init__(self, username, chat_history, mode='internet'):
+    def __init__(self, username, chat_history, mode='internet', zstd_dictionary=None):
         self.username = username
         self.udp_socket = None
         self.chat_history = chat_history
@@ -33,8 +33,13 @@ class P2PManager:
         self.pending_session_acks = {}
 
         self.encryption_manager = EncryptionManager()
-        self.zstd_c = zstd.ZstdCompressor()
-        self.zstd_d = zstd.ZstdDecompressor()
+        # A trained dictionary (cached from a server session) is only used towards
+        # peers that announced the same dictionary ID in 'discovery' or 'public_key'.
+        dictionary = dictionary_from_bytes(zstd_dictionary) if zstd_dictionary else None
+        self.zstd_dict_id = dictionary.dict_id() if dictionary else 0
+        self.zstd_c = make_compressor()
+        self.zstd_dict_c = make_compressor(dictionary) if dictionary else None
+        self.zstd_d = make_decompressor(dictionary)
 
         self.callbacks = {
             'peer_discovered': [],
@@ -142,8 +147,9 @@ class P2PManager:
             self.dht_loop.call_soon_threadsafe(self.dht_loop.stop)
         print("P2P Manager stopped.")
 
-    def _pack_data(self, data):
-        return self.zstd_c.compress(msgpack.packb(data, use_bin_type=True))
+    def _pack_data(self, data, use_dictionary=False):
+        compressor = self.zstd_dict_c if use_dictionary and self.zstd_dict_c else self.zstd_c
+        return compressor.compress(msgpack.packb(data, use_bin_type=True))
 
     def _unpack_data(self, packed_data):
         return msgpack.unpackb(self.zstd_d.decompress(packed_data), raw=False)
@@ -175,7 +181,8 @@ class P2PManager:
         message = self._pack_data({
             'command': 'discovery',
             'username': self.username,
-            'port': self.my_port
+            'port': self.my_port,
+            'zstd_dict_id': self.zstd_dict_id
         })
         while self.running:
             # In local mode, iterate through a range of ports to find other clients.
@@ -241,13 +248,16 @@ class P2PManager:
                 'local_ip': peer_addr[0],
                 'public_addr': peer_addr,
                 'last_seen': time.time(),
-                'port': peer_port
+                'port': peer_port,
+                'zstd_dict_id': message.get('zstd_dict_id', 0)
             }
             # Only start a key exchange if we don't already have a secure channel.
             # This prevents the endless handshake loop.
             if not self.encryption_manager.has_session_key(username):
                 self.send_public_key(username)
         elif command == 'public_key':
+            if username in self.peers:
+                self.peers[username]['zstd_dict_id'] = payload.get('zstd_dict_id', 0)
             if payload.get('key'):
                 if self.encryption_manager.add_peer_public_key(username, payload['key']):
                     print(f"Added public key for {username}.")
@@ -488,7 +498,8 @@ class P2PManager:
             return
 
         message_data = {'command': command, 'username': self.username, 'payload': payload}
-        message_bytes = self._pack_data(message_data)
+        use_dictionary = bool(self.zstd_dict_id) and peer_data.get('zstd_dict_id') == self.zstd_dict_id
+        message_bytes = self._pack_data(message_data, use_dictionary)
 
         try:
             if self.udp_socket:
@@ -601,7 +612,8 @@ class P2PManager:
 
     def send_public_key(self, target_username, request_key=True):
         key_pem = self.encryption_manager.get_public_key_pem()
-        self.send_peer_command(target_username, 'public_key', {'key': key_pem, 'request': request_key})
+        self.send_peer_command(target_username, 'public_key', {'key': key_pem, 'request': request_key,
+                                                               'zstd_dict_id': self.zstd_dict_id})
 
     def initiate_session_key_exchange(self, target_username):
         _, encrypted_key = self.encryption_manager.generate_session_key(target_username)
@@ -1,11 +1,15 @@
 import socket
 import threading
-import msgpack
-import zstandard as zstd
 import queue
+import time
+from contextlib import contextmanager
+from common.framing import FrameDecoder, FrameReader, FrameError, encode_frame, encode_batch
+from common.dictionary import dictionary_from_bytes, make_compressor
+
+RESUME_TIMEOUT = 30 # Seconds to keep trying to resume a session after the connection drops
 
 class ServerManager(threading.Thread):
-    def __init__(self, host, port, username, password, chat_history):
+    def __init__(self, host, port, username, password, chat_history, zstd_dictionary=None):
         super().__init__(daemon=True)
         self.host = host
         self.port = port
@@ -15,8 +19,16 @@ class ServerManager(threading.Thread):
         self.sock = None
         self.running = True
         self.callbacks = {}
-        self.zstd_c = zstd.ZstdCompressor()
-        self.zstd_d = zstd.ZstdDecompressor()
+        self.zstd_c = make_compressor()
+        self.decoder = FrameDecoder()
+        # Dictionary cached from an earlier session; the server only re-sends it if it changed.
+        self.cached_dictionary = dictionary_from_bytes(zstd_dictionary) if zstd_dictionary else None
+        self.history_cursors = {} # {chat_id: first_id of the oldest page received}
+        self.online_users = set()
+        self.presence_version = None # None until the initial snapshot arrives
+        self.pending_batch = None # Commands collected inside batch()
+        self.session_token = None # Issued at login; resumes the session after a server hot restart
+        self.call_relays = {} # {group_id: (host, port)} for calls relayed by another server node
 
     def register_callback(self, event_name, func):
         self.callbacks[event_name] = func
@@ -27,10 +39,12 @@ class ServerManager(threading.Thread):
 
     def run(self):
         try:
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.sock.connect((self.host, self.port))
-            self.login()
-            self.listen_for_messages()
+            self._connect()
+            while True:
+                self.listen_for_messages()
+                if not self._resume():
+                    break
+            self._trigger_callback('disconnected')
         except Exception as e:
             print(f"ServerManager Error: {e}")
             self._trigger_callback('connection_failed', str(e))
@@ -38,60 +52,116 @@ class ServerManager(threading.Thread):
             if self.sock:
                 self.sock.close()
 
+    def _connect(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.connect((self.host, self.port))
+        except OSError:
+            sock.close()
+            raise
+        # Every connection starts on plain zstd; login_success announces the dictionary again.
+        self.sock = sock
+        self.zstd_c = make_compressor()
+        self.decoder = FrameDecoder()
+        self.login()
+
+    def _resume(self):
+        """
+        Reconnects after the connection dropped (e.g. the server was
+        hot-restarted) and logs in with the session token, which puts us back
+        into our groups and call. Returns False if that is not possible.
+        """
+        if not self.running or not self.session_token:
+            return False
+        self.sock.close()
+        print("Connection to server lost, resuming session...")
+        deadline = time.monotonic() + RESUME_TIMEOUT
+        delay = 0.05
+        while self.running and time.monotonic() < deadline:
+            try:
+                self._connect()
+                return True
+            except OSError:
+                time.sleep(delay)
+                delay = min(delay * 2, 1.0)
+        return False
+
     def listen_for_messages(self):
-        unpacker = msgpack.Unpacker(raw=False)
+        reader = FrameReader(self.sock, self.decoder)
         while self.running:
             try:
-                data = self.sock.recv(4096)
-                if not data:
+                messages = reader.read()
+                if messages is None:
                     break
-                
-                # Decompress the received chunk immediately
-                try:
-                    decompressed_data = self.zstd_d.decompress(data)
-                    unpacker.feed(decompressed_data)
-                    for unpacked in unpacker:
-                        self.handle_command(unpacked)
-                except zstd.ZstdError:
-                    # This might happen if we receive a partial compressed frame.
-                    # A more robust solution would buffer compressed chunks.
-                    # For now, we assume each recv() gets at least one full message.
-                    print("Warning: Could not decompress chunk, might be partial.")
-                    continue
+                for message in messages:
+                    self.handle_command(message)
 
             except (ConnectionResetError, ConnectionAbortedError):
                 print("Connection to server lost.")
                 break
+            except FrameError as e:
+                print(f"Protocol error from server: {e}")
+                break
             except Exception as e:
                 print(f"Error receiving data from server: {e}")
                 break
-        self._trigger_callback('disconnected')
 
     def _send_command(self, command, payload=None):
         if not self.sock:
             return
+        message = {'command': command, 'payload': payload or {}}
+        if self.pending_batch is not None:
+            self.pending_batch.append(message)
+            return
         try:
-            message = {'command': command, 'payload': payload or {}}
-            packed_message = msgpack.packb(message, use_bin_type=True)
-            compressed_message = self.zstd_c.compress(packed_message)
-            self.sock.sendall(compressed_message)
+            self.sock.sendall(encode_frame(message, self.zstd_c))
         except Exception as e:
             print(f"Error sending command '{command}': {e}")
 
+    @contextmanager
+    def batch(self):
+        """
+        Sends every command issued inside the block in one frame, which the
+        server applies as a single transaction:
+
+            with server_manager.batch():
+                server_manager.start_group_call(group_id, 48000)
+                server_manager.join_group_call(group_id, udp_addr)
+        """
+        if self.pending_batch is not None:
+            yield  # Already batching; the outer block sends.
+            return
+        self.pending_batch = []
+        try:
+            yield
+        finally:
+            messages, self.pending_batch = self.pending_batch, None
+            if messages and self.sock:
+                try:
+                    self.sock.sendall(encode_batch(messages, self.zstd_c))
+                except Exception as e:
+                    print(f"Error sending {len(messages)} batched commands: {e}")
+
     def handle_command(self, message):
         try:
             command = message.get('command')
             payload = message.get('payload')
 
             if command == 'login_success':
-                # We don't really need to do anything here, but it's good to have.
-                pass
+                self.session_token = payload.get('session_token')
+                if payload.get('resumed'):
+                    print("Session resumed.")
+                self._apply_dictionary(payload)
             elif command == 'login_failed':
                 self._trigger_callback('login_failed', payload)
             elif command == 'info':
                 self._trigger_callback('info_received', payload)
-            elif command == 'user_list_update':
-                self._trigger_callback('user_list_update', payload.get('users'))
+            elif command == 'presence_delta':
+                self._apply_presence_delta(payload)
+            elif command == 'ping':
+                self._send_command('pong')  # Heartbeat: the server evicts connections that stay silent.
+            elif command == 'presence_snapshot':
+                self._set_presence(payload.get('version'), payload.get('users'))
             elif command == 'group_message':
                 self._trigger_callback('group_message_received', payload.get('group_id'), payload.get('message_data'))
             elif command == 'group_created':
@@ -103,11 +173,20 @@ class ServerManager(threading.Thread):
             elif command == 'user_joined_group':
                 self._trigger_callback('group_joined', payload.get('group_id'), payload.get('username'))
             elif command == 'history_response':
+                # Remember where the next older page starts; None once the beginning is reached.
+                self.history_cursors[payload.get('chat_id')] = payload.get('first_id') if payload.get('has_more') else None
                 self._trigger_callback('history_received', payload.get('chat_id'), payload.get('history'))
+            elif command == 'search_results':
+                self._trigger_callback('search_results_received', payload.get('group_id'), payload.get('query'),
+                                       payload.get('results'), payload.get('total'), payload.get('has_more'))
             elif command == 'initial_data':
+                self._set_presence(payload.get('presence_version'), payload.get('users'), notify=False)
                 self._trigger_callback('initial_data_received', payload.get('groups'), payload.get('users'))
             elif command == 'incoming_group_call':
                 self._trigger_callback('incoming_group_call', payload.get('group_id'), payload.get('admin'), payload.get('sample_rate'))
+            elif command == 'call_relay':
+                # The call is hosted by another node of a server cluster: its audio goes there.
+                self.call_relays[payload.get('group_id')] = tuple(payload.get('relay_addr'))
             elif command == 'user_joined_call':
                 self._trigger_callback('user_joined_call', payload.get('group_id'), payload.get('username'))
             elif command == 'user_left_call':
@@ -119,8 +198,48 @@ class ServerManager(threading.Thread):
         except Exception as e:
             print(f"Error handling server command: {e} - Message: {message}")
 
+    def _set_presence(self, version, users, notify=True):
+        self.presence_version = version
+        self.online_users = set(users or [])
+        if notify:
+            self._trigger_callback('user_list_update', sorted(self.online_users))
+
+    def _apply_presence_delta(self, payload):
+        """Applies the next presence delta, or asks for a fresh snapshot if one was missed."""
+        version = payload.get('version')
+        if self.presence_version is None or version <= self.presence_version:
+            return  # Already part of the snapshot we hold.
+        if version != self.presence_version + 1:
+            print(f"Presence version gap ({self.presence_version} -> {version}), resyncing.")
+            self.presence_version = None
+            self._send_command('request_presence')
+            return
+        self.presence_version = version
+        self.online_users.difference_update(payload.get('left', []))
+        self.online_users.update(payload.get('joined', []))
+        self._trigger_callback('user_list_update', sorted(self.online_users))
+
+    def _apply_dictionary(self, payload):
+        """Switches both directions to the server's trained dictionary, if it announced one."""
+        dict_id = payload.get('zstd_dict_id')
+        if not dict_id:
+            return
+        if payload.get('zstd_dictionary'):
+            self.cached_dictionary = dictionary_from_bytes(payload['zstd_dictionary'])
+            self._trigger_callback('zstd_dictionary_received', payload['zstd_dictionary'])
+        if not self.cached_dictionary or self.cached_dictionary.dict_id() != dict_id:
+            print("Server announced a zstd dictionary we do not have; staying on plain zstd.")
+            return
+        self.decoder.set_dictionary(self.cached_dictionary)
+        self.zstd_c = make_compressor(self.cached_dictionary)
+
     def login(self):
-        self._send_command('login', {'username': self.username, 'password': self.password})
+        payload = {'username': self.username, 'password': self.password}
+        if self.cached_dictionary:
+            payload['zstd_dict_id'] = self.cached_dictionary.dict_id()
+        if self.session_token:
+            payload['session_token'] = self.session_token
+        self._send_command('login', payload)
 
     def send_group_message(self, group_id, message_data):
         self._send_command('group_message', {'group_id': group_id, 'message_data': message_data})
@@ -134,8 +253,28 @@ class ServerManager(threading.Thread):
     def send_group_invite_response(self, group_id, accepted):
         self._send_command('group_invite_response', {'group_id': group_id, 'accepted': accepted})
         
-    def request_history(self, chat_id):
-        self._send_command('request_history', {'chat_id': chat_id})
+    def request_history(self, chat_id, before_id=None, limit=None):
+        payload = {'chat_id': chat_id}
+        if before_id is not None:
+            payload['before_id'] = before_id
+        if limit:
+            payload['limit'] = limit
+        self._send_command('request_history', payload)
+
+    def request_older_history(self, chat_id, limit=None):
+        """Requests the page before the oldest one received. Returns False if there is none."""
+        before_id = self.history_cursors.get(chat_id)
+        if before_id is None:
+            return False
+        self.request_history(chat_id, before_id, limit)
+        return True
+
+    def search_history(self, group_id, query, offset=0, limit=None):
+        """Searches a group's messages on the server; the next page starts at offset + len(results)."""
+        payload = {'group_id': group_id, 'query': query, 'offset': offset}
+        if limit:
+            payload['limit'] = limit
+        self._send_command('search_history', payload)
 
     def start_group_call(self, group_id, sample_rate):
         self._send_command('start_group_call', {'group_id': group_id, 'sample_rate': sample_rate})
@@ -144,8 +283,13 @@ class ServerManager(threading.Thread):
         self._send_command('join_group_call', {'group_id': group_id, 'udp_addr': udp_addr})
 
     def leave_group_call(self, group_id):
+        self.call_relays.pop(group_id, None)
         self._send_command('leave_group_call', {'group_id': group_id})
 
+    def relay_address(self, group_id):
+        """Where to send a group call's audio."""
+        return self.call_relays.get(group_id, (self.host, self.port))
+
     def kick_user_from_group(self, group_id, username):
         self._send_command('kick_from_group', {'group_id': group_id, 'username': username})
 
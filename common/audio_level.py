@@ -0,0 +1,44 @@
+"""
+One-byte audio level header for server-relayed call audio.
+
+When the server selects active speakers ("speaker_selection" in
+server_config.json), every audio datagram starts with a byte modelled on
+the RTP audio level extension (RFC 6464):
+
+    +---+---------------+------------------------+
+    | V | level (7 bit) | audio payload ...      |
+    +---+---------------+------------------------+
+
+V is set when the sender's voice activity detector thinks the frame holds
+speech; level is the frame's loudness in -dBov, from 0 (full scale) to 127
+(silence). The relay only reads this byte and forwards the datagram as is,
+so receivers skip it before decoding.
+"""
+import math
+from array import array
+
+HEADER_SIZE = 1
+VOICE_FLAG = 0x80
+SILENCE = 127
+
+
+def pcm_level(pcm):
+    """Returns the loudness of little-endian int16 PCM in -dBov (0..127)."""
+    samples = array('h', pcm[:len(pcm) - len(pcm) % 2])
+    if not samples:
+        return SILENCE
+    power = sum(sample * sample for sample in samples) / len(samples)
+    if power <= 0:
+        return SILENCE
+    dbov = 10 * math.log10(power / (32768 * 32768))
+    return min(SILENCE, max(0, round(-dbov)))
+
+
+def encode_level(level, voice):
+    """Packs a level in -dBov and the voice activity flag into the header byte."""
+    return bytes(((VOICE_FLAG if voice else 0) | min(SILENCE, max(0, int(level))),))
+
+
+def decode_level(header):
+    """Returns (loudness in dB above silence, voice) for a header byte value."""
+    return SILENCE - (header & SILENCE), bool(header & VOICE_FLAG)
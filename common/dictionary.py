@@ -0,0 +1,82 @@
+"""
+Trained zstd dictionaries for small protocol messages.
+
+Most control messages are a few hundred bytes of msgpack, too small for
+plain zstd to find repetitions in. A dictionary trained on captured traffic
+(see server/tools/train_dictionary.py) primes the compressor with the keys
+and values those messages share. Frames compressed with a dictionary record
+its ID in the zstd frame header, and a decompressor that holds the
+dictionary decodes both kinds of frame, so peers can switch over at any
+message boundary.
+"""
+import struct
+import threading
+import zstandard as zstd
+
+COMPRESSION_LEVEL = 3
+RECORD_HEADER = struct.Struct('!I')
+
+
+def load_dictionary(path):
+    """Reads a dictionary file, returning None if no usable file is configured."""
+    if not path:
+        return None
+    try:
+        with open(path, 'rb') as f:
+            return dictionary_from_bytes(f.read())
+    except (OSError, zstd.ZstdError) as e:
+        print(f"Warning: could not load zstd dictionary '{path}': {e}")
+        return None
+
+
+def dictionary_from_bytes(data):
+    dictionary = zstd.ZstdCompressionDict(data)
+    dictionary.precompute_compress(level=COMPRESSION_LEVEL)
+    return dictionary
+
+
+def make_compressor(dictionary=None):
+    return zstd.ZstdCompressor(level=COMPRESSION_LEVEL, dict_data=dictionary)
+
+
+def make_decompressor(dictionary=None):
+    return zstd.ZstdDecompressor(dict_data=dictionary)
+
+
+class TrafficCapture:
+    """
+    Appends uncompressed msgpack messages to a file as dictionary-training
+    samples, each prefixed with its length as a 4-byte big-endian integer.
+    """
+
+    def __init__(self, path, max_samples=100000):
+        self.path = path
+        self.max_samples = max_samples
+        self.samples = 0
+        self.lock = threading.Lock()
+        self.file = open(path, 'ab')
+
+    def record(self, packed):
+        with self.lock:
+            if self.samples >= self.max_samples:
+                return
+            self.file.write(RECORD_HEADER.pack(len(packed)))
+            self.file.write(packed)
+            self.samples += 1
+            if self.samples == self.max_samples:
+                self.file.close()
+                print(f"Traffic capture '{self.path}' is complete ({self.samples} samples).")
+
+
+def read_capture(path):
+    """Yields the samples stored by TrafficCapture."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(data):
+        (length,) = RECORD_HEADER.unpack_from(data, offset)
+        offset += RECORD_HEADER.size
+        if offset + length > len(data):
+            break
+        yield data[offset:offset + length]
+        offset += length
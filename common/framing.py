@@ -0,0 +1,169 @@
+"""
+Length-prefixed framing for the client/server TCP protocol.
+
+Every message is packed with msgpack, compressed into exactly one zstd frame
+and prefixed with its compressed length as a 4-byte big-endian integer:
+
+    +----------------+---------------------------+
+    | length (u32be) | zstd(msgpack(message))    |
+    +----------------+---------------------------+
+
+FrameDecoder consumes the stream in whatever chunks recv() returns, so frames
+split across reads (or several frames in one read) are handled correctly.
+A frame may also hold several consecutive msgpack messages (encode_batch):
+they are compressed together and decoded in order, and the server applies
+the commands of one such frame as a single transaction.
+Frames may be compressed with a trained dictionary (see common.dictionary).
+"""
+import struct
+import msgpack
+import zstandard as zstd
+from common.dictionary import make_decompressor
+
+HEADER = struct.Struct('!I')
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+MAX_DECOMPRESSED_SIZE = 64 * 1024 * 1024
+ZSTD_HEADER_MAX = 18  # Longest zstd frame header (ZSTD_FRAMEHEADERSIZE_MAX)
+RECV_BUFFER_SIZE = 64 * 1024
+
+
+class FrameError(ValueError):
+    """Raised when the peer sends a frame that cannot be decoded."""
+
+
+def encode_frame(message, compressor):
+    """Packs, compresses and length-prefixes a single message."""
+    body = compressor.compress(msgpack.packb(message, use_bin_type=True))
+    return HEADER.pack(len(body)) + body
+
+
+def encode_batch(messages, compressor):
+    """Packs several messages back to back and compresses them into one frame."""
+    body = compressor.compress(b''.join(msgpack.packb(message, use_bin_type=True) for message in messages))
+    return HEADER.pack(len(body)) + body
+
+
+class FrameDecoder:
+    """
+    Incremental decoder for a stream of length-prefixed zstd frames.
+
+    Frame bodies are streamed through a zstd decompression object into a
+    msgpack Unpacker as they arrive, so a large message is never buffered
+    twice and the Unpacker's internal buffer is reused across messages.
+    Each decoder owns its zstd context because a frame may stay half-decoded
+    while other connections are being served.
+
+    Frames must declare their decompressed size in the zstd frame header
+    (ZstdCompressor.compress() always does). It is checked against
+    max_decompressed_size before anything is decompressed, and zstd refuses
+    to write past it, so a small frame cannot expand without bound.
+    """
+
+    def __init__(self, dictionary=None, max_frame_size=MAX_FRAME_SIZE, max_decompressed_size=MAX_DECOMPRESSED_SIZE):
+        self.decompressor = make_decompressor(dictionary)
+        self.max_frame_size = max_frame_size
+        self.max_decompressed_size = max_decompressed_size
+        self.unpacker = msgpack.Unpacker(raw=False, max_buffer_size=max_decompressed_size)
+        self._header = bytearray()
+        self._zstd_header = bytearray()
+        self._remaining = 0
+        self._dobj = None
+
+    def set_dictionary(self, dictionary):
+        """Decodes every frame that starts after this call with `dictionary`."""
+        self.decompressor = make_decompressor(dictionary)
+
+    def feed(self, data):
+        """
+        Consumes a chunk of the stream and yields the messages it completes.
+        Messages are yielded one at a time, before the next frame is touched,
+        so a handler may call set_dictionary() in between; the generator must
+        be exhausted before the next chunk is fed.
+        """
+        for messages in self.feed_frames(data):
+            yield from messages
+
+    def feed_frames(self, data):
+        """Like feed(), but yields the list of messages of each completed frame."""
+        view = memoryview(data)
+        offset = 0
+        size = len(view)
+        while offset < size:
+            if not self._remaining:
+                needed = HEADER.size - len(self._header)
+                self._header += view[offset:offset + needed]
+                offset += needed
+                if len(self._header) < HEADER.size:
+                    break
+                (length,) = HEADER.unpack(self._header)
+                self._header.clear()
+                if length == 0 or length > self.max_frame_size:
+                    raise FrameError(f"Invalid frame length {length}")
+                self._remaining = length
+
+            if self._dobj is None:
+                wanted = min(ZSTD_HEADER_MAX, self._remaining)
+                needed = wanted - len(self._zstd_header)
+                self._zstd_header += view[offset:offset + needed]
+                offset += needed
+                if len(self._zstd_header) < wanted:
+                    break
+                chunk = bytes(self._zstd_header)
+                self._zstd_header.clear()
+                self._check_content_size(chunk)
+                self._dobj = self.decompressor.decompressobj()
+            else:
+                chunk = view[offset:offset + self._remaining]
+                offset += len(chunk)
+            self._remaining -= len(chunk)
+            try:
+                self.unpacker.feed(self._dobj.decompress(chunk))
+            except (zstd.ZstdError, ValueError, msgpack.BufferFull) as e:
+                raise FrameError(f"Corrupted frame: {e}") from e
+
+            if self._remaining == 0:
+                if not self._dobj.eof:
+                    raise FrameError("Frame ended before the zstd stream did")
+                self._dobj = None
+                try:
+                    messages = list(self.unpacker)
+                except (ValueError, msgpack.UnpackException) as e:
+                    raise FrameError(f"Invalid message: {e}") from e
+                yield messages
+
+    def _check_content_size(self, head):
+        try:
+            content_size = zstd.get_frame_parameters(head).content_size
+        except zstd.ZstdError as e:
+            raise FrameError(f"Corrupted frame: {e}") from e
+        if content_size == zstd.CONTENTSIZE_UNKNOWN:
+            raise FrameError("Frame does not declare its decompressed size")
+        if content_size > self.max_decompressed_size:
+            raise FrameError(f"Frame decompresses to {content_size} bytes")
+
+
+class FrameReader:
+    """
+    Reads frames from a blocking socket into one preallocated receive buffer.
+    """
+
+    def __init__(self, sock, decoder, buffer_size=RECV_BUFFER_SIZE):
+        self.sock = sock
+        self.decoder = decoder
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.received = 0  # Size of the last chunk read
+
+    def read(self):
+        """Blocks for the next chunk; returns an iterator of decoded messages, or None on EOF."""
+        received = self.received = self.sock.recv_into(self.buffer)
+        if not received:
+            return None
+        return self.decoder.feed(self.view[:received])
+
+    def read_frames(self):
+        """Like read(), but the iterator yields one list of messages per frame."""
+        received = self.received = self.sock.recv_into(self.buffer)
+        if not received:
+            return None
+        return self.decoder.feed_frames(self.view[:received])
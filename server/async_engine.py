@@ -0,0 +1,179 @@
+import asyncio
+from common.framing import FrameDecoder, FrameError, RECV_BUFFER_SIZE
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+class StreamConnection:
+    """
+    Socket-like facade over an asyncio StreamWriter.
+
+    Command handlers key their state on client sockets and the server only
+    calls getpeername(), getsockname(), shutdown() and close() on them (frames go through
+    the connection's OutboundQueue), so wrapping the writer lets the
+    event-loop engine reuse Server.process_command unchanged.
+    """
+    __slots__ = ('writer', 'peername', 'sockname')
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.peername = writer.get_extra_info('peername')
+        self.sockname = writer.get_extra_info('sockname')
+
+    def getpeername(self):
+        return self.peername
+
+    def getsockname(self):
+        return self.sockname
+
+    def shutdown(self, how=None):
+        # Drops anything still buffered, like shutdown() on a real socket.
+        self.writer.transport.abort()
+
+    def close(self):
+        self.writer.close()
+
+
+class AudioDatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+
+    def connection_made(self, transport):
+        self.server.udp_sendto = transport.sendto
+
+    def datagram_received(self, data, addr):
+        try:
+            self.server.relay_audio(data, addr)
+        except Exception as e:
+            print(f"Error in UDP handler: {e}")
+
+    def error_received(self, exc):
+        print(f"UDP socket error: {exc}")
+
+
+class AsyncioEngine:
+    """
+    Single-threaded event-loop engine for Server.
+
+    Every TCP client is served by a coroutine instead of an OS thread and the
+    UDP relay runs as a datagram protocol on the same loop, so idle
+    connections only cost their stream buffers. Enabled with
+    "engine": "asyncio" in server_config.json.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.streams = set()  # Connection tasks, referenced until they finish.
+
+    def run(self):
+        if uvloop is not None:
+            uvloop.install()
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            print("Server stopped.")
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        self.server.tcp_sock.setblocking(False)
+        if not self.server.relay_pool:
+            self.server.udp_sock.setblocking(False)
+            if self.server.config.get("udp_engine", "recvfrom") == "batched" and not self.server.mixer and not self.server.speakers:
+                from udp_relay import BatchedRelay
+                self.server.batched_relay = BatchedRelay(self.server.udp_sock, self.server.relay_routes,
+                                                          self.server.udp_limits)
+                loop.add_reader(self.server.udp_sock, self.server.batched_relay.drain)
+            else:
+                await loop.create_datagram_endpoint(lambda: AudioDatagramProtocol(self.server), sock=self.server.udp_sock)
+        self.server.wake_acceptor = lambda: loop.call_soon_threadsafe(self.follow_accepting)
+        self.follow_accepting()
+        if self.server.heartbeat:
+            self.heartbeat_task = asyncio.create_task(self.run_heartbeat())
+        print("Event-loop engine running.")
+        await loop.create_future()  # Serves until the process is stopped.
+
+    def follow_accepting(self):
+        """Watches the listening socket while server.accepting is set; a hot restart clears it."""
+        loop = asyncio.get_running_loop()
+        if self.server.accepting.is_set():
+            loop.add_reader(self.server.tcp_sock, self.accept_client)
+        else:
+            loop.remove_reader(self.server.tcp_sock)
+            self.server.acceptor_stopped.set()
+
+    def accept_client(self):
+        try:
+            client_socket, _ = self.server.tcp_sock.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            print(f"Error accepting a connection: {e}")
+            return
+        client_socket.setblocking(False)
+        task = asyncio.create_task(self.open_stream(client_socket))
+        self.streams.add(task)
+        task.add_done_callback(self.streams.discard)
+
+    async def open_stream(self, client_socket):
+        reader, writer = await asyncio.open_connection(sock=client_socket)
+        await self.handle_stream(reader, writer)
+
+    async def run_heartbeat(self):
+        """Ticks the heartbeat on the loop, so evictions run on the same thread as everything else."""
+        heartbeat = self.server.heartbeat
+        while True:
+            await asyncio.sleep(heartbeat.tick_seconds)
+            try:
+                heartbeat.tick()
+            except Exception as e:
+                print(f"Error in heartbeat: {e}")
+
+    async def handle_stream(self, reader, writer):
+        connection = StreamConnection(writer)
+        address = connection.getpeername()
+        print(f"New connection from {address}")
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        queue = self.server.register_connection(connection, on_ready=lambda: loop.call_soon_threadsafe(ready.set))
+        writer_task = asyncio.create_task(self.write_outbound(connection, queue, ready))
+        decoder = FrameDecoder(self.server.zstd_dictionary)
+        try:
+            while True:
+                data = await reader.read(RECV_BUFFER_SIZE)
+                if not data:
+                    break
+                self.server.bytes_in.inc(len(data))
+                frames = decoder.feed_frames(data)
+                backoff = self.server.dispatch_frames(connection, address, frames)
+                while backoff:
+                    await asyncio.sleep(backoff)  # Deferred by a rate limit; only this client waits.
+                    backoff = self.server.dispatch_frames(connection, address, frames)
+        except (ConnectionResetError, ConnectionAbortedError):
+            print(f"Connection lost with {address}")
+        except FrameError as e:
+            print(f"Protocol error from {address}: {e}")
+        finally:
+            self.server.disconnect_client(connection)
+            await writer_task
+
+    async def write_outbound(self, connection, queue, ready):
+        """Drains the connection's OutboundQueue, waiting on the transport for backpressure."""
+        try:
+            while True:
+                frames = queue.take(block=False)
+                if frames:
+                    connection.writer.writelines(frames)
+                    self.server.bytes_out.inc(sum(map(len, frames)))
+                    await connection.writer.drain()
+                    continue
+                if queue.closed:
+                    break
+                await ready.wait()
+                ready.clear()
+        except (ConnectionError, OSError):
+            self.server.disconnect_client(connection)
+        finally:
+            connection.close()
@@ -0,0 +1,350 @@
+"""
+Several server nodes sharing one user namespace ("cluster" in server_config.json).
+
+Nodes talk over a pluggable bus (cluster_bus.py). Each node announces the
+users logged in on it, so presence, invites and kicks span the cluster,
+and the groups it is home to, so initial_data lists every group.
+
+A group lives on the node it was created on: its members, history, search
+index and call. A command about a group that lives elsewhere (a chat
+message, an invite, a call, a history page...) is forwarded to that node
+and handled there by the usual handler, on behalf of a RemoteClient: a
+stand-in for the sender that the group's member set, call roster and
+relay indexes hold like any other session, with the UDP address the
+client gave its own node, so a call relays to it as it would there.
+Whatever the handler sends to a RemoteClient goes back over the bus as
+the encoded frame and is queued on the real connection. A broadcast
+frame crosses the bus once per node, however many of its recipients are
+there.
+
+Group calls stay on the group's node, so their audio is relayed there;
+clients on other nodes are told that node's UDP address ('call_relay'):
+its "advertise_host" if set, else the host it listens on. A node that
+listens on a wildcard address (0.0.0.0, ::) has no address to tell, so
+it refuses to start without "advertise_host".
+All nodes need the same zstd_dictionary, since frames cross unchanged.
+"""
+import threading
+from collections import deque
+from cluster_bus import make_bus
+
+# Commands about one group, by the payload field holding its id.
+ROUTED_COMMANDS = {
+    'invite_to_group': 'group_id',
+    'group_invite_response': 'group_id',
+    'group_message': 'group_id',
+    'request_history': 'chat_id',
+    'search_history': 'group_id',
+    'kick_from_group': 'group_id',
+    'start_group_call': 'group_id',
+    'join_group_call': 'group_id',
+    'leave_group_call': 'group_id',
+}
+CALL_COMMANDS = frozenset({'start_group_call', 'join_group_call'})
+WILDCARD_HOSTS = frozenset({'', '0.0.0.0', '::'})
+
+
+class RemoteClient:
+    """A session on another node, as seen by the node a group lives on."""
+    __slots__ = ('node', 'conn', 'peername')
+
+    def __init__(self, node, conn, peername):
+        self.node = node
+        self.conn = conn
+        self.peername = peername
+
+    def getpeername(self):
+        return self.peername
+
+    def shutdown(self, how=None):
+        pass
+
+    def close(self):
+        pass
+
+
+class RemoteQueue:
+    """Outbound queue of a RemoteClient: frames are handed to the cluster for its node."""
+    dropped = 0
+    closed = False
+
+    def __init__(self, cluster, client):
+        self.cluster = cluster
+        self.client = client
+
+    def __len__(self):
+        return 0
+
+    def put(self, command, frame):
+        self.cluster.deliver(self.client, command, frame)
+        return True
+
+    def close(self, flush=False):
+        self.closed = True
+
+
+class ClusterNode:
+    """
+    The server's view of the rest of the cluster. Messages from the bus are
+    applied under the server's client_lock, on the bus thread; messages to
+    it are queued in order and sent by a thread of their own, so handlers
+    never wait on the network.
+    """
+
+    def __init__(self, server, config, bus=None):
+        self.server = server
+        self.node_id = config.get("node_id") or f"{server.host}:{server.port}"
+        self.relay_addr = [config.get("advertise_host") or server.host, server.port]
+        self.bus = bus or make_bus(config)
+        self.nodes = {}  # {node_id: [relay host, relay port]}
+        self.homes = {}  # {group_id: node_id} for groups that live elsewhere
+        self.groups = {}  # {group_id: initial_data entry} for groups that live elsewhere
+        self.remote_sessions = {}  # {(node_id, conn): username}
+        self.session_addrs = {}  # {(node_id, conn): udp_addr the client logged in with}
+        self.user_sessions = {}  # {username: (node_id, conn)} of the latest remote login
+        self.proxies = {}  # {(node_id, conn): RemoteClient} for remote sessions in our groups
+        self.conns = {}  # {client_socket: conn} for local sessions
+        self.connections = {}  # {conn: client_socket}
+        self.next_conn = 0
+        self.outbox = deque()  # [(node_id or None, message)]
+        self.merge = {}  # {node_id: deliver message still in the outbox, open for more recipients}
+        self.ready = threading.Condition(threading.Lock())
+        self.forwarded = server.metrics.counter('cluster_forwarded_commands_total', 'Commands forwarded to the node their group lives on.')
+        self.deliveries = server.metrics.counter('cluster_delivered_frames_total', 'Frames queued for clients on behalf of other nodes.')
+        server.metrics.gauge_func('cluster_nodes', 'Other cluster nodes on the bus.', lambda: len(self.nodes))
+        server.metrics.gauge_func('cluster_remote_sessions', 'Sessions logged in on other nodes.', lambda: len(self.remote_sessions))
+
+    def start(self):
+        threading.Thread(target=self._send_loop, daemon=True, name='cluster-send').start()
+        self.bus.start(self.node_id, self.on_message, self.on_connected)
+
+    # --- Outgoing ---
+
+    def _publish(self, node, message):
+        with self.ready:
+            self.outbox.append((node, message))
+            if node is None:
+                self.merge.clear()
+            else:
+                self.merge.pop(node, None)
+            self.ready.notify()
+
+    def deliver(self, client, command, frame):
+        """Queues a frame for a RemoteClient; recipients of one broadcast on one node share a message."""
+        with self.ready:
+            message = self.merge.get(client.node)
+            if message is not None and message['frame'] is frame:
+                message['conns'].append(client.conn)
+                return
+            message = {'type': 'deliver', 'command': command, 'frame': frame, 'conns': [client.conn]}
+            self.outbox.append((client.node, message))
+            self.merge[client.node] = message
+            self.ready.notify()
+
+    def _send_loop(self):
+        while True:
+            with self.ready:
+                while not self.outbox:
+                    self.ready.wait()
+                batch, self.outbox = self.outbox, deque()
+                self.merge.clear()
+            for node, message in batch:
+                self.bus.send(node, message)
+
+    # --- Hooks called by the server (with client_lock held) ---
+
+    def route(self, command, payload):
+        """The node a command has to run on, or None to run it here."""
+        field = ROUTED_COMMANDS.get(command)
+        if field is None or not isinstance(payload, dict):
+            return None
+        return self.homes.get(payload.get(field))
+
+    def owns(self, group_id):
+        """Whether a group created here may take this id."""
+        return True
+
+    def forward(self, node, client_socket, messages):
+        """Sends commands to the node their group lives on, on behalf of a local session; a batch stays one."""
+        with self.server.client_lock:
+            client = self.server.clients.get(client_socket)
+            conn = self.conns.get(client_socket)
+            if client is None or conn is None:
+                return
+            for message in messages:
+                udp_addr = message['payload'].get('udp_addr') if message.get('command') == 'join_group_call' else None
+                if isinstance(udp_addr, list) and len(udp_addr) == 2:
+                    # Set there by the handler; ours follows, so later commands carry the same address.
+                    self.server._set_udp_addr(client_socket, tuple(udp_addr))
+            calls = {m['payload'].get('group_id') for m in messages if m.get('command') in CALL_COMMANDS}
+            for group_id in calls:
+                if node in self.nodes:
+                    # The call is relayed by the group's node: send the audio there.
+                    self.server._send_to_client(client_socket, 'call_relay',
+                                                {'group_id': group_id, 'relay_addr': self.relay_address(node, client_socket)})
+            self.forwarded.inc(len(messages))
+            self._publish(node, {'type': 'command', 'conn': conn, 'username': client['username'],
+                                 'address': list(client['address']), 'messages': messages,
+                                 'udp_addr': list(client['udp_addr']) if client['udp_addr'] else None})
+
+    def relay_address(self, node, client_socket):
+        """The UDP address a local session sends the audio of a call on another node to."""
+        return self.nodes[node]
+
+    def session_started(self, client_socket, username):
+        self.next_conn += 1
+        conn = self.next_conn
+        self.conns[client_socket] = conn
+        self.connections[conn] = client_socket
+        udp_addr = self.server.clients[client_socket]['udp_addr']
+        self._publish(None, {'type': 'session', 'conn': conn, 'username': username, 'online': True,
+                             'udp_addr': list(udp_addr) if udp_addr else None})
+
+    def session_ended(self, client_socket):
+        conn = self.conns.pop(client_socket, None)
+        if conn is not None:
+            del self.connections[conn]
+            self._publish(None, {'type': 'session', 'conn': conn, 'online': False})
+
+    def group_changed(self, group_id):
+        self._publish(None, {'type': 'groups', 'groups': {group_id: self._group_info(group_id)}})
+
+    def session(self, username):
+        """The RemoteClient for a user logged in on another node, or None."""
+        key = self.user_sessions.get(username)
+        return self._proxy(key[0], key[1], None) if key else None
+
+    # --- Incoming (bus thread) ---
+
+    def on_connected(self):
+        """(Re)joined the bus: forget what we knew about the others and tell them about us."""
+        ended = []
+        with self.server.client_lock:
+            for node in set(self.nodes) | set(self.homes.values()) | {key[0] for key in self.remote_sessions}:
+                self._node_down(node, ended)
+            self._publish(None, self._sync_message())
+        for client in ended:
+            self.server.disconnect_client(client)
+
+    def on_message(self, sender, message):
+        kind = message.get('type')
+        catch_up = []  # [(RemoteClient, username)] back online with groups here
+        ended = []  # [RemoteClient] of sessions gone offline
+        with self.server.client_lock:
+            if kind == 'deliver':
+                for conn in message['conns']:
+                    client_socket = self.connections.get(conn)
+                    if client_socket is not None:
+                        self.server._enqueue(client_socket, message['command'], message['frame'])
+                self.deliveries.inc(len(message['conns']))
+                return
+            if kind == 'command':
+                client = self._proxy(sender, message['conn'], message['username'], message['address'])
+                if client is not None:
+                    # The client may have changed its address since it logged in (join_group_call elsewhere).
+                    if (sender, message['conn']) in self.remote_sessions:
+                        self.session_addrs[(sender, message['conn'])] = message.get('udp_addr')
+                    self._set_udp_addr(client, message.get('udp_addr'))
+            elif kind == 'session':
+                self._session(sender, message['conn'], message.get('username'), message['online'], catch_up, ended,
+                              message.get('udp_addr'))
+            elif kind == 'groups':
+                self._update_groups(sender, message['groups'])
+            elif kind == 'sync':
+                self._node_down(sender, ended)  # Whatever we knew about it is stale (e.g. it restarted)
+                self.nodes[sender] = message['relay_addr']
+                for conn, username, udp_addr in message['sessions']:
+                    self._session(sender, conn, username, True, catch_up, udp_addr=udp_addr)
+                self._update_groups(sender, message['groups'])
+            elif kind == 'node_up':
+                self._publish(message['node'], self._sync_message())
+            elif kind == 'node_down':
+                self._node_down(message['node'], ended)
+        # Outside client_lock: these take group locks first.
+        for client in ended:
+            self.server.disconnect_client(client)
+        if kind == 'command' and client is not None:
+            if len(message['messages']) == 1:
+                self.server.process_command(client, message['messages'][0], limit=False)
+            else:
+                self.server.process_batch(client, message['messages'], limit=False)
+        for client, username in catch_up:
+            self.server._catch_up(client, username, initial_data=False)
+
+    def _sync_message(self):
+        server = self.server
+        return {'type': 'sync', 'relay_addr': self.relay_addr,
+                'sessions': [[conn, server.clients[s]['username'],
+                              list(server.clients[s]['udp_addr']) if server.clients[s]['udp_addr'] else None]
+                             for conn, s in self.connections.items()],
+                'groups': {group_id: self._group_info(group_id) for group_id in server.groups}}
+
+    def _group_info(self, group_id):
+        group = self.server.groups.get(group_id)
+        if group is None:
+            return None
+        return {'name': group['name'], 'admin': group['admin'],
+                'members': [self.server.clients[m]['username'] for m in group['members']]}
+
+    def _update_groups(self, node, groups):
+        for group_id, info in groups.items():
+            if info is None:
+                self.groups.pop(group_id, None)
+                self.homes.pop(group_id, None)
+            else:
+                self.groups[group_id] = info
+                self.homes[group_id] = node
+        self.server.groups_version += 1
+
+    def _proxy(self, node, conn, username, address=None):
+        key = (node, conn)
+        client = self.proxies.get(key)
+        if client is None:
+            username = username or self.remote_sessions.get(key)
+            if username is None:
+                return None
+            client = self.proxies[key] = RemoteClient(node, conn, tuple(address) if address else (node, conn))
+            self.server.clients[client] = {'username': username, 'address': client.peername, 'udp_addr': None,
+                                           'token': None, 'node': node}
+            self.server.outbound[client] = RemoteQueue(self, client)
+            # Its calls here relay to the client's own address, as if it had logged in here.
+            self._set_udp_addr(client, self.session_addrs.get(key))
+        return client
+
+    def _set_udp_addr(self, client, udp_addr):
+        udp_addr = tuple(udp_addr) if udp_addr else None
+        if self.server.clients[client]['udp_addr'] != udp_addr:
+            self.server._set_udp_addr(client, udp_addr)
+
+    def _session(self, node, conn, username, online, catch_up=None, ended=None, udp_addr=None):
+        server = self.server
+        key = (node, conn)
+        if online:
+            self.session_addrs[key] = udp_addr
+            if key in self.remote_sessions:
+                if key in self.proxies:
+                    self._set_udp_addr(self.proxies[key], udp_addr)
+                return
+            self.remote_sessions[key] = username
+            self.user_sessions[username] = key
+            server.presence.joined(username)
+            if username in server.offline_cursors and catch_up is not None:
+                # Back online elsewhere: rejoin our groups and catch up on them through that node.
+                catch_up.append((self._proxy(node, conn, username), username))
+            return
+        self.session_addrs.pop(key, None)
+        username = self.remote_sessions.pop(key, None)
+        if username is None:
+            return
+        if self.user_sessions.get(username) == key:
+            del self.user_sessions[username]
+        client = self.proxies.pop(key, None)
+        if client is not None:
+            ended.append(client)  # The caller disconnects it once client_lock is released.
+        server.presence.left(username)
+
+    def _node_down(self, node, ended):
+        for key in [key for key in self.remote_sessions if key[0] == node]:
+            self._session(node, key[1], None, False, ended=ended)
+        self._update_groups(node, {group_id: None for group_id, home in self.homes.items() if home == node})
+        self.nodes.pop(node, None)
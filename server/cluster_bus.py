@@ -0,0 +1,205 @@
+"""
+Message bus between the nodes of a cluster (see cluster.py).
+
+A bus carries msgpack-able dicts between named nodes. It must deliver the
+messages one node sends to another in order, and tell every node when
+another one joins or leaves, as {'type': 'node_up' / 'node_down', 'node': id}.
+Backbones plug in by subclassing Bus and registering in BUSES; "tcp" is a
+small broker that runs next to the servers:
+
+    python server/cluster_bus.py --host 127.0.0.1 --port 12400
+"""
+import argparse
+import socket
+import threading
+import time
+import msgpack
+
+MAX_MESSAGE = 64 * 1024 * 1024
+
+
+def send_message(sock, message):
+    sock.sendall(msgpack.packb(message, use_bin_type=True))
+
+
+def read_messages(sock):
+    """Yields the messages arriving on a socket (a plain msgpack stream) until it closes."""
+    unpacker = msgpack.Unpacker(raw=False, max_buffer_size=MAX_MESSAGE)
+    while True:
+        data = sock.recv(256 * 1024)
+        if not data:
+            return
+        unpacker.feed(data)
+        yield from unpacker
+
+
+class Bus:
+    """
+    What a cluster node needs from its backbone.
+
+    start() connects and calls on_connected() every time the node (re)joins
+    the bus; on_message(sender, message) is then called, from one thread,
+    for every message sent to this node. send(None, message) goes to every
+    other node. A node that loses the bus is reported down to the others.
+    """
+
+    def start(self, node_id, on_message, on_connected):
+        raise NotImplementedError
+
+    def send(self, node, message):
+        raise NotImplementedError
+
+
+class TcpBus(Bus):
+    """Client of BusBroker: one TCP connection, re-established if the broker restarts."""
+
+    def __init__(self, address, retry=1.0):
+        host, _, port = address.rpartition(':')
+        self.address = (host or '127.0.0.1', int(port))
+        self.retry = retry
+        self.sock = None
+        self.connected = threading.Event()
+
+    def start(self, node_id, on_message, on_connected):
+        self.node_id = node_id
+        self.on_message = on_message
+        self.on_connected = on_connected
+        self._connect(wait=False)
+        threading.Thread(target=self._read, daemon=True, name='cluster-bus').start()
+
+    def _connect(self, wait=True):
+        while True:
+            try:
+                sock = socket.create_connection(self.address)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                send_message(sock, {'hello': self.node_id})
+                self.sock = sock
+                self.connected.set()
+                return
+            except OSError as e:
+                if not wait:
+                    print(f"Cluster bus at {self.address[0]}:{self.address[1]} not reachable ({e}), retrying.")
+                    wait = True
+                time.sleep(self.retry)
+
+    def _read(self):
+        while True:
+            if self.sock is None:
+                self._connect()
+            print(f"Joined the cluster bus at {self.address[0]}:{self.address[1]} as '{self.node_id}'.")
+            try:
+                self.on_connected()
+                for envelope in read_messages(self.sock):
+                    try:
+                        self.on_message(envelope.get('from'), envelope['message'])
+                    except Exception as e:
+                        print(f"Error handling cluster message: {e}")
+            except (OSError, ValueError) as e:
+                print(f"Cluster bus error: {e}")
+            print("Lost the cluster bus, reconnecting.")
+            self.connected.clear()
+            self.sock.close()
+            self.sock = None
+
+    def send(self, node, message):
+        self.connected.wait()
+        try:
+            send_message(self.sock, {'to': node, 'message': message})
+        except (OSError, AttributeError):
+            pass  # The reader reconnects; the other nodes saw us go down and resync.
+
+
+class BusBroker:
+    """
+    Stand-in message broker: forwards each message to its target node, or to
+    every other node, and announces nodes joining and leaving.
+    """
+
+    def __init__(self, host, port):
+        self.sock = socket.create_server((host, port))
+        self.nodes = {}  # {node_id: (socket, send lock)}
+        self.lock = threading.Lock()
+
+    def serve_forever(self):
+        host, port = self.sock.getsockname()[:2]
+        print(f"Cluster bus broker listening on {host}:{port}.")
+        while True:
+            sock, address = self.sock.accept()
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self._serve_node, args=(sock, address), daemon=True).start()
+
+    def _send(self, node, message):
+        entry = self.nodes.get(node)
+        if entry is None:
+            return
+        sock, lock = entry
+        try:
+            with lock:
+                sock.sendall(message)
+        except OSError:
+            pass  # Its reader notices and announces it down.
+
+    def _broadcast(self, sender, data):
+        with self.lock:
+            others = [node for node in self.nodes if node != sender]
+        for node in others:
+            self._send(node, data)
+
+    def _serve_node(self, sock, address):
+        node_id = None
+        try:
+            messages = read_messages(sock)
+            hello = next(messages, None)
+            if not isinstance(hello, dict) or 'hello' not in hello:
+                return
+            node_id = hello['hello']
+            with self.lock:
+                previous = self.nodes.get(node_id)
+                self.nodes[node_id] = (sock, threading.Lock())
+            if previous:
+                previous[0].close()
+            self._broadcast(node_id, self._pack(None, {'type': 'node_up', 'node': node_id}))
+            print(f"Node '{node_id}' joined from {address}.")
+            for envelope in messages:
+                data = self._pack(node_id, envelope.get('message'))
+                if envelope.get('to') is None:
+                    self._broadcast(node_id, data)
+                else:
+                    self._send(envelope['to'], data)
+        except (OSError, ValueError) as e:
+            print(f"Node '{node_id}' connection error: {e}")
+        finally:
+            sock.close()
+            if node_id is not None:
+                with self.lock:
+                    if self.nodes.get(node_id, (None,))[0] is sock:
+                        del self.nodes[node_id]
+                    else:
+                        return  # Replaced by a newer connection of the same node.
+                print(f"Node '{node_id}' left.")
+                self._broadcast(node_id, self._pack(None, {'type': 'node_down', 'node': node_id}))
+
+    @staticmethod
+    def _pack(sender, message):
+        return msgpack.packb({'from': sender, 'message': message}, use_bin_type=True)
+
+
+BUSES = {'tcp': lambda config: TcpBus(config.get("broker", "127.0.0.1:12400"))}
+
+
+def make_bus(config):
+    kind = config.get("bus", "tcp")
+    if kind not in BUSES:
+        raise ValueError(f"unknown cluster bus '{kind}' (available: {', '.join(BUSES)})")
+    return BUSES[kind](config)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cluster bus broker")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=12400)
+    args = parser.parse_args()
+    try:
+        BusBroker(args.host, args.port).serve_forever()
+    except KeyboardInterrupt:
+        print("Broker stopped.")
@@ -0,0 +1,197 @@
+"""
+Group-sharded worker processes ("workers" > 1 in server_config.json).
+
+The acceptor process keeps every client connection: it reads and decodes
+frames, handles logins, presence and heartbeats, and forwards each command
+about a group to the worker process that owns the group, picked by a hash
+of the group_id. A worker is a Server without a TCP listener. The group's
+member set, history, search index and call all live in that worker, and
+the call's audio is relayed from the worker's own UDP port. Group commands
+thus run on as many cores as there are workers.
+
+With "metrics" enabled every worker serves the metrics of the groups it
+owns (command, history and search timings, calls...) itself, on the
+acceptor's metrics port + 1 + its index (9101, 9102... by default), or at
+"<unix_socket>.worker-<index>"; the acceptor's own /metrics covers the
+connections, logins and presence.
+
+Clients are sent to a worker's UDP port at the address they reached the
+acceptor on (or at "cluster": {"advertise_host"} if set), since the
+workers bind the same host as the acceptor, which may be a wildcard.
+
+This is a one-machine cluster (see cluster.py): the acceptor and the
+workers are nodes joined by pipes instead of a broker, and the workers
+reach clients through the same RemoteClient stand-ins. A worker exits
+when the acceptor goes away.
+"""
+import itertools
+import multiprocessing
+import threading
+import zlib
+from multiprocessing.connection import wait
+from cluster import ClusterNode, ROUTED_COMMANDS, WILDCARD_HOSTS
+from cluster_bus import Bus
+
+ACCEPTOR = 'acceptor'
+
+
+def worker_name(index):
+    return f"worker-{index}"
+
+
+def owner(group_id, workers):
+    """The worker a group lives on."""
+    return worker_name(zlib.crc32(group_id.encode('utf-8')) % workers)
+
+
+class WorkerHub(Bus):
+    """The acceptor's end of the pipes: one per worker, all read by one thread."""
+
+    def __init__(self, pipes):
+        self.pipes = pipes  # {worker name: Connection}
+
+    def start(self, node_id, on_message, on_connected):
+        self.on_message = on_message
+        on_connected()
+        threading.Thread(target=self._read, daemon=True, name='group-workers').start()
+
+    def _read(self):
+        names = {pipe: name for name, pipe in self.pipes.items()}
+        while names:
+            for pipe in wait(list(names)):
+                try:
+                    message = pipe.recv()
+                except (EOFError, OSError):
+                    name = names.pop(pipe)
+                    print(f"Group worker '{name}' exited; its groups are unavailable.")
+                    self.pipes.pop(name, None)
+                    self.on_message(None, {'type': 'node_down', 'node': name})
+                    continue
+                try:
+                    self.on_message(names[pipe], message)
+                except Exception as e:
+                    print(f"Error handling message from group worker: {e}")
+
+    def send(self, node, message):
+        for pipe in list(self.pipes.values()) if node is None else [self.pipes.get(node)]:
+            try:
+                if pipe is not None:
+                    pipe.send(message)
+            except OSError:
+                pass  # Exited; the reader reports it down.
+
+
+class WorkerPipeBus(Bus):
+    """A worker's end: everything goes to, and comes from, the acceptor."""
+
+    def __init__(self, pipe):
+        self.pipe = pipe
+        self.closed = threading.Event()
+
+    def start(self, node_id, on_message, on_connected):
+        self.on_message = on_message
+        on_connected()
+        threading.Thread(target=self._read, daemon=True, name='acceptor').start()
+
+    def _read(self):
+        while True:
+            try:
+                message = self.pipe.recv()
+            except (EOFError, OSError):
+                self.closed.set()
+                return
+            try:
+                self.on_message(ACCEPTOR, message)
+            except Exception as e:
+                print(f"Error handling message from the acceptor: {e}")
+
+    def send(self, node, message):
+        try:
+            self.pipe.send(message)
+        except OSError:
+            pass
+
+
+class AcceptorNode(ClusterNode):
+    """Routes group commands by hash of the group_id; new groups go to the workers in turn."""
+
+    def __init__(self, server, pipes):
+        super().__init__(server, {'node_id': ACCEPTOR}, WorkerHub(pipes))
+        self.workers = len(pipes)
+        self.placement = itertools.cycle(sorted(pipes))
+
+    def route(self, command, payload):
+        if command == 'create_group':
+            for _ in range(self.workers):
+                node = next(self.placement)
+                if node in self.nodes:  # Still running
+                    break
+            return node
+        field = ROUTED_COMMANDS.get(command)
+        if field is None or not isinstance(payload, dict):
+            return None
+        group_id = payload.get(field)
+        if not isinstance(group_id, str) or group_id == 'global':
+            return None
+        return owner(group_id, self.workers)
+
+    def relay_address(self, node, client_socket):
+        host, port = self.nodes[node]
+        if host in WILDCARD_HOSTS:
+            host = client_socket.getsockname()[0]  # The address this client reached us on
+        return [host, port]
+
+
+class WorkerNode(ClusterNode):
+    """A worker's view: every client is on the acceptor."""
+
+    def __init__(self, server, index, workers, pipe):
+        config = {'node_id': worker_name(index), 'advertise_host': server.config.get("cluster", {}).get("advertise_host")}
+        super().__init__(server, config, WorkerPipeBus(pipe))
+        self.workers = workers
+
+    def owns(self, group_id):
+        return owner(group_id, self.workers) == self.node_id
+
+
+def run_worker(server_class, host, password, index, workers, pipe):
+    """Entry point of a group worker process."""
+    server = server_class(host, 0, password, worker=(index, workers, pipe))
+    server.udp_sock.bind((host, 0))
+    server.cluster.relay_addr[1] = server.udp_sock.getsockname()[1]
+    if server.mixer:
+        from mixer import MixerThread
+        MixerThread(server, server.mixer).start()
+    threading.Thread(target=server.handle_udp_audio, daemon=True).start()
+    metrics_config = dict(server.config.get("metrics", {}))
+    if metrics_config.get("enabled", False):
+        if metrics_config.get("unix_socket"):
+            metrics_config["unix_socket"] += f".{worker_name(index)}"
+        else:
+            metrics_config["port"] = metrics_config.get("port", 9100) + 1 + index
+        server._start_metrics(metrics_config)
+    server.cluster.start()
+    server.cluster.bus.closed.wait()
+    server.history.close()
+
+
+class GroupWorkerPool:
+    """Starts the worker processes; the acceptor's AcceptorNode talks to them."""
+
+    def __init__(self, server_class, host, password, workers):
+        self.processes = []
+        self.pipes = {}
+        for index in range(workers):
+            parent_conn, child_conn = multiprocessing.Pipe()
+            self.processes.append(multiprocessing.Process(target=run_worker, daemon=True, name=worker_name(index),
+                                                          args=(server_class, host, password, index, workers, child_conn)))
+            self.pipes[worker_name(index)] = (parent_conn, child_conn)
+
+    def node(self, server):
+        return AcceptorNode(server, {name: parent_conn for name, (parent_conn, _) in self.pipes.items()})
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+        for _, child_conn in self.pipes.values():
+            child_conn.close()
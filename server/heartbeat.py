@@ -0,0 +1,83 @@
+import random
+import threading
+import time
+from timer_wheel import TimerWheel
+
+
+class Heartbeat:
+    """
+    Application-level liveness for client connections ("heartbeat").
+
+    Anything a client sends counts as a sign of life. A connection that has
+    been silent for `interval` seconds is sent a ping, which clients answer
+    with a pong; one silent for `timeout` seconds is considered dead
+    (half-open TCP, a crashed or suspended client) and evicted.
+
+    Receiving data only stores a timestamp from a clock that tick() updates,
+    so the read path never touches the timer wheel. Each connection holds a
+    single timer, which is moved forward when it fires and the connection
+    turned out to be active. That keeps the cost of tick() to about one timer
+    per connection per `interval`, however many connections there are.
+
+    on_ping(keys) and on_dead(key) are called from tick(), outside the lock.
+    """
+
+    def __init__(self, on_ping, on_dead, interval=15.0, timeout=45.0, tick=1.0):
+        self.on_ping = on_ping
+        self.on_dead = on_dead
+        self.interval = interval
+        self.timeout = max(timeout, interval)
+        self.tick_seconds = tick
+        self.wheel = TimerWheel(tick, slots=int(self.timeout // tick) + 2)
+        self.last_seen = {}  # {connection: clock value of the last data received}
+        self.now = time.monotonic()
+        self.lock = threading.Lock()  # Guards the wheel; last_seen values are plain stores
+        self.evicted = 0
+        self.pings = 0
+
+    def add(self, key):
+        with self.lock:
+            self.last_seen[key] = self.now
+            # Spread the first check, so a reconnect storm does not come due in a single tick.
+            self.wheel.schedule(key, self.now + self.interval * random.uniform(0.5, 1.0))
+
+    def seen(self, key):
+        if key in self.last_seen:  # Not re-added after remove()
+            self.last_seen[key] = self.now
+
+    def remove(self, key):
+        with self.lock:
+            self.wheel.cancel(key)
+            self.last_seen.pop(key, None)
+
+    def tick(self):
+        self.now = now = time.monotonic()
+        ping, dead = [], []
+        with self.lock:
+            for key in self.wheel.advance(now):
+                last_seen = self.last_seen.get(key)
+                if last_seen is None:
+                    continue
+                idle = now - last_seen
+                if idle >= self.timeout:
+                    dead.append(key)
+                elif idle >= self.interval:
+                    ping.append(key)
+                    self.wheel.schedule(key, last_seen + self.timeout)
+                else:
+                    self.wheel.schedule(key, last_seen + self.interval)
+        if ping:
+            self.pings += len(ping)
+            self.on_ping(ping)
+        for key in dead:
+            self.evicted += 1
+            self.on_dead(key)
+
+    def run(self):
+        """Ticks forever (the threaded engine runs this on its own thread)."""
+        while True:
+            time.sleep(self.tick_seconds)
+            try:
+                self.tick()
+            except Exception as e:
+                print(f"Error in heartbeat: {e}")
@@ -0,0 +1,218 @@
+import hashlib
+import os
+import re
+import struct
+import threading
+from bisect import bisect_right
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import msgpack
+
+RECORD_HEADER = struct.Struct('!I')
+INDEX_ENTRY = struct.Struct('!Q')
+SEGMENT_SUFFIX = '.log'
+INDEX_SUFFIX = '.idx'
+SAFE_CHAT_ID = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+class ChatLog:
+    """
+    Append-only log of one chat, split into segments.
+
+    Messages get consecutive integer ids starting at 0. Segment files are
+    named after the id of their first message; each .log holds
+    length-prefixed msgpack records and its .idx sibling holds one 8-byte
+    file offset per record, so message `id` lives at
+    idx[(id - base) * 8] of the segment whose base is the largest <= id.
+    Callers hold `lock`, and must not use a log the store has evicted.
+    """
+
+    def __init__(self, directory, segment_bytes):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.lock = threading.Lock()
+        self.tail = None  # deque([(message_id, message)]) once the chat has been read
+        self.evicted = False  # Closed by the store; the chat is reopened as a new ChatLog
+        os.makedirs(directory, exist_ok=True)
+        self.bases = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(directory)
+                            if name.endswith(SEGMENT_SUFFIX))
+        self.log_file = None
+        self.index_file = None
+        if not self.bases:
+            self.bases.append(0)
+        self.next_id = self.bases[-1] + self._recover(self.bases[-1])
+        self._open_active()
+
+    def _path(self, base, suffix):
+        return os.path.join(self.directory, f"{base:016d}{suffix}")
+
+    def _recover(self, base):
+        """Drops a torn trailing index entry and returns the record count of a segment."""
+        index_path = self._path(base, INDEX_SUFFIX)
+        if not os.path.exists(index_path):
+            open(index_path, 'ab').close()
+            open(self._path(base, SEGMENT_SUFFIX), 'ab').close()
+            return 0
+        size = os.path.getsize(index_path)
+        if size % INDEX_ENTRY.size:
+            size -= size % INDEX_ENTRY.size
+            os.truncate(index_path, size)
+        return size // INDEX_ENTRY.size
+
+    def _open_active(self):
+        base = self.bases[-1]
+        self.log_file = open(self._path(base, SEGMENT_SUFFIX), 'ab')
+        self.index_file = open(self._path(base, INDEX_SUFFIX), 'ab')
+
+    def append(self, message):
+        if self.log_file.tell() >= self.segment_bytes:
+            self.close()
+            self.bases.append(self.next_id)
+            self._recover(self.next_id)
+            self._open_active()
+        packed = msgpack.packb(message, use_bin_type=True)
+        offset = self.log_file.tell()
+        self.log_file.write(RECORD_HEADER.pack(len(packed)) + packed)
+        self.log_file.flush()
+        # The index entry is written last: a crash in between leaves an
+        # unreferenced record, never an index entry pointing at garbage.
+        self.index_file.write(INDEX_ENTRY.pack(offset))
+        self.index_file.flush()
+        message_id = self.next_id
+        self.next_id += 1
+        return message_id
+
+    def read_range(self, start, end):
+        """Returns the messages with ids in [start, end), reading each segment once."""
+        messages = []
+        while start < end:
+            segment = bisect_right(self.bases, start) - 1
+            base = self.bases[segment]
+            segment_end = self.bases[segment + 1] if segment + 1 < len(self.bases) else self.next_id
+            stop = min(end, segment_end)
+            messages.extend(self._read_segment(base, start - base, stop - base))
+            start = stop
+        return messages
+
+    def _read_segment(self, base, first, last):
+        with open(self._path(base, INDEX_SUFFIX), 'rb') as index_file:
+            index_file.seek(first * INDEX_ENTRY.size)
+            raw = index_file.read((last - first) * INDEX_ENTRY.size)
+        offsets = [entry[0] for entry in INDEX_ENTRY.iter_unpack(raw)]
+        if not offsets:
+            return []
+        # One contiguous read from the first record to the end of the last.
+        with open(self._path(base, SEGMENT_SUFFIX), 'rb') as log_file:
+            log_file.seek(offsets[-1])
+            (last_length,) = RECORD_HEADER.unpack(log_file.read(RECORD_HEADER.size))
+            log_file.seek(offsets[0])
+            data = log_file.read(offsets[-1] + RECORD_HEADER.size + last_length - offsets[0])
+        messages = []
+        for offset in offsets:
+            position = offset - offsets[0]
+            (length,) = RECORD_HEADER.unpack_from(data, position)
+            start = position + RECORD_HEADER.size
+            messages.append(msgpack.unpackb(data[start:start + length], raw=False))
+        return messages
+
+    def close(self):
+        for f in (self.log_file, self.index_file):
+            if f:
+                f.close()
+        self.log_file = self.index_file = None
+
+
+class HistoryStore:
+    """
+    Persistent chat history with paginated reads.
+
+    Each chat is a segmented append-only ChatLog on disk. Only the
+    `max_open_chats` most recently used chats are open, with their files and
+    a tail cache of their most recent messages; the least recently used one
+    is closed and dropped when another opens, and reopened from disk on its
+    next use. Memory thus stays flat no matter how many chats there are or
+    how long their history grows. Reads cost O(page), not
+    O(history). Every chat has its own lock, so writes to different chats
+    do not wait for each other's disk I/O.
+    """
+
+    def __init__(self, directory, segment_bytes=8 * 1024 * 1024, cache_messages=200, max_open_chats=256):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.cache_messages = cache_messages
+        self.max_open_chats = max_open_chats
+        self.logs = OrderedDict()  # {chat_id: ChatLog} of the open chats, least recently used first
+        self.lock = threading.Lock()  # Guards `logs`, not the chats themselves
+        os.makedirs(directory, exist_ok=True)
+
+    def _chat_dir(self, chat_id):
+        if SAFE_CHAT_ID.match(chat_id):
+            return os.path.join(self.directory, chat_id)
+        return os.path.join(self.directory, hashlib.sha1(chat_id.encode('utf-8')).hexdigest())
+
+    @contextmanager
+    def _log(self, chat_id):
+        """Holds the lock of a chat's log, opening the log if it is not open."""
+        while True:
+            with self.lock:
+                log = self.logs.get(chat_id)
+                if log is None:
+                    log = self.logs[chat_id] = ChatLog(self._chat_dir(chat_id), self.segment_bytes)
+                    if len(self.logs) > self.max_open_chats:
+                        # Closed before the chat can be reopened, so two logs never append to its files.
+                        _, evicted = self.logs.popitem(last=False)
+                        with evicted.lock:
+                            evicted.close()
+                            evicted.evicted = True
+                else:
+                    self.logs.move_to_end(chat_id)
+            with log.lock:
+                if not log.evicted:
+                    yield log
+                    return
+            # Evicted between the lookup and taking its lock.
+
+    def append(self, chat_id, message):
+        """Stores a message and returns its id within the chat."""
+        with self._log(chat_id) as log:
+            message_id = log.append(message)
+            # Only extend a tail that is contiguous with the log; a cold chat
+            # is loaded from disk on its first read instead.
+            tail = log.tail
+            if tail is not None and (not tail or tail[-1][0] == message_id - 1):
+                tail.append((message_id, message))
+            return message_id
+
+    def read(self, chat_id, before_id=None, limit=50):
+        """
+        Returns (first_id, messages) for up to `limit` messages older than
+        `before_id` (the newest ones if it is None), oldest first.
+        """
+        with self._log(chat_id) as log:
+            end = log.next_id if before_id is None else max(0, min(before_id, log.next_id))
+            start = max(0, end - limit)
+            if log.tail is None:
+                first = max(0, log.next_id - self.cache_messages)
+                log.tail = deque(zip(range(first, log.next_id), log.read_range(first, log.next_id)),
+                                 maxlen=self.cache_messages)
+            tail = log.tail
+            if tail and tail[0][0] <= start:
+                first_cached = tail[0][0]
+                messages = [message for _, message in list(tail)[start - first_cached:end - first_cached]]
+            else:
+                messages = log.read_range(start, end)
+            return start, messages
+
+    def next_id(self, chat_id):
+        """Returns the id the chat's next message will get."""
+        with self._log(chat_id) as log:
+            return log.next_id
+
+    def close(self):
+        with self.lock:
+            logs = list(self.logs.values())
+            self.logs.clear()
+        for log in logs:
+            with log.lock:
+                log.close()
+                log.evicted = True
@@ -0,0 +1,114 @@
+"""
+Zero-downtime restarts ("hot_restart" in server_config.json).
+
+The running server listens on a Unix control socket. A new server started
+with --takeover finishes initialising, connects to it and the old one:
+
+1. stops accepting connections and freezes its state (every group lock,
+   then client_lock), so no command and no history append can run any more;
+2. writes groups, memberships and calls to the snapshot file;
+3. passes its listening TCP socket (and UDP socket) over SCM_RIGHTS;
+4. waits for the new process to confirm it is serving, then exits.
+
+The listening socket is never closed, so clients connecting meanwhile
+wait in its backlog instead of being refused. Established connections do
+close; clients log in again with the session token from their
+login_success and the new server puts them back into their groups and
+calls. If the new process fails before confirming, the old one unfreezes,
+accepts again and keeps serving.
+"""
+import os
+import socket
+import threading
+import msgpack
+from common.dictionary import make_compressor, make_decompressor
+
+TAKEOVER = b'takeover'
+READY = b'ready'
+MAX_MESSAGE = 64 * 1024
+
+
+def supported():
+    return hasattr(socket, 'AF_UNIX') and hasattr(socket, 'send_fds')
+
+
+def write_snapshot(path, state):
+    """Writes the state as zstd-compressed msgpack, atomically."""
+    data = make_compressor().compress(msgpack.packb(state, use_bin_type=True))
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+def read_snapshot(path):
+    with open(path, 'rb') as f:
+        return msgpack.unpackb(make_decompressor().decompress(f.read()), raw=False)
+
+
+class HandoffListener(threading.Thread):
+    """Old-process side: hands the server over to whoever asks on the control socket."""
+
+    def __init__(self, server, path, snapshot_path, timeout=30):
+        super().__init__(daemon=True, name='hot-restart')
+        self.server = server
+        self.path = path
+        self.snapshot_path = snapshot_path
+        self.timeout = timeout
+        if os.path.exists(path):
+            os.unlink(path)  # Left by the process we took over from, or by a crash.
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(1)
+
+    def run(self):
+        while True:
+            conn, _ = self.sock.accept()
+            with conn:
+                try:
+                    self.hand_off(conn)
+                except OSError as e:
+                    print(f"Takeover aborted, still serving: {e}")
+
+    def hand_off(self, conn):
+        conn.settimeout(self.timeout)
+        if conn.recv(len(TAKEOVER)) != TAKEOVER:
+            return
+        # A connection accepted from here on would hang on the frozen locks and
+        # die with this process; left in the backlog, the new process gets it.
+        try:
+            if not self.server.stop_accepting(self.timeout):
+                print("Takeover aborted: the accept loop did not stop. Still serving.")
+                return
+            with self.server.frozen():
+                write_snapshot(self.snapshot_path, self.server.snapshot_state())
+                sockets = self.server.listening_sockets()
+                info = {'snapshot': os.path.abspath(self.snapshot_path), 'sockets': list(sockets)}
+                socket.send_fds(conn, [msgpack.packb(info, use_bin_type=True)], [s.fileno() for s in sockets.values()])
+                if conn.recv(len(READY)) != READY:
+                    print("Takeover aborted: the new process did not confirm. Still serving.")
+                    return
+                print("Handed over to the new server process. Exiting.")
+                # Still frozen: nothing may change after the snapshot was taken.
+                self.server.exit_after_handoff()
+        finally:
+            self.server.resume_accepting()
+
+
+def take_over(path, timeout=30):
+    """
+    New-process side. Returns (control connection, {'tcp' | 'udp': fd}, state);
+    send READY on the connection once serving to let the old process exit.
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(timeout)
+    conn.connect(path)
+    conn.sendall(TAKEOVER)
+    message, fds, _, _ = socket.recv_fds(conn, MAX_MESSAGE, 2)
+    if not message:
+        conn.close()
+        raise ConnectionError("the running server closed the control connection")
+    info = msgpack.unpackb(message, raw=False)
+    return conn, dict(zip(info['sockets'], fds)), read_snapshot(info['snapshot'])
@@ -0,0 +1,293 @@
+"""
+In-process metrics for the server, exposed in the Prometheus text format.
+
+Counters and histograms are updated from handler, writer and relay threads
+and cost one uncontended lock per update. Values that already live in server
+state (queue depths, connection counts, relay totals kept by the single relay
+thread) are read by callbacks at scrape time instead, so the hot paths pay
+nothing for them.
+"""
+import os
+import socketserver
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter as _Tally
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=''):
+    pairs = ['%s="%s"' % (name, _escape(value)) for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    """Monotonic counter, optionally split by label values: inc(1, ('login',))."""
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, labels=()):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        with self.lock:
+            values = list(self.values.items())
+        return [f"{self.name}{_format_labels(self.labels, key)} {value}" for key, value in values]
+
+
+class Histogram:
+    """Cumulative-bucket histogram of observed values (seconds, by convention)."""
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.values = {}  # {labels: [bucket counts..., +Inf count, sum]}
+        self.lock = threading.Lock()
+
+    def observe(self, value, labels=()):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(labels)
+            if series is None:
+                series = self.values[labels] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        with self.lock:
+            values = [(key, list(series)) for key, series in self.values.items()]
+        lines = []
+        for key, series in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {series[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+class Callback:
+    """A gauge or counter whose value is read from server state at scrape time."""
+
+    def __init__(self, name, help, type, func, labels=()):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.func = func
+        self.labels = labels
+
+    def render(self):
+        value = self.func()
+        if not isinstance(value, dict):
+            value = {(): value}
+        return [f"{self.name}{_format_labels(self.labels, key)} {v}" for key, v in value.items()]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def gauge_func(self, name, help, func, labels=()):
+        return self._add(Callback(name, help, 'gauge', func, labels))
+
+    def counter_func(self, name, help, func, labels=()):
+        return self._add(Callback(name, help, 'counter', func, labels))
+
+    def render(self):
+        """Returns every metric in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                lines.append(f"# error collecting {metric.name}: {e}")
+        return '\n'.join(lines) + '\n'
+
+
+class TimedLock:
+    """
+    Wraps a (re-entrant) lock and records how long acquirers had to wait.
+    The uncontended path is a single non-blocking acquire; only contended
+    acquisitions are timed and observed.
+    """
+
+    def __init__(self, lock, histogram, labels=()):
+        self.lock = lock
+        self.histogram = histogram
+        self.labels = labels
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self.lock.acquire(False):
+            return True
+        if not blocking:
+            return False
+        start = time.perf_counter()
+        acquired = self.lock.acquire(True, timeout)
+        self.histogram.observe(time.perf_counter() - start, self.labels)
+        return acquired
+
+    def release(self):
+        self.lock.release()
+
+    __enter__ = acquire
+
+    def __exit__(self, *exc_info):
+        self.lock.release()
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler: a background thread samples the stack of every
+    other thread at a fixed interval and counts identical stacks. Results are
+    returned in the folded format (one "frame;frame;frame count" line per
+    stack) that flamegraph.pl and speedscope read.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = _Tally()
+        self.thread = None
+        self.running = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.running:
+                return False
+            self.samples = _Tally()
+            self.running = True
+            self.thread = threading.Thread(target=self._run, daemon=True, name='sampling-profiler')
+            self.thread.start()
+            return True
+
+    def stop(self):
+        """Stops sampling and returns the folded stacks collected so far."""
+        with self.lock:
+            self.running = False
+            thread = self.thread
+        if thread:
+            thread.join()
+        return ''.join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+    def _run(self):
+        me = threading.get_ident()
+        names = {}
+        while self.running:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                if ident not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                stack.append(names.get(ident, str(ident)))
+                self.samples[';'.join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        endpoint = self.server.endpoint
+        if url.path == '/metrics':
+            self._reply(200, endpoint.registry.render(), 'text/plain; version=0.0.4')
+        elif url.path.startswith('/debug/profile') and endpoint.profiler is None:
+            self._reply(404, "Profiler is disabled ('metrics': {'profiler': true}).\n")
+        elif url.path == '/debug/profile':
+            # Samples for ?seconds=N (default 10) and returns the folded stacks.
+            seconds = float(parse_qs(url.query).get('seconds', ['10'])[0])
+            if not endpoint.profiler.start():
+                self._reply(409, "Profiler is already running.\n")
+                return
+            time.sleep(min(seconds, 300))
+            self._reply(200, endpoint.profiler.stop())
+        elif url.path == '/debug/profile/start':
+            started = endpoint.profiler.start()
+            self._reply(200 if started else 409, "started\n" if started else "already running\n")
+        elif url.path == '/debug/profile/stop':
+            self._reply(200, endpoint.profiler.stop())
+        else:
+            self._reply(404, "Not found\n")
+
+    def _reply(self, status, body, content_type='text/plain; charset=utf-8'):
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        pass  # Scrapes every few seconds would drown out the server log.
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ('unix', 0)
+
+
+class MetricsEndpoint:
+    """
+    Serves /metrics (and, if enabled, /debug/profile) over HTTP on a local
+    TCP port or a Unix socket, from a daemon thread.
+    """
+
+    def __init__(self, registry, host='127.0.0.1', port=9100, unix_socket=None, profiler=False):
+        self.registry = registry
+        self.profiler = SamplingProfiler() if profiler else None
+        if unix_socket:
+            if os.path.exists(unix_socket):
+                os.unlink(unix_socket)
+            self.httpd = _UnixHTTPServer(unix_socket, _MetricsHandler)
+            self.address = unix_socket
+        else:
+            self.httpd = ThreadingHTTPServer((host, port), _MetricsHandler)
+            self.httpd.daemon_threads = True
+            self.address = f"http://{host}:{self.httpd.server_address[1]}"
+        self.httpd.endpoint = self
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True, name='metrics-endpoint').start()
@@ -0,0 +1,140 @@
+import socket
+import threading
+from collections import deque
+
+# Full-state snapshots: a newer one makes any still-queued copy obsolete.
+COALESCED_COMMANDS = frozenset({'presence_snapshot'})
+
+POLICIES = ('drop_oldest', 'coalesce', 'disconnect')
+
+# Stay below the kernel's iovec limit (IOV_MAX is 1024 on Linux).
+MAX_IOVECS = 1024
+
+
+def send_frames(sock, frames):
+    """
+    Writes a batch of frames with vectored sendmsg() calls, so a burst of
+    queued messages (often the very same broadcast buffer) costs one syscall
+    instead of one per frame. Falls back to a single sendall() where sendmsg
+    is unavailable (Windows).
+    """
+    if not hasattr(sock, 'sendmsg'):
+        sock.sendall(b''.join(frames))
+        return
+    views = [memoryview(frame) for frame in frames]
+    start = 0
+    while start < len(views):
+        sent = sock.sendmsg(views[start:start + MAX_IOVECS])
+        while sent:
+            size = len(views[start])
+            if sent >= size:
+                sent -= size
+                start += 1
+            else:
+                views[start] = views[start][sent:]
+                sent = 0
+
+
+class OutboundQueue:
+    """
+    Bounded queue of encoded frames waiting to be written to one client.
+
+    Handlers only ever append to it, so a slow or stalled client can no longer
+    block the thread (and the lock) that is broadcasting to it. When the queue
+    is full the overflow policy decides what happens:
+
+    - "drop_oldest": the oldest pending frame is discarded.
+    - "coalesce": pending snapshot frames (presence_snapshot) are replaced by
+      the newest one; if the queue is still full the oldest frame is dropped.
+    - "disconnect": put() returns False and the caller drops the client.
+    """
+
+    def __init__(self, max_frames=1024, policy='drop_oldest', on_ready=None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown outbound queue policy '{policy}'")
+        self.max_frames = max_frames
+        self.policy = policy
+        self.on_ready = on_ready
+        self.frames = deque()  # [(command, frame bytes)]
+        self.cond = threading.Condition()
+        self.closed = False
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+    def put(self, command, frame):
+        """Queues a frame. Returns False if the client should be disconnected."""
+        with self.cond:
+            if self.closed:
+                return True
+            if self.policy == 'coalesce' and command in COALESCED_COMMANDS:
+                self._discard_pending(command)
+            if len(self.frames) >= self.max_frames:
+                if self.policy == 'disconnect':
+                    return False
+                self.frames.popleft()
+                self.dropped += 1
+            self.frames.append((command, frame))
+            if len(self.frames) == 1:
+                self._notify()
+        return True
+
+    def _discard_pending(self, command):
+        kept = [entry for entry in self.frames if entry[0] != command]
+        if len(kept) != len(self.frames):
+            self.dropped += len(self.frames) - len(kept)
+            self.frames = deque(kept)
+
+    def take(self, block=True):
+        """
+        Removes and returns every pending frame. With block=True waits until
+        there is at least one; an empty list then means the queue was closed.
+        """
+        with self.cond:
+            while block and not self.frames and not self.closed:
+                self.cond.wait()
+            batch = [frame for _, frame in self.frames]
+            self.frames.clear()
+            return batch
+
+    def close(self, flush=False):
+        """Stops accepting frames; pending ones are kept only if flush is set."""
+        with self.cond:
+            self.closed = True
+            if not flush:
+                self.frames.clear()
+            self._notify()
+
+    def _notify(self):
+        self.cond.notify()
+        if self.on_ready:
+            self.on_ready()
+
+
+class SocketWriter(threading.Thread):
+    """Drains one client's OutboundQueue onto its blocking socket (threaded engine)."""
+
+    def __init__(self, server, client_socket, queue):
+        super().__init__(daemon=True)
+        self.server = server
+        self.client_socket = client_socket
+        self.queue = queue
+
+    def run(self):
+        try:
+            while True:
+                frames = self.queue.take()
+                if not frames:
+                    break
+                send_frames(self.client_socket, frames)
+                self.server.bytes_out.inc(sum(map(len, frames)))
+        except socket.error:
+            self.server.disconnect_client(self.client_socket)
+        finally:
+            # Wakes the reader thread blocked in recv() on this socket.
+            try:
+                self.client_socket.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.client_socket.close()
@@ -0,0 +1,69 @@
+import threading
+from collections import Counter
+
+
+class PresenceFeed:
+    """
+    Versioned online-user feed.
+
+    Logins and disconnects are collected for `window` seconds and then
+    published as one presence_delta, which increments the version by one:
+    {'version': n, 'joined': [...], 'left': [...]}. A user who comes and goes
+    within one window does not appear in it at all. Clients start from the
+    snapshot in initial_data and request a fresh one ('request_presence')
+    whenever they see a version they did not expect.
+
+    `publish(version, joined, left)` is called with the server's client_lock
+    held, so a snapshot taken under that lock is always consistent with the
+    deltas that follow it.
+    """
+
+    def __init__(self, lock, publish, window=0.05):
+        self.lock = lock
+        self.publish = publish
+        self.window = window
+        self.version = 0
+        self.sessions = Counter()  # {username: live sessions}
+        self.published = set()  # Online users as of self.version
+        self.dirty = set()  # Users whose sessions changed since then
+        self.timer = None
+        self._snapshot = (None, None)
+
+    def snapshot(self):
+        """Returns (version, users) as of the last published delta. Caller holds the lock."""
+        if self._snapshot[0] != self.version:
+            self._snapshot = (self.version, list(self.published))
+        return self._snapshot
+
+    def joined(self, username):
+        self.sessions[username] += 1
+        self.dirty.add(username)
+        self._schedule()
+
+    def left(self, username):
+        self.sessions[username] -= 1
+        if self.sessions[username] <= 0:
+            del self.sessions[username]
+        self.dirty.add(username)
+        self._schedule()
+
+    def _schedule(self):
+        if self.window <= 0:
+            self.flush()
+        elif self.timer is None:
+            self.timer = threading.Timer(self.window, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            self.timer = None
+            joined = [username for username in self.dirty if username in self.sessions and username not in self.published]
+            left = [username for username in self.dirty if username not in self.sessions and username in self.published]
+            self.dirty.clear()
+            if not joined and not left:
+                return
+            self.published.difference_update(left)
+            self.published.update(joined)
+            self.version += 1
+            self.publish(self.version, joined, left)
@@ -0,0 +1,75 @@
+import time
+
+ACTIONS = ('drop', 'defer')
+
+
+class RateLimiter:
+    """
+    Token buckets for one class of traffic, one bucket per key (a client
+    connection or a UDP sender address).
+
+    Each bucket refills at `rate` tokens per second up to `burst`, and every
+    command or packet spends one. When a bucket is empty the action decides:
+
+    - "drop": the command is discarded.
+    - "defer": the command still runs, the bucket goes into debt and the
+      caller pauses that client's reader until the debt is paid off, so the
+      client is slowed down by TCP backpressure instead of losing messages.
+      A client already `burst` tokens in debt is dropped as well.
+
+    A key is only ever checked from one thread at a time (its reader, or the
+    relay thread), so buckets need no lock.
+    """
+
+    def __init__(self, name, rate, burst=None, action='drop'):
+        if action not in ACTIONS:
+            raise ValueError(f"Unknown rate limit action '{action}'")
+        self.name = name
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else rate)
+        self.action = action
+        self.buckets = {}  # {key: [tokens, time of last refill]}
+        self.dropped = 0
+
+    def check(self, key):
+        """
+        Spends a token for `key`. Returns 0.0 if it was available, the number
+        of seconds the client should pause if the excess is deferred, or None
+        if it must be dropped.
+        """
+        now = time.monotonic()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [self.burst, now]
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens >= 1:
+            bucket[0] = tokens - 1
+            return 0.0
+        if self.action == 'defer' and tokens > -self.burst:
+            bucket[0] = tokens - 1
+            return (1 - bucket[0]) / self.rate
+        bucket[0] = tokens
+        self.dropped += 1
+        return None
+
+    def admit(self, key):
+        """Drop-only check for the UDP relay: True if the packet may be forwarded."""
+        return self.check(key) is not None
+
+    def forget(self, key):
+        self.buckets.pop(key, None)
+
+
+def command_limiters(config):
+    """
+    Builds {command: RateLimiter} from the "commands" section of
+    "rate_limits": {class name: {"commands": [...], "rate", "burst", "action"}}.
+    Commands of one class share a bucket.
+    """
+    limiters = {}
+    for name, spec in config.items():
+        limiter = RateLimiter(name, spec["rate"], spec.get("burst"), spec.get("action", "drop"))
+        for command in spec.get("commands", ()):
+            limiters[command] = limiter
+    return limiters
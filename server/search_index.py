@@ -0,0 +1,438 @@
+"""
+Full-text search over group history ("search" in server_config.json).
+
+Every group has its own shard of an inverted index: term -> ids of the
+messages containing it, with the number of occurrences. A shard is a few
+immutable segment files plus an in-memory buffer for the newest messages:
+
+    seg-<first id>-<end id>.idx:
+        MAGIC | postings ... | term dictionary (msgpack) | dictionary offset (!Q)
+
+A posting list is stored as the gaps between consecutive message ids, in the
+narrowest unsigned width that fits them (1, 2 or 4 bytes), followed by one
+byte of term frequency per message unless they are all 1. Segments are
+memory-mapped and decoded with numpy, so a search costs a few vectorised
+passes over the posting lists of its terms, not a scan of the history.
+
+The index follows the HistoryStore: a background thread reads messages
+appended since the last indexed id and adds them to the buffer, which is
+written out as a segment once it holds `flush_messages` messages. Segments
+of similar size are merged, so a shard has O(log messages) of them. The
+buffer is never persisted on its own; after a restart a shard re-reads the
+messages its segments do not cover from the history.
+"""
+import hashlib
+import math
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from collections import OrderedDict
+import msgpack
+import numpy as np
+from history_store import SAFE_CHAT_ID
+
+MAGIC = b'JMSIDX01'
+TRAILER = struct.Struct('!Q')
+TOKEN = re.compile(r'\w+')
+MAX_TERM_LENGTH = 40
+WIDTHS = (np.uint8, np.uint16, np.uint32)
+BM25_K1 = 1.2
+# BM25 term frequency saturation, tf * (k1 + 1) / (tf + k1), for every stored tf (0..255)
+TF_WEIGHT = (np.arange(256) * (BM25_K1 + 1) / (np.arange(256) + BM25_K1)).astype(np.float32)
+
+
+def tokenize(text):
+    """Returns the lowercased words of a text."""
+    return [term for term in TOKEN.findall(text.casefold()) if len(term) <= MAX_TERM_LENGTH]
+
+
+def message_text(message):
+    """The searchable text of a message: its 'text' field, or the message itself if it is a string."""
+    if isinstance(message, dict):
+        message = message.get('text')
+    return message if isinstance(message, str) else ''
+
+
+class Segment:
+    """
+    One immutable, memory-mapped segment covering message ids [base, end).
+    It is closed when it is merged away, before its file is deleted (a
+    mapped file cannot be deleted on Windows), or when its shard is evicted.
+    """
+
+    def __init__(self, path, base, end):
+        self.path = path
+        self.base = base
+        self.end = end
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            self.map.close()
+            raise ValueError(f"{path} is not a search segment")
+        dictionary_offset, = TRAILER.unpack_from(self.map, len(self.map) - TRAILER.size)
+        # {term: [offset, count, first id, width index, has term frequencies]}
+        self.terms = msgpack.unpackb(self.map[dictionary_offset:len(self.map) - TRAILER.size], raw=False)
+
+    def postings(self, term):
+        """Returns (ids, term frequencies) as numpy arrays, or None."""
+        entry = self.terms.get(term)
+        if entry is None:
+            return None
+        offset, count, first, width, has_tf = entry
+        dtype = WIDTHS[width]
+        ids = np.empty(count, dtype=np.int32)
+        ids[0] = first
+        gaps = np.frombuffer(self.map, dtype=dtype, count=count - 1, offset=offset)
+        np.cumsum(gaps, out=ids[1:])
+        ids[1:] += first
+        if has_tf:
+            tfs = np.frombuffer(self.map, dtype=np.uint8, count=count,
+                                offset=offset + (count - 1) * np.dtype(dtype).itemsize).copy()
+        else:
+            tfs = np.ones(count, dtype=np.uint8)
+        return ids, tfs
+
+    def close(self):
+        self.map.close()
+
+
+def write_segment(path, postings):
+    """Writes {term: (ids, tfs)} (ids ascending) as a segment file, atomically."""
+    temp_path = path + '.tmp'
+    terms = {}
+    with open(temp_path, 'wb') as f:
+        f.write(MAGIC)
+        for term in sorted(postings):
+            ids, tfs = postings[term]
+            ids = np.asarray(ids, dtype=np.int64)
+            tfs = np.minimum(np.asarray(tfs), 255).astype(np.uint8)
+            gaps = np.diff(ids)
+            largest = int(gaps.max()) if len(gaps) else 0
+            width = 0 if largest < 1 << 8 else 1 if largest < 1 << 16 else 2
+            has_tf = bool(len(tfs) and tfs.max() > 1)
+            terms[term] = [f.tell(), len(ids), int(ids[0]), width, has_tf]
+            f.write(gaps.astype(WIDTHS[width]).tobytes())
+            if has_tf:
+                f.write(tfs.tobytes())
+        dictionary_offset = f.tell()
+        f.write(msgpack.packb(terms, use_bin_type=True))
+        f.write(TRAILER.pack(dictionary_offset))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+class Shard:
+    """
+    The index of one group. `lock` guards the segment list and the buffer;
+    `segments` is None once the shard was evicted. Merges, which run without
+    `lock`, take `merge_lock`. Segments are only read under one of the two,
+    so a shard is evicted (and its segments closed) holding both.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.merge_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.segments = self._load_segments()
+        self.indexed = self.segments[-1].end if self.segments else 0  # Next message id to index
+        self.buffer = {}  # {term: ([ids], [tfs])} for ids in [buffer_base, indexed)
+        self.buffer_base = self.indexed
+
+    def _load_segments(self):
+        ranges = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.tmp'):
+                os.unlink(os.path.join(self.directory, name))  # An interrupted flush or merge
+            elif name.startswith('seg-') and name.endswith('.idx'):
+                base, end = name[4:-4].split('-')
+                ranges.append((int(base), int(end)))
+        segments = []
+        end_so_far = 0
+        # Keep one chain of segments starting at id 0. A crash between writing
+        # a merged segment and deleting its inputs leaves segments that a
+        # longer one covers; those (and anything not continuing the chain)
+        # are deleted, and their messages indexed again from the history.
+        for base, end in sorted(ranges, key=lambda r: (r[0], -r[1])):
+            if base != end_so_far:
+                os.unlink(self.segment_path(base, end))
+                continue
+            segments.append(Segment(self.segment_path(base, end), base, end))
+            end_so_far = end
+        return segments
+
+    def segment_path(self, base, end):
+        return os.path.join(self.directory, f"seg-{base:012d}-{end:012d}.idx")
+
+    @property
+    def buffered(self):
+        return self.indexed - self.buffer_base
+
+    def add(self, first_id, messages):
+        """Indexes consecutive messages starting at `first_id`. Caller holds lock."""
+        buffer = self.buffer
+        for message_id, message in enumerate(messages, first_id):
+            counts = {}
+            for term in tokenize(message_text(message)):
+                counts[term] = counts.get(term, 0) + 1
+            for term, count in counts.items():
+                entry = buffer.get(term)
+                if entry is None:
+                    entry = buffer[term] = ([], [])
+                entry[0].append(message_id)
+                entry[1].append(count)
+        self.indexed = first_id + len(messages)
+
+    def flush(self):
+        """Writes the buffer out as a segment. Caller holds lock."""
+        if self.buffered == 0:
+            return
+        path = self.segment_path(self.buffer_base, self.indexed)
+        write_segment(path, self.buffer)
+        self.segments.append(Segment(path, self.buffer_base, self.indexed))
+        self.buffer = {}
+        self.buffer_base = self.indexed
+
+    def merge_candidates(self):
+        """
+        The newest segments to merge, or None: an older segment joins while it
+        is no bigger than everything newer, like carries in a binary counter,
+        so sizes grow geometrically and each message is rewritten O(log n) times.
+        """
+        segments = self.segments
+        if not segments:
+            return None
+        count, newer = 1, segments[-1].end - segments[-1].base
+        while count < len(segments):
+            older = segments[-count - 1]
+            if older.end - older.base > newer:
+                break
+            newer += older.end - older.base
+            count += 1
+        return segments[-count:] if count > 1 else None
+
+    def postings(self, term):
+        """Returns (ids, tfs) for a term across segments and the buffer. Caller holds lock."""
+        parts = [p for p in (segment.postings(term) for segment in self.segments) if p is not None]
+        entry = self.buffer.get(term)
+        if entry:
+            parts.append((np.array(entry[0], dtype=np.int32), np.array(entry[1], dtype=np.uint8)))
+        if not parts:
+            return None
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate([p[0] for p in parts]), np.concatenate([p[1] for p in parts])
+
+
+def merge_segments(path, segments):
+    """Writes the union of consecutive segments to `path`."""
+    terms = set()
+    for segment in segments:
+        terms.update(segment.terms)
+    postings = {}
+    for term in terms:
+        parts = [p for p in (segment.postings(term) for segment in segments) if p is not None]
+        postings[term] = (np.concatenate([p[0] for p in parts]), np.concatenate([p[1] for p in parts]))
+    write_segment(path, postings)
+
+
+class SearchIndex:
+    """
+    Per-group inverted indexes over a HistoryStore.
+
+    notify() is called after every history append and only marks the group;
+    the indexer thread catches its shard up. search() catches the shard up
+    first, so a message can be found as soon as it was sent. At most
+    `max_open_shards` shards stay loaded, give or take those in use when
+    another is loaded; an evicted shard drops its buffer and re-reads those
+    messages from the history when it is next used.
+    """
+
+    def __init__(self, directory, history, flush_messages=10000, max_open_shards=64, read_chunk=2000):
+        self.directory = directory
+        self.history = history
+        self.flush_messages = flush_messages
+        self.max_open_shards = max_open_shards
+        self.read_chunk = read_chunk
+        self.shards = OrderedDict()  # {group_id: Shard}, least recently used first
+        self.lock = threading.Lock()  # Guards the dict above and `pending`
+        self.pending = set()  # Groups with messages the indexer has not seen yet
+        self.wakeup = threading.Event()
+        os.makedirs(directory, exist_ok=True)
+        threading.Thread(target=self.run, daemon=True, name='search-indexer').start()
+
+    def _shard_dir(self, group_id):
+        if SAFE_CHAT_ID.match(group_id):
+            return os.path.join(self.directory, group_id)
+        return os.path.join(self.directory, hashlib.sha1(group_id.encode('utf-8')).hexdigest())
+
+    def _shard(self, group_id):
+        with self.lock:
+            shard = self.shards.get(group_id)
+            if shard is None:
+                shard = self.shards[group_id] = Shard(self._shard_dir(group_id))
+                self._evict()
+            else:
+                self.shards.move_to_end(group_id)
+        return shard
+
+    def _evict(self):
+        """
+        Unloads the least recently used shards over the limit that are not in
+        use. A busy one (searched, caught up or merged) stays loaded, so no
+        merge of an evicted shard races the files of its reloaded successor.
+        Caller holds lock; waiting for a shard's lock here could deadlock.
+        """
+        for group_id, shard in list(self.shards.items())[:-1]:  # Not the one just loaded
+            if len(self.shards) <= self.max_open_shards:
+                return
+            if not shard.merge_lock.acquire(blocking=False):
+                continue
+            try:
+                if not shard.lock.acquire(blocking=False):
+                    continue
+                try:
+                    del self.shards[group_id]
+                    for segment in shard.segments:
+                        segment.close()
+                    shard.segments = None
+                finally:
+                    shard.lock.release()
+            finally:
+                shard.merge_lock.release()
+
+    def _locked_shard(self, group_id):
+        """Returns the loaded shard of a group with its lock held."""
+        while True:
+            shard = self._shard(group_id)
+            shard.lock.acquire()
+            if shard.segments is not None:
+                return shard
+            shard.lock.release()  # Evicted between lookup and locking
+
+    def notify(self, group_id):
+        with self.lock:
+            self.pending.add(group_id)
+        self.wakeup.set()
+
+    def _catch_up(self, group_id, shard):
+        """Indexes the messages appended since the shard was last updated. Caller holds shard.lock."""
+        end = self.history.next_id(group_id)
+        while shard.indexed < end:
+            start = shard.indexed
+            stop = min(end, start + self.read_chunk)
+            first_id, messages = self.history.read(group_id, stop, stop - start)
+            if first_id != start or not messages:
+                break  # Shorter history than the index (deleted files); nothing more to read.
+            shard.add(first_id, messages)
+            if shard.buffered >= self.flush_messages:
+                shard.flush()
+                self.notify(group_id)  # Let the indexer merge the new segment
+
+    def run(self):
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            with self.lock:
+                group_ids, self.pending = self.pending, set()
+            for group_id in group_ids:
+                try:
+                    self.update(group_id)
+                except Exception as e:
+                    print(f"Error indexing group {group_id}: {e}")
+            time.sleep(0.05)  # Index bursts of messages in larger steps.
+
+    def update(self, group_id):
+        """Catches a group's shard up with the history and merges its segments."""
+        shard = self._locked_shard(group_id)
+        try:
+            self._catch_up(group_id, shard)
+        finally:
+            shard.lock.release()
+        with shard.merge_lock:
+            with shard.lock:
+                candidates = shard.merge_candidates() if shard.segments is not None else None
+            while candidates:
+                # Segments are immutable, so the merge runs without the lock;
+                # searches keep using the old ones until they are swapped.
+                path = shard.segment_path(candidates[0].base, candidates[-1].end)
+                merge_segments(path, candidates)
+                merged = Segment(path, candidates[0].base, candidates[-1].end)
+                with shard.lock:  # Not evicted meanwhile: that takes merge_lock.
+                    position = next(i for i, segment in enumerate(shard.segments) if segment is candidates[0])
+                    shard.segments[position:position + len(candidates)] = [merged]
+                    # Searches read segments under the lock and merges take turns,
+                    # so nothing reads the merged-away ones any more.
+                    for segment in candidates:
+                        segment.close()
+                        os.unlink(segment.path)
+                    candidates = shard.merge_candidates()
+
+    def search(self, group_id, query, offset=0, limit=20):
+        """
+        Returns (total, [(message_id, score)]) for the messages containing
+        every word of the query, best match first: BM25 over term
+        frequencies (chat messages are short, so without length
+        normalisation), newer messages first among equal scores.
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return 0, []
+        shard = self._locked_shard(group_id)
+        try:
+            self._catch_up(group_id, shard)
+            documents = max(1, shard.indexed)
+            lists = []
+            for term in terms:
+                postings = shard.postings(term)
+                if postings is None:
+                    return 0, []
+                lists.append(postings)
+        finally:
+            shard.lock.release()
+        # Intersect starting from the rarest term, so every step shrinks the candidates.
+        lists.sort(key=lambda p: len(p[0]))
+        ids, tfs = lists[0]
+        scores = self._idf(len(ids), documents) * TF_WEIGHT.take(tfs)
+        for other_ids, other_tfs in lists[1:]:
+            if len(ids) * len(other_ids).bit_length() * 3 > documents + 2 * len(other_ids):
+                # Cheaper to index the other list by message id than to binary-search it.
+                by_id = np.full(documents, -1, dtype=np.int32)
+                np.put(by_id, other_ids, np.arange(len(other_ids), dtype=np.int32))
+                positions = by_id.take(ids)
+                found = np.flatnonzero(positions >= 0)
+            else:
+                positions = np.minimum(np.searchsorted(other_ids, ids), len(other_ids) - 1)
+                found = np.flatnonzero(other_ids.take(positions) == ids)
+            # take() with index arrays is several times faster than boolean masks here.
+            ids, positions = ids.take(found), positions.take(found)
+            scores = scores.take(found) + self._idf(len(other_ids), documents) * TF_WEIGHT.take(other_tfs.take(positions))
+            if not len(ids):
+                return 0, []
+        total = len(ids)
+        wanted = offset + limit
+        if offset >= total or limit <= 0:
+            return total, []
+        # Rank by score (to 1/1000), then recency. Only the first `wanted` are
+        # sorted: everything above the wanted-th best score, plus the newest
+        # of those tied with it (ids are ascending).
+        quantized = (scores * 1000).astype(np.int32)
+        if wanted < total:
+            # Scores take few distinct values, which makes a histogram cheaper than np.partition.
+            at_least = np.cumsum(np.bincount(quantized)[::-1])  # [i]: how many score >= max - i
+            threshold = len(at_least) - 1 - np.searchsorted(at_least, wanted)
+            above = np.flatnonzero(quantized > threshold)
+            tied = np.flatnonzero(quantized == threshold)
+            top = np.concatenate((above, tied[len(tied) - (wanted - len(above)):]))
+        else:
+            top = np.arange(total)
+        top = top[np.lexsort((-ids[top], -quantized[top]))][offset:wanted]
+        return total, [(int(ids[i]), round(float(scores[i]), 3)) for i in top]
+
+    @staticmethod
+    def _idf(document_frequency, documents):
+        return math.log(1 + (documents - document_frequency + 0.5) / (document_frequency + 0.5))
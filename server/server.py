@@ -1,44 +1,241 @@
 import socket
 import threading
 import msgpack
-import zstandard as zstd
 import os
 import sys
 import json
 import uuid
+import time
+import secrets
+import selectors
 from datetime import datetime
 import argparse
+from contextlib import ExitStack, contextmanager
 
-# Add project root to sys.path for plugin_manager import
+# Add project root to sys.path for plugin_manager and common imports
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 try:
     from plugin_manager import PluginManager
+    from common.framing import FrameDecoder, FrameReader, FrameError, encode_frame, encode_batch
+    from common.dictionary import load_dictionary, make_compressor, TrafficCapture
+    from outbound import OutboundQueue, SocketWriter
+    from history_store import HistoryStore
+    from presence import PresenceFeed
+    from metrics import MetricsRegistry, MetricsEndpoint, TimedLock
+    from rate_limit import RateLimiter, command_limiters
+    from heartbeat import Heartbeat
 except ImportError as e:
     print(f"Fatal Error: Could not import PluginManager. {e}")
     sys.exit(1)
 
 class Server:
-    def __init__(self, host, port, password=None):
+    def __init__(self, host, port, password=None, takeover=False, worker=None):
         self.host = host
         self.port = port
         self.password = password
+        self.takeover = takeover # Take the sockets and state over from a running server (hot restart)
+        self.worker = worker # (index, workers, pipe) in a group worker process; see group_workers.py
         self.clients = {}  # {client_socket: {'username': str, 'address': tuple, 'udp_addr': (ip, port)}}
-        self.groups = {}   # {group_id: {'name': str, 'members': {client_socket}, 'admin': str}}
+        self.groups = {}   # {group_id: {'name': str, 'members': frozenset({client_socket}), 'admin': str}}
+        # Serializes history appends and fan-out per group, so ids match delivery order.
+        # Lock order: group locks may be held while taking client_lock, never the reverse;
+        # a batch holding several takes them in group_id order. Re-entrant for batches.
+        self.group_locks = {} # {group_id: threading.RLock}
+        # Bumped on every group or membership change; keys the cached initial_data frame.
+        self.groups_version = 0
+        self._groups_info = {} # {group_id: initial_data entry}, refreshed for dirty groups only
+        self._dirty_groups = set()
+        self._initial_data = (None, None) # ((groups_version, presence version), encoded frame)
+        self._welcome_frame = None
         self.active_calls = {} # {group_id: {client_socket}}
-        self.chat_history = {'global': []} # {chat_id: [messages]}
-        self.client_lock = threading.Lock()
+        # Lookup indexes, maintained on login/join/kick/disconnect so handlers never scan
+        self.sessions = {} # {username: client_socket}
+        self.session_groups = {} # {client_socket: {group_id}}
+        # Relay indexes, maintained on login/join/leave/disconnect so the UDP path never scans
+        self.udp_sessions = {} # {udp_addr: client_socket}
+        self.session_calls = {} # {client_socket: group_id}
+        self.relay_routes = {} # {udp_addr: (destination udp_addr, ...)}
+        self.call_addrs = {} # {group_id: (member udp_addr, ...)}
+        self.outbound = {} # {client_socket: OutboundQueue}
+        self.metrics = MetricsRegistry()
+        self.lock_wait_seconds = self.metrics.histogram('server_lock_wait_seconds', 'Time spent waiting for contended server locks.', ('lock',))
+        # Re-entrant: disconnect_client broadcasts hang-ups and user lists while holding it.
+        self.client_lock = TimedLock(threading.RLock(), self.lock_wait_seconds, ('client',))
         self.tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.config = self.load_config()
-        self.zstd_c = zstd.ZstdCompressor()
-        self.zstd_d = zstd.ZstdDecompressor()
+        # zstd contexts are not thread-safe, so each sending thread gets its own.
+        self._codec = threading.local()
+        # While a thread applies a batch, the messages it sends are collected here
+        # and go out together when the batch is done.
+        self._batch = threading.local()
+        self.max_batch_commands = self.config.get("max_batch_commands", 64)
+        # Per-connection token buckets by command class, and per-sender buckets for relayed audio.
+        limits_config = self.config.get("rate_limits", {})
+        self.command_limits = command_limiters(limits_config.get("commands", {}))
+        udp_limit = limits_config.get("udp_packets")
+        self.udp_limits = RateLimiter('udp', udp_limit["rate"], udp_limit.get("burst")) if udp_limit else None
+        self.read_backoff = {} # {client_socket: seconds its reader pauses after the current frame}
+        # Sessions from before a hot restart, waiting for their clients to log in again with their token.
+        self.hot_restart_config = self.config.get("hot_restart", {})
+        self.resumable = {} # {session_token: {'username', 'udp_addr', 'groups', 'call'}}
+        self.resume_deadline = 0
+        # Group membership outlives the connection: {username: {group_id: id of the first message it missed}}
+        # for users who went offline, so the next login rejoins the groups and catches up from the history.
+        self.offline_cursors = {}
+        offline_config = self.config.get("offline_delivery", {})
+        self.catch_up_limit = offline_config.get("max_messages", 500)
+        self.catch_up_batch = offline_config.get("batch_messages", 50)
+        # Optional trained dictionary for small control messages, shipped to clients at login.
+        self.zstd_dictionary = load_dictionary(self.config.get("zstd_dictionary"))
+        self.traffic_capture = None
+        capture_config = self.config.get("traffic_capture", {})
+        if capture_config.get("path"):
+            self.traffic_capture = TrafficCapture(capture_config["path"], capture_config.get("max_samples", 100000))
+        # Logins and disconnects reach clients as coalesced, versioned presence deltas.
+        self.presence = PresenceFeed(self.client_lock, self._publish_presence,
+                                     window=self.config.get("presence_window_ms", 50) / 1000)
+        # Chat history lives on disk; only a bounded tail of recent chats is kept in memory.
+        history_config = self.config.get("history", {})
+        self.history = HistoryStore(history_config.get("directory", "history"),
+                                    segment_bytes=history_config.get("segment_bytes", 8 * 1024 * 1024),
+                                    cache_messages=history_config.get("cache_messages", 200))
+        self.history_page_limit = history_config.get("max_page", 200)
+        # Full-text search: per-group inverted indexes that follow the history.
+        self.search = None
+        search_config = self.config.get("search", {})
+        if search_config.get("enabled", False):
+            from search_index import SearchIndex
+            self.search = SearchIndex(search_config.get("directory", "search_index"), self.history,
+                                      flush_messages=search_config.get("flush_messages", 10000),
+                                      max_open_shards=search_config.get("max_open_shards", 64))
+        self.search_page_limit = search_config.get("max_page", 50)
+        # Engines that own the UDP socket (e.g. asyncio transports) replace this.
+        self.udp_sendto = self.udp_sock.sendto
+        # The accept loop parks while accepting is clear (a hot restart handing the
+        # listening socket over); engines with their own accept loop replace wake_acceptor.
+        self.accepting = threading.Event()
+        self.accepting.set()
+        self.acceptor_stopped = threading.Event()
+        self._accept_wake = socket.socketpair()
+        self.wake_acceptor = self._wake_accept_loop
+
+        # "relay" forwards every packet; "mcu" mixes one stream per member on the server.
+        self.mixer = None
+        if self.config.get("mode", "relay") == "mcu":
+            from mixer import CallMixer
+            self.mixer = CallMixer(self.udp_sock.sendto)
+
+        # In relay mode, large calls can forward only their loudest speakers.
+        self.speakers = None
+        speaker_config = self.config.get("speaker_selection", {})
+        if speaker_config.get("enabled", False):
+            if self.mixer:
+                print("Ignoring 'speaker_selection' in MCU mode: the mixer already sends one stream per member.")
+            else:
+                from speakers import SpeakerSelector
+                self.speakers = SpeakerSelector(max_speakers=speaker_config.get("max_speakers", 3),
+                                                hysteresis_db=speaker_config.get("hysteresis_db", 6),
+                                                hold=speaker_config.get("hold_ms", 500) / 1000,
+                                                update_interval=speaker_config.get("update_ms", 100) / 1000)
+
+        # With "udp_workers" > 1 the relay runs in SO_REUSEPORT worker processes.
+        self.relay_pool = None
+        udp_workers = self.config.get("udp_workers", 1)
+        if udp_workers > 1 and not worker:
+            from udp_relay import RelayWorkerPool
+            if self.mixer:
+                print("Ignoring 'udp_workers' in MCU mode: mixing needs every frame in one process.")
+            elif self.speakers:
+                print("Ignoring 'udp_workers' with speaker selection: it needs every sender of a call in one process.")
+            elif not RelayWorkerPool.supported():
+                print("SO_REUSEPORT is not available on this platform. Relaying in-process.")
+            else:
+                self.relay_pool = RelayWorkerPool(self.host, self.port, udp_workers, self.config.get("udp_engine", "recvfrom"),
+                                                  udp_limit=udp_limit)
         
+        # Pings silent connections and evicts dead ones; the engine calls its tick().
+        self.heartbeat = None
+        heartbeat_config = self.config.get("heartbeat", {})
+        if heartbeat_config.get("enabled", True):
+            self.heartbeat = Heartbeat(self._send_pings, self._evict_connection,
+                                       interval=heartbeat_config.get("interval", 15),
+                                       timeout=heartbeat_config.get("timeout", 45),
+                                       tick=heartbeat_config.get("tick", 1))
+        self._ping_frame = None
+
+        # Several nodes sharing users and groups over a message bus; see cluster.py.
+        # Group workers are such nodes too, owning a share of the groups each.
+        self.cluster = None
+        self.group_workers = None
+        cluster_config = self.config.get("cluster", {})
+        workers = self.config.get("workers", 1)
+        if worker:
+            from group_workers import WorkerNode
+            self.cluster = WorkerNode(self, *worker)
+        elif cluster_config.get("enabled", False):
+            from cluster import ClusterNode, WILDCARD_HOSTS
+            if host in WILDCARD_HOSTS and not cluster_config.get("advertise_host"):
+                print(f"Fatal Error: a cluster node listening on '{host}' needs 'cluster': {{'advertise_host': ...}}, "
+                      "the address other nodes' clients reach its UDP relay at.")
+                sys.exit(1)
+            self.cluster = ClusterNode(self, cluster_config)
+            if workers > 1:
+                print("Ignoring 'workers' in a cluster: every node serves its own groups.")
+        elif workers > 1:
+            from group_workers import GroupWorkerPool
+            self.group_workers = GroupWorkerPool(type(self), host, password, workers)
+            self.cluster = self.group_workers.node(self)
+
+        self._register_metrics()
+
         self.plugin_manager = None
         if self.config.get("plugins", {}).get("enabled", False):
             plugin_dir = self.config.get("plugins", {}).get("directory", "VoiceChat/plugins")
             self.plugin_manager = PluginManager(plugin_folder=plugin_dir)
             self.plugin_manager.discover_plugins()
 
+    def _register_metrics(self):
+        """Declares the server's metrics; state that already exists is read at scrape time."""
+        m = self.metrics
+        self.command_seconds = m.histogram('server_command_seconds', 'Time spent in command handlers.', ('command',))
+        self.encode_seconds = m.histogram('server_encode_seconds', 'Time spent packing and compressing outgoing messages.', ('command',))
+        self.messages_out = m.counter('server_messages_sent_total', 'Frames queued to clients (one per recipient); multi-message frames count as "batch".', ('command',))
+        self.batch_commands = m.histogram('server_batch_commands', 'Commands per multi-command frame applied as one batch.',
+                                          buckets=(2, 4, 8, 16, 32, 64, 128))
+        self.rate_limited = m.counter('server_rate_limited_commands_total', 'Commands over their class rate limit.', ('class', 'action'))
+        self.caught_up = m.counter('server_caught_up_messages_total', 'Messages missed while offline and replayed at the next login.')
+        self.frames_dropped = m.counter('server_outbound_dropped_frames_total', 'Frames discarded by outbound queue overflow policies.')
+        self.bytes_in = m.counter('server_tcp_received_bytes_total', 'Bytes received from TCP clients.')
+        self.bytes_out = m.counter('server_tcp_sent_bytes_total', 'Bytes written to TCP clients.')
+        # The UDP relay runs on a single thread, so it keeps plain integers.
+        self.relay_stats = {'packets_in': 0, 'bytes_in': 0, 'packets_out': 0}
+        self.batched_relay = None
+        m.counter_func('server_relay_received_packets_total', 'Audio datagrams received by the in-process relay.',
+                       lambda: self.relay_stats['packets_in'] + (self.batched_relay.packets if self.batched_relay else 0))
+        m.counter_func('server_relay_received_bytes_total', 'Audio bytes received by the in-process relay (recvfrom engine).',
+                       lambda: self.relay_stats['bytes_in'])
+        m.counter_func('server_relay_sent_packets_total', 'Audio datagrams forwarded by the in-process relay (recvfrom engine).',
+                       lambda: self.relay_stats['packets_out'])
+        m.counter_func('server_relay_rate_limited_packets_total', 'Audio datagrams dropped by the per-sender rate limit (in-process relay).',
+                       lambda: self.udp_limits.dropped if self.udp_limits else 0)
+        m.counter_func('server_relay_unselected_packets_total', 'Audio datagrams not forwarded because their sender was not an active speaker.',
+                       lambda: self.speakers.dropped if self.speakers else 0)
+        m.counter_func('server_heartbeat_pings_total', 'Pings sent to silent connections.',
+                       lambda: self.heartbeat.pings if self.heartbeat else 0)
+        m.counter_func('server_heartbeat_evicted_total', 'Connections evicted after the heartbeat timeout.',
+                       lambda: self.heartbeat.evicted if self.heartbeat else 0)
+        # Sessions on other cluster nodes have a stand-in here, but no connection.
+        remote = lambda: len(self.cluster.proxies) if self.cluster else 0
+        m.gauge_func('server_connections', 'Open TCP connections.', lambda: len(self.outbound) - remote())
+        m.gauge_func('server_logged_in_clients', 'Logged-in clients.', lambda: len(self.clients) - remote())
+        m.gauge_func('server_groups', 'Groups.', lambda: len(self.groups))
+        m.gauge_func('server_active_calls', 'Group calls in progress.', lambda: len(self.call_addrs))
+        m.gauge_func('server_outbound_queue_frames', 'Frames waiting in outbound queues.',
+                     lambda: sum(len(q) for q in list(self.outbound.values())))
+        m.gauge_func('server_outbound_queue_max_frames', 'Longest outbound queue.',
+                     lambda: max((len(q) for q in list(self.outbound.values())), default=0))
+
     @staticmethod
     def load_config():
         try:
@@ -49,50 +246,343 @@ class Server:
             return {"host": "0.0.0.0", "port": 12345, "max_clients": 100, "welcome_message": "Welcome!"}
 
     def start(self):
-        self.tcp_sock.bind((self.host, self.port))
-        self.udp_sock.bind((self.host, self.port))
-        self.tcp_sock.listen(self.config.get("max_clients", 100))
+        handoff = None
+        if self.takeover:
+            handoff = self._take_over()
+        else:
+            self.tcp_sock.bind((self.host, self.port))
+            if not self.relay_pool:
+                self.udp_sock.bind((self.host, self.port))
+            self.tcp_sock.listen(self.config.get("max_clients", 100))
         print(f"TCP Server started on {self.host}:{self.port}.")
         if self.password:
             print("Server is password protected.")
-        print(f"UDP Server listening on {self.host}:{self.port}.")
+        if self.relay_pool:
+            self.relay_pool.start(self.relay_routes)
+            print(f"UDP relay sharded across {self.relay_pool.workers} processes on {self.host}:{self.port}.")
+        else:
+            print(f"UDP Server listening on {self.host}:{self.port}.")
 
         if self.plugin_manager:
             print(f"Loaded plugins: {list(self.plugin_manager.plugins.keys())}")
 
-        udp_thread = threading.Thread(target=self.handle_udp_audio, daemon=True)
-        udp_thread.start()
+        if self.mixer:
+            from mixer import MixerThread
+            MixerThread(self, self.mixer).start()
+            print("Group calls are mixed on the server (MCU mode).")
+
+        control_socket = self.hot_restart_config.get("control_socket")
+        if control_socket and self.group_workers:
+            print("Hot restart is not available with group workers: the groups live in the worker processes.")
+        elif control_socket:
+            from hot_restart import HandoffListener, supported
+            if supported():
+                HandoffListener(self, control_socket, self.hot_restart_config.get("snapshot", "server_state.snapshot")).start()
+                print(f"Hot restart: start a new server with --takeover to replace this one ({control_socket}).")
+            else:
+                print("Hot restart is not available on this platform (needs Unix sockets with SCM_RIGHTS).")
+        if handoff:
+            handoff.sendall(b'ready')  # The old process exits now and frees its metrics port.
+            handoff.close()
+
+        if self.group_workers:
+            self.group_workers.start()
+            print(f"Groups sharded across {len(self.group_workers.processes)} worker processes.")
+        elif self.cluster:
+            print(f"Cluster node '{self.cluster.node_id}'.")
+        if self.cluster:
+            self.cluster.start()
+
+        metrics_config = self.config.get("metrics", {})
+        if metrics_config.get("enabled", False):
+            threading.Thread(target=self._start_metrics, args=(metrics_config, 10 if handoff else 0), daemon=True).start()
+
+        engine = self.config.get("engine", "threaded")
+        if engine == "asyncio":
+            from async_engine import AsyncioEngine
+            AsyncioEngine(self).run()
+            return
+        if engine != "threaded":
+            print(f"Unknown engine '{engine}', falling back to 'threaded'.")
+
+        if not self.relay_pool:
+            udp_thread = threading.Thread(target=self.handle_udp_audio, daemon=True)
+            udp_thread.start()
+        if self.heartbeat:
+            threading.Thread(target=self.heartbeat.run, daemon=True, name='heartbeat').start()
 
+        selector = selectors.DefaultSelector()
+        selector.register(self.tcp_sock, selectors.EVENT_READ)
+        selector.register(self._accept_wake[0], selectors.EVENT_READ)
         while True:
+            if not self.accepting.is_set():
+                self.acceptor_stopped.set()
+                self.accepting.wait()
+                continue
+            ready = [key.fileobj for key, _ in selector.select()]
+            if self._accept_wake[0] in ready:
+                self._accept_wake[0].recv(64)
+                continue
             client_socket, address = self.tcp_sock.accept()
             print(f"New connection from {address}")
             client_thread = threading.Thread(target=self.handle_client, args=(client_socket, address))
             client_thread.daemon = True
             client_thread.start()
 
+    def _start_metrics(self, metrics_config, retry_for=0):
+        deadline = time.monotonic() + retry_for
+        while True:
+            try:
+                endpoint = MetricsEndpoint(self.metrics, metrics_config.get("host", "127.0.0.1"), metrics_config.get("port", 9100),
+                                           metrics_config.get("unix_socket"), metrics_config.get("profiler", False))
+                break
+            except OSError as e:
+                if time.monotonic() >= deadline:
+                    print(f"Could not start the metrics endpoint: {e}")
+                    return
+                time.sleep(0.1)  # The server we took over from still holds the port.
+        endpoint.start()
+        print(f"Metrics available at {endpoint.address}/metrics.")
+
+    # --- Hot restart ---
+
+    def _take_over(self):
+        """Adopts the listening sockets and state of the running server. Returns the control connection."""
+        from hot_restart import take_over
+        control_socket = self.hot_restart_config.get("control_socket")
+        if not control_socket:
+            print("Fatal Error: --takeover needs 'hot_restart': {'control_socket': ...} in server_config.json.")
+            sys.exit(1)
+        try:
+            connection, fds, state = take_over(control_socket)
+        except (OSError, ValueError) as e:
+            print(f"Fatal Error: could not take over from the running server: {e}")
+            sys.exit(1)
+        # Reusing the descriptors of the sockets created in __init__ keeps
+        # every reference to them (udp_sendto, the mixer) valid.
+        os.dup2(fds['tcp'], self.tcp_sock.fileno())
+        self.host, self.port = self.tcp_sock.getsockname()[:2]
+        if self.relay_pool:
+            pass  # The relay workers bind the port themselves.
+        elif 'udp' in fds:
+            os.dup2(fds['udp'], self.udp_sock.fileno())
+        else:
+            self.udp_sock.bind((self.host, self.port))
+        for fd in fds.values():
+            os.close(fd)
+        # O_NONBLOCK belongs to the shared open socket, and an asyncio server sets it.
+        self.tcp_sock.setblocking(True)
+        self.udp_sock.setblocking(True)
+        self.restore_state(state)
+        print(f"Took over {len(self.groups)} groups, {len(self.active_calls)} calls and {len(self.resumable)} sessions.")
+        return connection
+
+    def listening_sockets(self):
+        """The sockets a hot restart hands over: {'tcp': socket, 'udp': socket (unless relay workers own the port)}."""
+        sockets = {'tcp': self.tcp_sock}
+        if not self.relay_pool:
+            sockets['udp'] = self.udp_sock
+        return sockets
+
+    def stop_accepting(self, timeout):
+        """
+        Stops taking connections off the listening socket, so they wait in its
+        backlog for the process taking over. False if the accept loop did not
+        stop within timeout.
+        """
+        self.accepting.clear()
+        self.wake_acceptor()
+        return self.acceptor_stopped.wait(timeout)
+
+    def resume_accepting(self):
+        self.acceptor_stopped.clear()
+        self.accepting.set()
+        self.wake_acceptor()
+
+    def _wake_accept_loop(self):
+        self._accept_wake[1].send(b'\0')
+
+    @contextmanager
+    def frozen(self):
+        """Holds every group lock and client_lock, so no command (or history append) runs meanwhile."""
+        while True:
+            with ExitStack() as locks:
+                group_ids = sorted(self.group_locks)
+                for group_id in group_ids:
+                    locks.enter_context(self.group_locks[group_id])
+                locks.enter_context(self.client_lock)
+                if len(self.group_locks) == len(group_ids):
+                    yield
+                    return
+            # A group was created before we got client_lock; lock order forbids taking its lock now.
+
+    @contextmanager
+    def _session_locked(self, client_socket):
+        """
+        Holds the locks of the groups a session is in, then client_lock, so it
+        can leave them without racing a message about to be numbered in one.
+        """
+        while True:
+            with self.client_lock:
+                group_ids = sorted(self.session_groups.get(client_socket, ()))
+            with ExitStack() as locks:
+                for group_id in group_ids:
+                    locks.enter_context(self.group_locks[group_id])
+                locks.enter_context(self.client_lock)
+                if self.session_groups.get(client_socket, set()) <= set(group_ids):
+                    yield
+                    return
+            # Joined another group before we got client_lock; lock order forbids taking its lock now.
+
+    def snapshot_state(self):
+        """Groups, calls, resumable sessions (by token) and offline members for a hot restart. State is frozen."""
+        now = time.monotonic()
+        offline = {username: dict(cursors) for username, cursors in self.offline_cursors.items()}
+        sessions = dict(self.resumable) if now < self.resume_deadline else {}  # Not back yet from the last restart
+        for client_socket, client in self.clients.items():
+            if 'node' in client:
+                continue  # Lives on another cluster node
+            sessions[client['token']] = {
+                'username': client['username'],
+                'udp_addr': list(client['udp_addr']) if client['udp_addr'] else None,
+                'groups': list(self.session_groups.get(client_socket, ())),
+                'call': self.session_calls.get(client_socket),
+            }
+            # Users who do not resume still rejoin (and catch up) at their next login.
+            cursors = offline.setdefault(client['username'], {})
+            for group_id in self.session_groups.get(client_socket, ()):
+                cursors.setdefault(group_id, self.groups[group_id]['next_id'])
+        return {
+            'groups': {gid: {'name': g['name'], 'admin': g['admin'], 'next_id': g['next_id']} for gid, g in self.groups.items()},
+            'calls': list(self.active_calls),
+            'sessions': sessions,
+            'offline': offline,
+        }
+
+    def restore_state(self, state):
+        """Loads a hot-restart snapshot. Groups start empty; members return as their clients resume."""
+        with self.client_lock:
+            for group_id, group in state['groups'].items():
+                next_id = group['next_id'] if 'next_id' in group else self.history.next_id(group_id)
+                self.groups[group_id] = {'name': group['name'], 'members': frozenset(), 'admin': group['admin'],
+                                         'next_id': next_id}
+                self.group_locks[group_id] = TimedLock(threading.RLock(), self.lock_wait_seconds, ('group',))
+                self._dirty_groups.add(group_id)
+            for group_id in state['calls']:
+                self.active_calls[group_id] = set()
+            self.groups_version += 1
+            self.resumable = state['sessions']
+            self.offline_cursors = state.get('offline', {})
+            self.resume_deadline = time.monotonic() + self.hot_restart_config.get("resume_window", 60)
+
+    def exit_after_handoff(self):
+        """Ends the old process once the new one serves. Called with the state frozen."""
+        if self.relay_pool:
+            self.relay_pool.stop()
+        self.history.close()
+        sys.stdout.flush()
+        os._exit(0)
+
+    def _take_resumable(self, username, token):
+        """
+        The session a client that logged in with a token from before a hot
+        restart resumes, or None. Caller holds client_lock.
+        """
+        if not isinstance(token, str) or not self.resumable:
+            return None
+        if time.monotonic() > self.resume_deadline:
+            self.resumable.clear()
+            return None
+        entry = self.resumable.pop(token, None)
+        if not entry or entry['username'] != username:
+            return None
+        return entry
+
+    def _resume_session(self, client_socket, entry):
+        """
+        Puts a resuming client back into its groups and call. Caller holds
+        the locks of those groups, then client_lock.
+        """
+        for group_id in entry['groups']:
+            if group_id in self.groups:
+                self._add_member(client_socket, group_id)
+        if not self.clients[client_socket]['udp_addr'] and entry['udp_addr']:
+            self._set_udp_addr(client_socket, tuple(entry['udp_addr']))
+        call_group_id = entry['call']
+        if call_group_id in self.active_calls and call_group_id in self.session_groups.get(client_socket, ()):
+            self._join_call(client_socket, call_group_id)
+
+    def register_connection(self, client_socket, on_ready=None):
+        """Creates the bounded outbound queue every frame for this client goes through."""
+        queue_config = self.config.get("outbound_queue", {})
+        queue = OutboundQueue(max_frames=queue_config.get("max_frames", 1024),
+                              policy=queue_config.get("policy", "drop_oldest"),
+                              on_ready=on_ready)
+        self.outbound[client_socket] = queue
+        if self.heartbeat:
+            self.heartbeat.add(client_socket)
+        return queue
+
+    def get_queue_depths(self):
+        """Returns {address: (pending frames, dropped frames)} for every open connection."""
+        depths = {}
+        for client_socket, queue in list(self.outbound.items()):
+            client = self.clients.get(client_socket)
+            key = client['username'] if client else client_socket.getpeername()
+            depths[key] = (len(queue), queue.dropped)
+        return depths
+
     def handle_client(self, client_socket, address):
-        unpacker = msgpack.Unpacker(raw=False)
+        SocketWriter(self, client_socket, self.register_connection(client_socket)).start()
+        reader = FrameReader(client_socket, FrameDecoder(self.zstd_dictionary))
         try:
             while True:
-                data = client_socket.recv(4096)
-                if not data:
+                frames = reader.read_frames()
+                if frames is None:
                     break
-                
-                try:
-                    decompressed_data = self.zstd_d.decompress(data)
-                    unpacker.feed(decompressed_data)
-                    for unpacked in unpacker:
-                        self.process_command(client_socket, unpacked)
-                except zstd.ZstdError:
-                    print(f"Zstd decompression error from {address}. Might be a partial frame.")
-                    continue
+                self.bytes_in.inc(reader.received)
+                # Over a deferring rate limit: stop serving this client for a while.
+                backoff = self.dispatch_frames(client_socket, address, frames)
+                while backoff:
+                    time.sleep(backoff)
+                    backoff = self.dispatch_frames(client_socket, address, frames)
 
         except (ConnectionResetError, ConnectionAbortedError):
             print(f"Connection lost with {address}")
+        except FrameError as e:
+            print(f"Protocol error from {address}: {e}")
         finally:
             self.disconnect_client(client_socket)
 
-    def process_command(self, sender_socket, message):
+    def dispatch_frames(self, client_socket, address, frames):
+        """
+        Runs every command decoded from a client's stream, frame by frame.
+        If a rate limit defers the client, stops after the current frame and
+        returns how many seconds to wait; the engine then calls it again with
+        the same (lazy) iterator. Returns 0 once every frame is done.
+        """
+        if self.heartbeat:
+            self.heartbeat.seen(client_socket)
+        for messages in frames:
+            commands = []
+            for message in messages:
+                if self.traffic_capture:
+                    self.traffic_capture.record(msgpack.packb(message, use_bin_type=True))
+                if isinstance(message, dict):
+                    commands.append(message)
+                else:
+                    print(f"Malformed message from {address}: {message!r}")
+            if len(commands) == 1:
+                self.process_command(client_socket, commands[0])
+            else:
+                for start in range(0, len(commands), self.max_batch_commands):
+                    self.process_batch(client_socket, commands[start:start + self.max_batch_commands])
+            backoff = self.read_backoff.pop(client_socket, None)
+            if backoff:
+                return backoff
+        return 0
+
+    def process_command(self, sender_socket, message, limit=True):
         command = message.get('command')
         payload = message.get('payload')
         
@@ -103,57 +593,271 @@ class Server:
             'group_invite_response': self.handle_group_invite_response,
             'group_message': self.handle_group_message,
             'request_history': self.handle_request_history,
+            'search_history': self.handle_search_history,
+            'request_presence': self.handle_request_presence,
             'start_group_call': self.handle_start_group_call,
             'join_group_call': self.handle_join_group_call,
             'leave_group_call': self.handle_leave_group_call,
             'kick_from_group': self.handle_kick_from_group,
+            'pong': self.handle_pong,
         }
         
         handler = handlers.get(command)
-        if handler:
+        if handler and limit and not self._admit(sender_socket, command):
+            return
+        node = self.cluster.route(command, payload) if self.cluster and handler else None
+        if node:
+            self.cluster.forward(node, sender_socket, [message])
+        elif handler:
+            start = time.perf_counter()
             handler(sender_socket, payload)
+            self.command_seconds.observe(time.perf_counter() - start, (command,))
         else:
             print(f"Unknown command received: {command}")
 
-    def disconnect_client(self, client_socket):
-        with self.client_lock:
+    def _admit(self, sender_socket, command):
+        """Charges a command to its rate limit. False if it is dropped; a deferral pauses the reader."""
+        limiter = self.command_limits.get(command)
+        if not limiter:
+            return True
+        backoff = limiter.check(sender_socket)
+        if backoff is None:
+            self.rate_limited.inc(1, (limiter.name, 'dropped'))
+            return False
+        if backoff:
+            self.rate_limited.inc(1, (limiter.name, 'deferred'))
+            self.read_backoff[sender_socket] = max(backoff, self.read_backoff.get(sender_socket, 0))
+        return True
+
+    def process_batch(self, sender_socket, messages, limit=True):
+        """
+        Applies the commands a client sent in one frame as one transaction:
+        the locks they need (the locks of the groups they message, then
+        client_lock unless they are all chat messages) are taken once for the
+        whole batch, and everything the batch sends is collected and queued
+        before they are released, one frame per recipient. A burst of chat
+        messages thus costs one lock round-trip and one compression per
+        distinct set of recipients instead of one per message.
+
+        Logins are not batched: the login frame must reach the client before
+        anything compressed with the dictionary it announces. A batch about
+        groups that live on one other cluster node (or group worker) is
+        forwarded there whole; one that mixes nodes is not batched either.
+        """
+        nodes = {self.cluster.route(m.get('command'), m.get('payload')) for m in messages} if self.cluster else {None}
+        if len(nodes) == 1 and None not in nodes:
+            messages = [m for m in messages if self._admit(sender_socket, m.get('command'))]
+            if messages:
+                self.cluster.forward(nodes.pop(), sender_socket, messages)
+            return
+        if len(nodes) > 1 or any(message.get('command') == 'login' for message in messages):
+            for message in messages:
+                self.process_command(sender_socket, message, limit)
+            return
+        self.batch_commands.observe(len(messages))
+        group_ids = set()
+        for message in messages:
+            payload = message.get('payload')
+            if message.get('command') == 'group_message' and isinstance(payload, dict) \
+                    and isinstance(payload.get('group_id'), str):
+                group_ids.add(payload['group_id'])
+        with ExitStack() as locks:
+            for group_id in sorted(group_ids):
+                lock = self.group_locks.get(group_id)
+                if lock:
+                    locks.enter_context(lock)
+            if any(message.get('command') != 'group_message' for message in messages):
+                locks.enter_context(self.client_lock)
+            outbox = self._batch.outbox = []
+            try:
+                for message in messages:
+                    self.process_command(sender_socket, message, limit)
+            finally:
+                self._batch.outbox = None
+                # Still under the locks, so nothing sent after the batch can overtake it.
+                self._flush_outbox(outbox)
+
+    def _flush_outbox(self, outbox):
+        """
+        Queues what a batch sent. Consecutive messages to the same recipient
+        share one frame, and recipients that get the same run of messages
+        share one encoded buffer. Pre-encoded frames are queued as they are.
+        """
+        plans = {}  # {client_socket: [[outbox index, ...] or (command, frame)]}
+        for index, (recipients, command, payload, frame) in enumerate(outbox):
+            for client_socket in recipients:
+                plan = plans.setdefault(client_socket, [])
+                if frame is not None:
+                    plan.append((command, frame))
+                elif plan and isinstance(plan[-1], list):
+                    plan[-1].append(index)
+                else:
+                    plan.append([index])
+        encoded = {}
+        for client_socket, plan in plans.items():
+            for item in plan:
+                if isinstance(item, tuple):
+                    self._enqueue(client_socket, *item)
+                    continue
+                run = tuple(item)
+                if run not in encoded:
+                    if len(run) == 1:
+                        _, command, payload, _ = outbox[run[0]]
+                        encoded[run] = (command, self._encode(command, payload))
+                    else:
+                        encoded[run] = ('batch', self._encode_batch([outbox[i][1:3] for i in run]))
+                self._enqueue(client_socket, *encoded[run])
+
+    def disconnect_client(self, client_socket, flush=False):
+        """
+        Drops a client. With flush=True frames already queued for it (e.g. a
+        login_failed notice) are still written before its writer closes the socket.
+        Takes group locks, so the caller must not hold client_lock.
+        """
+        with self._session_locked(client_socket):
             if client_socket in self.clients:
-                username = self.clients[client_socket]['username']
+                client = self.clients[client_socket]
+                username = client['username']
                 print(f"User '{username}' disconnected.")
-                del self.clients[client_socket]
+                call_group_id = self._leave_call(client_socket)
+                self._set_udp_addr(client_socket, None)
+                self._drop_session(client_socket)
                 
-                # Remove from all groups
-                groups_to_leave = []
-                for group_id, group_data in self.groups.items():
-                    if client_socket in group_data['members']:
-                        groups_to_leave.append(group_id)
-                
-                for group_id in groups_to_leave:
-                    self.groups[group_id]['members'].remove(client_socket)
-                    if group_id in self.active_calls and client_socket in self.active_calls[group_id]:
-                        self.active_calls[group_id].remove(client_socket)
-                        self.broadcast_call_hang_up(group_id, username)
+                # Leave the live member sets, but remember where the user left off
+                # unless another of its sessions is still in the group.
+                other = self._session(username)
+                cursors = self.offline_cursors.setdefault(username, {})
+                for group_id in list(self.session_groups.get(client_socket, ())):
+                    if other is None or other not in self.groups[group_id]['members']:
+                        cursors.setdefault(group_id, self.groups[group_id]['next_id'])
+                    self._remove_member(client_socket, group_id)
+                if not cursors:
+                    del self.offline_cursors[username]
+                if call_group_id:
+                    self.broadcast_call_hang_up(call_group_id, username)
+
+                if 'node' not in client:  # A remote session's own node reports it
+                    self.presence.left(username)
+                    if self.cluster:
+                        self.cluster.session_ended(client_socket)
 
-                self.broadcast_user_list()
+        for limiter in set(self.command_limits.values()):
+            limiter.forget(client_socket)
+        self.read_backoff.pop(client_socket, None)
+        if self.heartbeat:
+            self.heartbeat.remove(client_socket)
+
+        queue = self.outbound.pop(client_socket, None)
+        if queue is not None:  # An empty queue is falsy, but its writer still has to stop.
+            queue.close(flush)
+            if flush:
+                return
+        try:
+            client_socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
         try:
             client_socket.close()
         except socket.error:
             pass
 
+    def _compressor(self, use_dictionary=True):
+        """
+        This thread's compressor. Everything after login_success uses the
+        trained dictionary when one is configured.
+        """
+        attr = 'zstd_dict_c' if use_dictionary and self.zstd_dictionary else 'zstd_c'
+        compressor = getattr(self._codec, attr, None)
+        if compressor is None:
+            compressor = make_compressor(self.zstd_dictionary if attr == 'zstd_dict_c' else None)
+            setattr(self._codec, attr, compressor)
+        return compressor
+
+    def _encode(self, command, payload=None, use_dictionary=True):
+        """Packs and compresses one message."""
+        compressor = self._compressor(use_dictionary)
+        start = time.perf_counter()
+        message = {'command': command, 'payload': payload or {}}
+        if self.traffic_capture:
+            self.traffic_capture.record(msgpack.packb(message, use_bin_type=True))
+        frame = encode_frame(message, compressor)
+        self.encode_seconds.observe(time.perf_counter() - start, (command,))
+        return frame
+
+    def _encode_batch(self, commands):
+        """Packs [(command, payload)] into one frame, compressed in a single call."""
+        compressor = self._compressor()
+        start = time.perf_counter()
+        messages = [{'command': command, 'payload': payload or {}} for command, payload in commands]
+        if self.traffic_capture:
+            for message in messages:
+                self.traffic_capture.record(msgpack.packb(message, use_bin_type=True))
+        frame = encode_batch(messages, compressor)
+        self.encode_seconds.observe(time.perf_counter() - start, ('batch',))
+        return frame
+
     def _send_to_client(self, client_socket, command, payload=None):
+        outbox = getattr(self._batch, 'outbox', None)
+        if outbox is not None:
+            outbox.append(((client_socket,), command, payload, None))
+            return
+        self._enqueue(client_socket, command, self._encode(command, payload))
+
+    def _broadcast(self, client_sockets, command, payload=None, exclude=None):
+        """Encodes a message once and queues the same frame for every recipient."""
+        outbox = getattr(self._batch, 'outbox', None)
+        if outbox is not None:
+            outbox.append(([s for s in client_sockets if s is not exclude], command, payload, None))
+            return
+        frame = None
+        for client_socket in list(client_sockets):
+            if client_socket is exclude:
+                continue
+            if frame is None:
+                frame = self._encode(command, payload)
+            self._enqueue(client_socket, command, frame)
+
+    def _enqueue(self, client_socket, command, frame):
+        outbox = getattr(self._batch, 'outbox', None)
+        if outbox is not None:
+            outbox.append(((client_socket,), command, None, frame))
+            return
+        queue = self.outbound.get(client_socket)
+        if queue is None:
+            return  # Connection is already gone.
+        dropped = queue.dropped
+        if not queue.put(command, frame):
+            # The caller may hold group locks, which disconnect_client takes first; closing
+            # the queue makes the writer drop the connection and its reader disconnect it.
+            print(f"Disconnecting slow client {client_socket.getpeername()}: outbound queue full.")
+            queue.close()
+            return
+        self.messages_out.inc(1, (command,))
+        if queue.dropped != dropped:
+            self.frames_dropped.inc(queue.dropped - dropped)
+
+    def _send_pings(self, client_sockets):
+        """Pings connections that have been silent for the heartbeat interval."""
+        if self._ping_frame is None:
+            self._ping_frame = self._encode('ping', use_dictionary=False)  # Also before login
+        for client_socket in client_sockets:
+            self._enqueue(client_socket, 'ping', self._ping_frame)
+
+    def _evict_connection(self, client_socket):
+        """Drops a connection the heartbeat gave up on, with its call and relay routes."""
         try:
-            message = {'command': command, 'payload': payload or {}}
-            packed = msgpack.packb(message, use_bin_type=True)
-            compressed = self.zstd_c.compress(packed)
-            client_socket.sendall(compressed)
-        except socket.error:
-            self.disconnect_client(client_socket)
+            address = client_socket.getpeername()
+        except OSError:
+            address = None
+        print(f"No heartbeat from {address} for {self.heartbeat.timeout:g} s. Disconnecting.")
+        self.disconnect_client(client_socket)
 
-    def broadcast_user_list(self):
-        with self.client_lock:
-            user_list = [data['username'] for data in self.clients.values()]
-            for client in self.clients.keys():
-                self._send_to_client(client, 'user_list_update', {'users': user_list})
+    def _publish_presence(self, version, joined, left):
+        """Sends one coalesced presence_delta to every client (PresenceFeed holds client_lock)."""
+        recipients = self.clients
+        if self.cluster:
+            recipients = [s for s, client in self.clients.items() if 'node' not in client]  # Their node tells them
+        self._broadcast(recipients, 'presence_delta', {'version': version, 'joined': joined, 'left': left})
 
     # --- Command Handlers ---
 
@@ -162,8 +866,9 @@ class Server:
         password = payload.get('password')
 
         if self.password and self.password != password:
-            self._send_to_client(client_socket, 'login_failed', {'reason': 'Invalid password'})
-            self.disconnect_client(client_socket)
+            self._enqueue(client_socket, 'login_failed',
+                          self._encode('login_failed', {'reason': 'Invalid password'}, use_dictionary=False))
+            self.disconnect_client(client_socket, flush=True)
             return
 
         if not username:
@@ -175,22 +880,141 @@ class Server:
         else:
             udp_addr = None # Или можно установить дефолтный адрес, например ('0.0.0.0', 0)
             
+        # login_success is the last frame compressed without the dictionary; it
+        # carries the dictionary itself unless the client already has that one cached.
+        login_payload = {}
+        if self.zstd_dictionary:
+            dict_id = self.zstd_dictionary.dict_id()
+            login_payload['zstd_dict_id'] = dict_id
+            if payload.get('zstd_dict_id') != dict_id:
+                login_payload['zstd_dictionary'] = self.zstd_dictionary.as_bytes()
+
         with self.client_lock:
-            self.clients[client_socket] = {'username': username, 'address': client_socket.getpeername(), 'udp_addr': udp_addr}
+            previous = self.clients.get(client_socket)
+            if previous:
+                self.presence.left(previous['username'])
+                if self.cluster:
+                    self.cluster.session_ended(client_socket)
+                if previous['username'] != username and client_socket in self.session_groups:
+                    # Member names in the snapshot change.
+                    self._dirty_groups.update(self.session_groups[client_socket])
+                    self.groups_version += 1
+                if self.sessions.get(previous['username']) is client_socket:
+                    del self.sessions[previous['username']]
+            self.clients[client_socket] = {'username': username, 'address': client_socket.getpeername(),
+                                           'udp_addr': previous['udp_addr'] if previous else None,
+                                           'token': secrets.token_urlsafe(16)}
+            self.sessions[username] = client_socket
+            self._set_udp_addr(client_socket, udp_addr)
+            # The token lets the client resume this session after a hot restart.
+            login_payload['session_token'] = self.clients[client_socket]['token']
+            resume = self._take_resumable(username, payload.get('session_token'))
+            login_payload['resumed'] = resume is not None
+            # Queued under the lock so no broadcast can overtake it.
+            self._enqueue(client_socket, 'login_success', self._encode('login_success', login_payload, use_dictionary=False))
+            self.presence.joined(username)
+            if self.cluster and previous and previous['username'] != username:
+                for group_id in self.session_groups.get(client_socket, ()):
+                    self.cluster.group_changed(group_id)
         print(f"User '{username}' logged in.")
-        
-        self._send_to_client(client_socket, 'login_success')
 
         # Send welcome message and initial data
-        welcome_msg = self.config.get("welcome_message", "Welcome!")
-        self._send_to_client(client_socket, 'info', {'message': welcome_msg})
+        if self._welcome_frame is None:
+            self._welcome_frame = self._encode('info', {'message': self.config.get("welcome_message", "Welcome!")})
+        self._enqueue(client_socket, 'info', self._welcome_frame)
         
-        # Send existing groups and user list
-        groups_info = {gid: {'name': g['name'], 'admin': g['admin'], 'members': [self.clients[m]['username'] for m in g['members']]} for gid, g in self.groups.items()}
-        user_list = [data['username'] for data in self.clients.values()]
-        self._send_to_client(client_socket, 'initial_data', {'groups': groups_info, 'users': user_list})
+        # Send existing groups and the presence snapshot the client's deltas start from,
+        # then what the user's groups said while it was offline.
+        self._catch_up(client_socket, username, resume=resume)
 
-        self.broadcast_user_list()
+    def _catch_up(self, client_socket, username, initial_data=True, resume=None):
+        """
+        Puts a returning user back into the groups it was in when it went
+        offline, sends initial_data and replays the messages it missed from
+        the history, in multi-message frames of `catch_up_batch`. Only the
+        newest `catch_up_limit` messages per group are replayed; older ones
+        are paged in with request_history as usual.
+
+        A session resumed after a hot restart rejoins its groups and call
+        here too. The locks of those groups are held until the replay is
+        queued, so live messages cannot overtake it or be replayed twice.
+        A user who logged in on another cluster node (or on the acceptor of
+        group workers) gets initial_data from that node instead, sent before
+        it was back in the groups here, so it is told user_joined_group for
+        each of them.
+        """
+        with self.client_lock:
+            group_ids = set(self.offline_cursors.get(username, ()))
+            if resume:
+                group_ids.update(group_id for group_id in resume['groups'] if group_id in self.groups)
+            group_ids = sorted(group_ids)
+        with ExitStack() as locks:
+            for group_id in group_ids:
+                locks.enter_context(self.group_locks[group_id])
+            with self.client_lock:
+                if client_socket not in self.clients:
+                    return
+                if resume:
+                    self._resume_session(client_socket, resume)
+                cursors = self.offline_cursors.pop(username, {})
+                missed = {group_id: cursors.pop(group_id) for group_id in group_ids if group_id in cursors}
+                if cursors:  # Another session went offline meanwhile; those groups wait for the next login.
+                    self.offline_cursors[username] = cursors
+                for group_id in missed:
+                    self._add_member(client_socket, group_id)
+                    if not initial_data:
+                        self._send_to_client(client_socket, 'user_joined_group', {'group_id': group_id, 'username': username})
+                if initial_data:
+                    self._enqueue(client_socket, 'initial_data', self._initial_data_frame())
+                    if self.cluster:
+                        # Announced only now, so what other nodes send for it cannot overtake initial_data.
+                        self.cluster.session_started(client_socket, username)
+
+            for group_id, cursor in missed.items():
+                next_id = self.groups[group_id]['next_id']
+                start = max(cursor, next_id - self.catch_up_limit)
+                if start >= next_id:
+                    continue
+                first_id, messages = self.history.read(group_id, next_id, next_id - start)
+                for i in range(0, len(messages), self.catch_up_batch):
+                    self._enqueue(client_socket, 'batch', self._encode_batch([
+                        ('group_message', {'group_id': group_id, 'message_data': message,
+                                           'message_id': message_id, 'offline': True})
+                        for message_id, message in enumerate(messages[i:i + self.catch_up_batch], first_id + i)]))
+                self.caught_up.inc(len(messages))
+
+    def _initial_data_frame(self):
+        """
+        Returns the encoded initial_data message, re-encoding it only when groups
+        or presence changed since the last login, so a reconnect storm costs one
+        shared buffer per client. Caller holds client_lock.
+        """
+        presence_version, user_list = self.presence.snapshot()
+        key = (self.groups_version, presence_version)
+        if self._initial_data[0] == key:
+            return self._initial_data[1]
+        for gid in self._dirty_groups:
+            g = self.groups[gid]
+            self._groups_info[gid] = {'name': g['name'], 'admin': g['admin'], 'members': [self.clients[m]['username'] for m in g['members']]}
+        self._dirty_groups.clear()
+        groups = self._groups_info
+        if self.cluster and self.cluster.groups:
+            groups = {**self.cluster.groups, **groups}
+        frame = self._encode('initial_data', {'groups': groups, 'users': user_list,
+                                              'presence_version': presence_version})
+        self._initial_data = (key, frame)
+        return frame
+
+    def handle_pong(self, sender_socket, payload):
+        """Nothing to do: dispatch_frames already recorded that the client is alive."""
+
+    def handle_request_presence(self, sender_socket, payload):
+        """Resends the presence snapshot to a client that missed a delta."""
+        with self.client_lock:
+            if sender_socket not in self.clients:
+                return
+            version, users = self.presence.snapshot()
+            self._send_to_client(sender_socket, 'presence_snapshot', {'version': version, 'users': users})
 
     def handle_create_group(self, sender_socket, payload):
         group_name = payload.get('group_name')
@@ -200,12 +1024,17 @@ class Server:
             return
             
         group_id = str(uuid.uuid4())
-        self.groups[group_id] = {
-            'name': group_name,
-            'members': {sender_socket},
-            'admin': admin_username
-        }
-        self.chat_history[group_id] = []
+        while self.cluster and not self.cluster.owns(group_id):  # A group worker takes ids that hash to it
+            group_id = str(uuid.uuid4())
+        with self.client_lock:
+            self.groups[group_id] = {
+                'name': group_name,
+                'members': frozenset(),
+                'admin': admin_username,
+                'next_id': 0
+            }
+            self.group_locks[group_id] = TimedLock(threading.RLock(), self.lock_wait_seconds, ('group',))
+            self._add_member(sender_socket, group_id)
         print(f"Group '{group_name}' created by '{admin_username}'.")
         self._send_to_client(sender_socket, 'group_created', {'group_id': group_id, 'group_name': group_name, 'admin': admin_username})
 
@@ -219,12 +1048,7 @@ class Server:
             if not group or group['admin'] != admin_username:
                 return # Not admin or group doesn't exist
             
-            target_socket = None
-            for sock, data in self.clients.items():
-                if data['username'] == target_username:
-                    target_socket = sock
-                    break
-            
+            target_socket = self._session(target_username)
             if target_socket and target_socket not in group['members']:
                 self._send_to_client(target_socket, 'group_invite', {
                     'group_id': group_id,
@@ -242,20 +1066,15 @@ class Server:
             if not group or not username:
                 return
 
-            admin_socket = None
-            for sock, data in self.clients.items():
-                if data['username'] == group['admin']:
-                    admin_socket = sock
-                    break
+            admin_socket = self._session(group['admin'])
             
             if accepted:
-                group['members'].add(sender_socket)
+                self._add_member(sender_socket, group_id)
                 # Notify admin
                 if admin_socket:
                     self._send_to_client(admin_socket, 'group_invite_response', {'group_id': group_id, 'username': username, 'accepted': True})
                 # Notify all members of the new user
-                for member_socket in group['members']:
-                    self._send_to_client(member_socket, 'user_joined_group', {'group_id': group_id, 'username': username})
+                self._broadcast(group['members'], 'user_joined_group', {'group_id': group_id, 'username': username})
             else:
                 # Notify admin of rejection
                 if admin_socket:
@@ -265,26 +1084,65 @@ class Server:
         group_id = payload.get('group_id')
         message_data = payload.get('message_data')
         
-        with self.client_lock:
-            group = self.groups.get(group_id)
-            if not group or sender_socket not in group['members']:
-                return
-            
+        # Member sets are copy-on-write, so the hot chat path never takes client_lock:
+        # messages in different groups proceed in parallel.
+        group = self.groups.get(group_id)
+        if not group or sender_socket not in group['members']:
+            return
+        with self.group_locks[group_id]:
             # Add to history
-            self.chat_history.setdefault(group_id, []).append(message_data)
+            message_id = self.history.append(group_id, message_data)
+            group['next_id'] = message_id + 1
+            if self.search:
+                self.search.notify(group_id)
             
             # Relay to other members
-            for member_socket in group['members']:
-                if member_socket != sender_socket:
-                    self._send_to_client(member_socket, 'group_message', {'group_id': group_id, 'message_data': message_data})
+            self._broadcast(group['members'], 'group_message',
+                            {'group_id': group_id, 'message_data': message_data, 'message_id': message_id},
+                            exclude=sender_socket)
 
     def handle_request_history(self, sender_socket, payload):
+        """Sends one page of history: the newest messages, or those older than 'before_id'."""
         chat_id = payload.get('chat_id')
-        if chat_id in self.chat_history:
-            self._send_to_client(sender_socket, 'history_response', {
-                'chat_id': chat_id,
-                'history': self.chat_history[chat_id]
-            })
+        if chat_id != 'global' and chat_id not in self.groups:
+            return
+        before_id = payload.get('before_id')
+        limit = payload.get('limit') or self.history_page_limit
+        if (before_id is not None and not isinstance(before_id, int)) or not isinstance(limit, int):
+            return
+        first_id, history = self.history.read(chat_id, before_id, max(1, min(limit, self.history_page_limit)))
+        self._send_to_client(sender_socket, 'history_response', {
+            'chat_id': chat_id,
+            'history': history,
+            'first_id': first_id,
+            'has_more': first_id > 0
+        })
+
+    def handle_search_history(self, sender_socket, payload):
+        """Sends one page of a group's messages that contain every word of 'query', best match first."""
+        group_id = payload.get('group_id')
+        query = payload.get('query')
+        offset = payload.get('offset', 0)
+        limit = payload.get('limit') or self.search_page_limit
+        group = self.groups.get(group_id)
+        if not self.search or not group or sender_socket not in group['members']:
+            return
+        if not isinstance(query, str) or not isinstance(offset, int) or not isinstance(limit, int) or offset < 0:
+            return
+        total, hits = self.search.search(group_id, query, offset, max(1, min(limit, self.search_page_limit)))
+        results = []
+        for message_id, score in hits:
+            _, messages = self.history.read(group_id, message_id + 1, 1)
+            if messages:
+                results.append({'message_id': message_id, 'score': score, 'message_data': messages[0]})
+        self._send_to_client(sender_socket, 'search_results', {
+            'group_id': group_id,
+            'query': query,
+            'offset': offset,
+            'total': total,
+            'results': results,
+            'has_more': offset + len(hits) < total
+        })
 
     def handle_kick_from_group(self, sender_socket, payload):
         group_id = payload.get('group_id')
@@ -298,26 +1156,29 @@ class Server:
                 # Silently fail if not admin or group doesn't exist
                 return
 
-            socket_to_kick = None
-            for sock, data in self.clients.items():
-                if data['username'] == username_to_kick:
-                    socket_to_kick = sock
-                    break
-            
+            socket_to_kick = self._session(username_to_kick)
+            offline_groups = self.offline_cursors.get(username_to_kick, {})
             if socket_to_kick and socket_to_kick in group['members']:
-                group['members'].remove(socket_to_kick)
-                print(f"User '{username_to_kick}' was kicked from group '{group['name']}' by admin '{admin_username}'.")
+                self._remove_member(socket_to_kick, group_id)
+            elif group_id in offline_groups:
+                # An offline member: it simply won't rejoin at its next login.
+                del offline_groups[group_id]
+                if not offline_groups:
+                    del self.offline_cursors[username_to_kick]
+                socket_to_kick = None
+            else:
+                return
+            print(f"User '{username_to_kick}' was kicked from group '{group['name']}' by admin '{admin_username}'.")
 
-                # Notify all original members (including the kicked one)
-                notification_payload = {
-                    'group_id': group_id,
-                    'kicked_user': username_to_kick,
-                    'admin': admin_username
-                }
-                # Create a temporary list of members to notify before the kick
-                members_to_notify = list(group['members']) + [socket_to_kick]
-                for member_socket in members_to_notify:
-                    self._send_to_client(member_socket, 'user_kicked', notification_payload)
+            # Notify all original members (including the kicked one)
+            notification_payload = {
+                'group_id': group_id,
+                'kicked_user': username_to_kick,
+                'admin': admin_username
+            }
+            # Create a temporary list of members to notify before the kick
+            members_to_notify = list(group['members']) + ([socket_to_kick] if socket_to_kick else [])
+            self._broadcast(members_to_notify, 'user_kicked', notification_payload)
 
     def handle_start_group_call(self, sender_socket, payload):
         group_id = payload.get('group_id')
@@ -328,39 +1189,46 @@ class Server:
             if not group or group['admin'] != admin_username:
                 return
             
-            self.active_calls[group_id] = {sender_socket}
+            # One call at a time: hang up the admin's current call in another group.
+            previous_group_id = self._leave_call(sender_socket)
+            if previous_group_id and previous_group_id != group_id:
+                self.broadcast_call_hang_up(previous_group_id, admin_username)
+            for member_socket in list(self.active_calls.get(group_id, ())):
+                self._leave_call(member_socket)
+            self.active_calls[group_id] = set()
+            self._join_call(sender_socket, group_id)
             
-            for member_socket in group['members']:
-                if member_socket != sender_socket:
-                    self._send_to_client(member_socket, 'incoming_group_call', {
-                        'group_id': group_id,
-                        'group_name': group['name'],
-                        'admin': admin_username,
-                        'sample_rate': sample_rate
-                    })
+            self._broadcast(group['members'], 'incoming_group_call', {
+                'group_id': group_id,
+                'group_name': group['name'],
+                'admin': admin_username,
+                'sample_rate': sample_rate
+            }, exclude=sender_socket)
 
     def handle_join_group_call(self, sender_socket, payload):
         group_id = payload.get('group_id')
         udp_addr = tuple(payload.get('udp_addr'))
         with self.client_lock:
-            if group_id not in self.active_calls:
+            if group_id not in self.active_calls or sender_socket not in self.clients:
                 return
             
-            self.clients[sender_socket]['udp_addr'] = udp_addr
-            self.active_calls[group_id].add(sender_socket)
+            previous_group_id = self._leave_call(sender_socket)
+            self._set_udp_addr(sender_socket, udp_addr)
+            self._join_call(sender_socket, group_id)
             username = self.clients[sender_socket]['username']
+            if previous_group_id and previous_group_id != group_id:
+                self.broadcast_call_hang_up(previous_group_id, username)
             
             # Notify others in the call that this user has joined
-            for member_socket in self.active_calls[group_id]:
-                if member_socket != sender_socket:
-                    self._send_to_client(member_socket, 'user_joined_call', {'group_id': group_id, 'username': username})
+            self._broadcast(self.active_calls[group_id], 'user_joined_call', {'group_id': group_id, 'username': username},
+                            exclude=sender_socket)
 
     def handle_leave_group_call(self, sender_socket, payload):
         group_id = payload.get('group_id')
         with self.client_lock:
             username = self.clients.get(sender_socket, {}).get('username')
-            if group_id in self.active_calls and sender_socket in self.active_calls[group_id]:
-                self.active_calls[group_id].remove(sender_socket)
+            if self.session_calls.get(sender_socket) == group_id:
+                self._leave_call(sender_socket)
                 if username:
                     self.broadcast_call_hang_up(group_id, username)
 
@@ -368,53 +1236,142 @@ class Server:
         # This can be called from disconnect or leave_group_call
         with self.client_lock:
             if group_id in self.active_calls:
-                for member_socket in self.active_calls[group_id]:
-                    self._send_to_client(member_socket, 'user_left_call', {'group_id': group_id, 'username': username})
+                self._broadcast(self.active_calls[group_id], 'user_left_call', {'group_id': group_id, 'username': username})
 
     def handle_udp_audio(self):
+        if self.config.get("udp_engine", "recvfrom") == "batched" and not self.mixer and not self.speakers:
+            from udp_relay import BatchedRelay
+            self.batched_relay = BatchedRelay(self.udp_sock, self.relay_routes, self.udp_limits)
+            self.batched_relay.run()
+            return
         while True:
             try:
                 data, sender_addr = self.udp_sock.recvfrom(2048)
-                
-                with self.client_lock:
-                    sender_socket = None
-                    for sock, client_data in self.clients.items():
-                        if client_data['udp_addr'] == sender_addr:
-                            sender_socket = sock
-                            break
-                    
-                    if not sender_socket:
-                        continue
-
-                    # Find which call this user is in
-                    active_group_id = None
-                    for group_id, members in self.active_calls.items():
-                        if sender_socket in members:
-                            active_group_id = group_id
-                            break
-                    
-                    if not active_group_id:
-                        continue
-
-                    # Relay audio to other call members
-                    for member_socket in self.active_calls[active_group_id]:
-                        if member_socket != sender_socket and self.clients[member_socket]['udp_addr']:
-                            self.udp_sock.sendto(data, self.clients[member_socket]['udp_addr'])
-
+                self.relay_audio(data, sender_addr)
             except Exception as e:
                 print(f"Error in UDP handler: {e}")
 
+    def relay_audio(self, data, sender_addr):
+        """Forwards one audio datagram to the other members of the sender's call."""
+        # The indexes are only mutated under client_lock and a single dict
+        # lookup is atomic, so the hot path needs no lock at all.
+        stats = self.relay_stats
+        stats['packets_in'] += 1
+        stats['bytes_in'] += len(data)
+        if self.mixer:
+            group_id = self.session_calls.get(self.udp_sessions.get(sender_addr))
+            if group_id and (self.udp_limits is None or self.udp_limits.admit(sender_addr)):
+                self.mixer.push(group_id, sender_addr, data)
+            return
+        destinations = self.relay_routes.get(sender_addr)
+        if destinations and (self.udp_limits is None or self.udp_limits.admit(sender_addr)) \
+                and (self.speakers is None or self.speakers.admit(sender_addr, data)):
+            sendto = self.udp_sendto
+            for addr in destinations:
+                sendto(data, addr)
+            stats['packets_out'] += len(destinations)
+
+    # --- Relay indexes (callers hold client_lock) ---
+
+    def _session(self, username):
+        """The latest session of a user, on this node or (as a stand-in) on another cluster node."""
+        client_socket = self.sessions.get(username)
+        if client_socket is None and self.cluster:
+            client_socket = self.cluster.session(username)
+        return client_socket
+
+    def _drop_session(self, client_socket):
+        """Forgets a logged-in client and its username (caller holds client_lock)."""
+        username = self.clients.pop(client_socket)['username']
+        if self.sessions.get(username) is client_socket:
+            del self.sessions[username]
+
+    def _add_member(self, client_socket, group_id):
+        group = self.groups[group_id]
+        group['members'] = group['members'] | {client_socket}
+        self._dirty_groups.add(group_id)
+        self.groups_version += 1
+        self.session_groups.setdefault(client_socket, set()).add(group_id)
+        if self.cluster:
+            self.cluster.group_changed(group_id)
+
+    def _remove_member(self, client_socket, group_id):
+        group = self.groups[group_id]
+        group['members'] = group['members'] - {client_socket}
+        self._dirty_groups.add(group_id)
+        self.groups_version += 1
+        group_ids = self.session_groups.get(client_socket)
+        if group_ids:
+            group_ids.discard(group_id)
+            if not group_ids:
+                del self.session_groups[client_socket]
+        if self.cluster:
+            self.cluster.group_changed(group_id)
+
+    def _set_udp_addr(self, client_socket, udp_addr):
+        old_addr = self.clients[client_socket]['udp_addr']
+        if old_addr and self.udp_sessions.get(old_addr) is client_socket:
+            del self.udp_sessions[old_addr]
+            self._drop_route(old_addr)
+        self.clients[client_socket]['udp_addr'] = udp_addr
+        if udp_addr:
+            self.udp_sessions[udp_addr] = client_socket
+        group_id = self.session_calls.get(client_socket)
+        if group_id:
+            self._rebuild_call_routes(group_id)
+
+    def _join_call(self, client_socket, group_id):
+        self.active_calls[group_id].add(client_socket)
+        self.session_calls[client_socket] = group_id
+        self._rebuild_call_routes(group_id)
+
+    def _leave_call(self, client_socket):
+        """Removes a session from its call, if any, and returns that call's group_id."""
+        group_id = self.session_calls.pop(client_socket, None)
+        if group_id is None:
+            return None
+        self.active_calls.get(group_id, set()).discard(client_socket)
+        udp_addr = self.clients[client_socket]['udp_addr']
+        if udp_addr:
+            self._drop_route(udp_addr)
+        self._rebuild_call_routes(group_id)
+        return group_id
+
+    def _drop_route(self, udp_addr):
+        if self.udp_limits:
+            self.udp_limits.forget(udp_addr)
+        if self.relay_routes.pop(udp_addr, None) is not None and self.relay_pool:
+            self.relay_pool.publish([(udp_addr, None)])
+
+    def _rebuild_call_routes(self, group_id):
+        """Precomputes, for every member of a call, the addresses its audio fans out to."""
+        # A member that is already gone has no address to route (its call membership is dropped on disconnect).
+        members = (self.clients.get(m) for m in self.active_calls.get(group_id, ()))
+        addrs = [client['udp_addr'] for client in members if client and client['udp_addr']]
+        routes = [(addr, tuple(a for a in addrs if a != addr)) for addr in addrs]
+        self.relay_routes.update(routes)
+        if self.relay_pool and routes:
+            self.relay_pool.publish(routes)
+        if self.speakers:
+            self.speakers.set_call(group_id, addrs)
+        if addrs:
+            self.call_addrs[group_id] = tuple(addrs)
+        else:
+            self.call_addrs.pop(group_id, None)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Voice Chat Server")
     parser.add_argument('--host', default=None, help='Host to bind the server to.')
     parser.add_argument('--port', type=int, default=None, help='Port to bind the server to.')
     parser.add_argument('--password', default=None, help='Password for the server.')
+    parser.add_argument('--takeover', action='store_true',
+                        help="Replace the running server without dropping its state (see 'hot_restart').")
     args = parser.parse_args()
 
     config = Server.load_config()
     host = args.host or config.get("host")
     port = args.port or config.get("port")
     
-    server = Server(host=host, port=port, password=args.password)
+    server = Server(host=host, port=port, password=args.password, takeover=args.takeover)
     server.start()
\ No newline at end of file
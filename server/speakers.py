@@ -0,0 +1,108 @@
+import time
+from common.audio_level import SILENCE, VOICE_FLAG
+
+
+class CallSpeakers:
+    """Speaker state of one call. Membership is replaced by the control thread, the rest is relay-thread only."""
+    __slots__ = ('members', 'levels', 'selected', 'next_update')
+
+    def __init__(self, members):
+        self.members = members  # frozenset of member udp_addrs
+        self.levels = {}  # {udp_addr: [smoothed loudness, time of last voice frame]}
+        self.selected = set()
+        self.next_update = 0.0
+
+
+class SpeakerSelector:
+    """
+    Active-speaker forwarding for relayed calls ("speaker_selection").
+
+    Every datagram starts with a one-byte audio level header (see
+    common.audio_level). The relay keeps a smoothed loudness per sender and
+    only forwards the `max_speakers` loudest senders of each call, so a
+    listener receives at most that many streams however large the call is.
+
+    Two things keep the selection from flapping between speakers of similar
+    loudness: a selected speaker stays selected until it has been silent for
+    `hold` seconds, and a louder speaker only replaces the quietest selected
+    one if it is louder by at least `hysteresis_db`. The selection is
+    revisited every `update_interval` seconds; a free slot is taken by the
+    first voice frame that arrives.
+
+    admit() runs on the single relay thread. set_call() and drop_call() are
+    called under client_lock and only swap whole entries, so admit() needs
+    no lock.
+    """
+
+    def __init__(self, max_speakers=3, hysteresis_db=6.0, hold=0.5, update_interval=0.1, smoothing=0.3):
+        self.max_speakers = max_speakers
+        self.hysteresis_db = hysteresis_db
+        self.hold = hold
+        self.update_interval = update_interval
+        self.smoothing = smoothing
+        self.calls = {}  # {group_id: CallSpeakers}
+        self.by_addr = {}  # {udp_addr: CallSpeakers}
+        self.dropped = 0  # Datagrams from unselected senders, for metrics
+
+    def set_call(self, group_id, addrs):
+        """Updates the members of a call (after a join, leave or address change)."""
+        members = frozenset(addrs)
+        call = self.calls.get(group_id)
+        if call is None:
+            call = self.calls[group_id] = CallSpeakers(members)
+        else:
+            for addr in call.members - members:
+                if self.by_addr.get(addr) is call:
+                    del self.by_addr[addr]
+            call.members = members
+        for addr in members:
+            self.by_addr[addr] = call
+        if not members:
+            del self.calls[group_id]
+
+    def admit(self, sender_addr, data):
+        """Returns True if a datagram should be forwarded to the rest of the call."""
+        call = self.by_addr.get(sender_addr)
+        if call is None or not data:
+            return False
+        header = data[0]
+        voice = header & VOICE_FLAG
+        now = time.monotonic()
+        state = call.levels.get(sender_addr)
+        if state is None:
+            state = call.levels[sender_addr] = [0.0, 0.0]
+        state[0] += self.smoothing * ((SILENCE - (header & SILENCE) if voice else 0) - state[0])
+        if voice:
+            state[1] = now
+            if sender_addr not in call.selected and len(call.selected) < self.max_speakers:
+                call.selected.add(sender_addr)
+        if now >= call.next_update:
+            self._reselect(call, now)
+        if sender_addr in call.selected:
+            return True
+        self.dropped += 1
+        return False
+
+    def _reselect(self, call, now):
+        call.next_update = now + self.update_interval
+        levels = call.levels
+        for addr in [addr for addr in levels if addr not in call.members]:
+            del levels[addr]
+        active = {addr for addr, (_, last_voice) in levels.items() if now - last_voice < self.hold}
+        selected = call.selected & active
+        candidates = sorted(((levels[addr][0], addr) for addr in active - selected), reverse=True)
+        for loudness, addr in candidates:
+            if len(selected) < self.max_speakers:
+                selected.add(addr)
+                continue
+            quietest = min(selected, key=lambda a: levels[a][0])
+            if loudness < levels[quietest][0] + self.hysteresis_db:
+                break  # Candidates are sorted, so nobody after this one qualifies either.
+            selected.discard(quietest)
+            selected.add(addr)
+        call.selected = selected
+
+    def speakers(self, group_id):
+        """Returns the currently forwarded senders of a call."""
+        call = self.calls.get(group_id)
+        return set(call.selected) if call else set()
@@ -0,0 +1,56 @@
+class TimerWheel:
+    """
+    Hashed timer wheel: `slots` buckets of `tick` seconds each.
+
+    A timer goes into the bucket of the tick its deadline falls in, so
+    scheduling and cancelling are O(1) dict operations. advance() visits
+    only the buckets of the ticks that passed since the last call; timers in
+    them that belong to a later turn of the wheel (deadline more than
+    slots * tick ahead) are left where they are. With the wheel at least as
+    long as the longest timeout, a tick costs O(timers due), independent of
+    how many timers exist.
+
+    Not thread-safe; callers serialize access.
+    """
+
+    def __init__(self, tick=1.0, slots=256):
+        self.tick = tick
+        self.slots = slots
+        self.buckets = [{} for _ in range(slots)]  # {key: deadline}
+        self.where = {}  # {key: bucket index}
+        self.current = None  # Last tick advanced to
+
+    def __len__(self):
+        return len(self.where)
+
+    def schedule(self, key, deadline):
+        """Sets (or moves) the timer for `key`."""
+        self.cancel(key)
+        tick = int(deadline // self.tick)
+        if self.current is not None and tick <= self.current:
+            tick = self.current + 1  # Already due: fire on the next advance, not a turn later.
+        index = tick % self.slots
+        self.buckets[index][key] = deadline
+        self.where[key] = index
+
+    def cancel(self, key):
+        index = self.where.pop(key, None)
+        if index is not None:
+            del self.buckets[index][key]
+
+    def advance(self, now):
+        """Removes and returns the keys whose deadline is not after `now`."""
+        target = int(now // self.tick)
+        if self.current is None:
+            self.current = target - 1
+        expired = []
+        # One full turn visits every bucket, so a long pause never needs more.
+        for tick in range(max(self.current + 1, target - self.slots + 1), target + 1):
+            bucket = self.buckets[tick % self.slots]
+            due = [key for key, deadline in bucket.items() if deadline <= now]
+            for key in due:
+                del bucket[key]
+                del self.where[key]
+            expired.extend(due)
+        self.current = max(self.current, target)
+        return expired
@@ -0,0 +1,225 @@
+"""
+Mixed-workload contention benchmark for the server's shared state.
+
+Runs a server in a child process and hits it at the same time with:
+
+- login churn: clients that connect, log in, wait for initial_data and leave;
+- group chat: one sender and one receiver per group, paced messages
+  carrying their send time;
+- UDP relay: pairs of call members streaming 20 ms packets to each other.
+
+and reports login rate and latency, chat throughput and latency, and how
+many audio packets arrived and how late. Run it against different commits
+(or engines) to see how much the workloads get in each other's way:
+
+    python server/tools/bench_contention.py --groups 8 --calls 8 --churn 4 --duration 5
+"""
+import argparse
+import multiprocessing
+import os
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from server import Server
+from common.framing import FrameDecoder, FrameReader, FrameError, encode_frame
+from common.dictionary import make_compressor
+
+AUDIO_PACKET = struct.Struct('!d')  # send timestamp, padded to a 20 ms Opus-sized packet
+AUDIO_PADDING = b'\x00' * 152
+PACKET_INTERVAL = 0.02
+
+
+def serve(port, engine):
+    """Child process: a server with default settings and its history in a scratch directory."""
+    config = {"engine": engine, "max_clients": 1000, "presence_window_ms": 50,
+              "history": {"directory": tempfile.mkdtemp(prefix='bench_contention_')}}
+
+    class BenchServer(Server):
+        @staticmethod
+        def load_config():
+            return config
+
+    sys.stdout = open(os.devnull, 'w')
+    BenchServer('127.0.0.1', port).start()
+
+
+class BenchClient:
+    """Just enough of the client protocol to drive the server."""
+
+    def __init__(self, port, username, udp_addr=None):
+        self.username = username
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self.compressor = make_compressor()
+        self.reader = FrameReader(self.sock, FrameDecoder())
+        self.pending = []
+        payload = {'username': username}
+        if udp_addr:
+            payload['udp_addr'] = list(udp_addr)
+        self.send('login', payload)
+
+    def send(self, command, payload=None):
+        self.sock.sendall(encode_frame({'command': command, 'payload': payload or {}}, self.compressor))
+
+    def messages(self):
+        """Yields incoming messages until the connection closes."""
+        while True:
+            while self.pending:
+                yield self.pending.pop(0)
+            batch = self.reader.read()
+            if batch is None:
+                return
+            self.pending.extend(batch)
+
+    def wait_for(self, command):
+        for message in self.messages():
+            if message.get('command') == command:
+                return message.get('payload')
+        raise ConnectionError(f"connection closed while waiting for '{command}'")
+
+    def close(self):
+        self.sock.close()
+
+
+def make_group(port, index, udp=False):
+    """Creates a two-member group and returns (admin, member, group_id, udp sockets)."""
+    udp_socks = []
+    if udp:
+        for _ in range(2):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(('127.0.0.1', 0))
+            sock.settimeout(0.2)
+            udp_socks.append(sock)
+    admin = BenchClient(port, f"admin{index}", udp_socks[0].getsockname() if udp else None)
+    member = BenchClient(port, f"member{index}")
+    admin.wait_for('initial_data')
+    member.wait_for('initial_data')
+    admin.send('create_group', {'group_name': f"bench{index}"})
+    group_id = admin.wait_for('group_created')['group_id']
+    admin.send('invite_to_group', {'group_id': group_id, 'username': member.username})
+    member.wait_for('group_invite')
+    member.send('group_invite_response', {'group_id': group_id, 'accepted': True})
+    admin.wait_for('group_invite_response')
+    if udp:
+        admin.send('start_group_call', {'group_id': group_id, 'sample_rate': 48000})
+        member.wait_for('incoming_group_call')
+        member.send('join_group_call', {'group_id': group_id, 'udp_addr': list(udp_socks[1].getsockname())})
+        admin.wait_for('user_joined_call')
+    return admin, member, group_id, udp_socks
+
+
+def drain(client):
+    for _ in client.messages():
+        pass
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def login_churn(port, worker, deadline, latencies):
+    count = 0
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            client = BenchClient(port, f"churn{worker}-{count}")
+            client.wait_for('initial_data')
+            client.close()
+        except (OSError, ConnectionError, FrameError):
+            continue
+        latencies.append(time.perf_counter() - start)
+        count += 1
+
+
+def chat_sender(client, group_id, deadline, rate):
+    next_send = time.monotonic()
+    while next_send < deadline:
+        client.send('group_message', {'group_id': group_id, 'message_data': {'sent': time.time(), 'text': 'x' * 64}})
+        next_send += 1.0 / rate
+        time.sleep(max(0.0, next_send - time.monotonic()))
+
+
+def chat_receiver(client, latencies):
+    for message in client.messages():
+        if message.get('command') == 'group_message':
+            latencies.append(time.time() - message['payload']['message_data']['sent'])
+
+
+def audio_sender(sock, relay_addr, deadline, sent):
+    next_send = time.monotonic()
+    while next_send < deadline:
+        sock.sendto(AUDIO_PACKET.pack(time.time()) + AUDIO_PADDING, relay_addr)
+        sent.append(1)
+        next_send += PACKET_INTERVAL
+        time.sleep(max(0.0, next_send - time.monotonic()))
+
+
+def audio_receiver(sock, deadline, latencies):
+    while time.monotonic() < deadline + 0.5:
+        try:
+            data = sock.recv(2048)
+        except socket.timeout:
+            continue
+        latencies.append(time.time() - AUDIO_PACKET.unpack_from(data)[0])
+
+
+def run(args):
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    server = multiprocessing.get_context('fork').Process(target=serve, args=(port, args.engine), daemon=True)
+    server.start()
+    time.sleep(0.5)
+
+    chats = [make_group(port, i) for i in range(args.groups)]
+    calls = [make_group(port, args.groups + i, udp=True) for i in range(args.calls)]
+    time.sleep(0.2)
+
+    login_latencies, chat_latencies, audio_latencies, audio_sent = [], [], [], []
+    deadline = time.monotonic() + args.duration
+    threads = [threading.Thread(target=login_churn, args=(port, i, deadline, login_latencies)) for i in range(args.churn)]
+    for admin, member, group_id, _ in chats:
+        threads.append(threading.Thread(target=chat_sender, args=(admin, group_id, deadline, args.chat_rate)))
+        threading.Thread(target=chat_receiver, args=(member, chat_latencies), daemon=True).start()
+    for admin, member, _, (admin_udp, member_udp) in calls:
+        for client in (admin, member):
+            threading.Thread(target=drain, args=(client,), daemon=True).start()
+        for sock, peer in ((admin_udp, member_udp), (member_udp, admin_udp)):
+            threads.append(threading.Thread(target=audio_sender, args=(sock, ('127.0.0.1', port), deadline, audio_sent)))
+            threads.append(threading.Thread(target=audio_receiver, args=(peer, deadline, audio_latencies)))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    server.terminate()
+
+    duration = args.duration
+    print(f"engine={args.engine}, {args.churn} churn workers, {args.groups} chats, {args.calls} calls, {duration:.0f}s")
+    print(f"logins:  {len(login_latencies) / duration:8.0f}/s   p50 {percentile(login_latencies, .5) * 1e3:7.2f} ms"
+          f"   p99 {percentile(login_latencies, .99) * 1e3:7.2f} ms")
+    print(f"chat:    {len(chat_latencies) / duration:8.0f}/s   p50 {percentile(chat_latencies, .5) * 1e3:7.2f} ms"
+          f"   p99 {percentile(chat_latencies, .99) * 1e3:7.2f} ms")
+    print(f"audio:   {len(audio_latencies)}/{len(audio_sent)} packets   p50 {percentile(audio_latencies, .5) * 1e3:7.2f} ms"
+          f"   p99 {percentile(audio_latencies, .99) * 1e3:7.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Server contention benchmark")
+    parser.add_argument('--engine', default='threaded', choices=['threaded', 'asyncio'])
+    parser.add_argument('--churn', type=int, default=4, help="login/logout worker threads")
+    parser.add_argument('--groups', type=int, default=8, help="chatting groups")
+    parser.add_argument('--chat-rate', type=float, default=200, help="messages per second per group")
+    parser.add_argument('--calls', type=int, default=8, help="two-member calls streaming audio")
+    parser.add_argument('--duration', type=float, default=5.0)
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Measures the server's username and membership lookups at scale.
+
+Builds a server with --users logged-in sessions spread over --groups groups
+(without any network I/O) and times the handlers that map usernames to
+sessions and sessions to groups, next to the linear scans they replaced,
+and the cost of the initial_data snapshot every login receives:
+
+    python server/tools/bench_indexes.py --users 50000 --groups 10000
+"""
+import argparse
+import contextlib
+import io
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from server import Server
+from metrics import TimedLock
+
+
+class FakeSocket:
+    """Stands in for a client socket; the handlers only need a peername."""
+
+    def __init__(self, index):
+        self.peername = ('10.0.%d.%d' % (index // 250 % 250, index % 250), 40000 + index % 20000)
+
+    def getpeername(self):
+        return self.peername
+
+    def shutdown(self, how):
+        pass
+
+    def close(self):
+        pass
+
+
+def build(users, groups, group_size):
+    server = Server('127.0.0.1', 0)
+    sockets = [FakeSocket(i) for i in range(users)]
+    # Under client_lock like the handlers: the presence timer flushes concurrently.
+    with server.client_lock:
+        for i, sock in enumerate(sockets):
+            username = f"user{i}"
+            server.clients[sock] = {'username': username, 'address': sock.getpeername(), 'udp_addr': None}
+            server.sessions[username] = sock
+            server.presence.joined(username)
+        server.presence.flush()
+        rng = random.Random(0)
+        for g in range(groups):
+            members = rng.sample(sockets, group_size)
+            group_id = f"group{g}"
+            server.groups[group_id] = {'name': group_id, 'members': frozenset(), 'admin': server.clients[members[0]]['username'],
+                                     'next_id': 0}
+            server.group_locks[group_id] = TimedLock(threading.RLock(), server.lock_wait_seconds, ('group',))
+            for sock in members:
+                server._add_member(sock, group_id)
+    return server, sockets
+
+
+def timed(label, operations, func):
+    # Handlers log every kick and disconnect; keep that out of the timing.
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        for i in range(operations):
+            func(i)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<34} {elapsed / operations * 1e6:10.1f} us/op")
+
+
+def run(users, groups, group_size, operations):
+    server, sockets = build(users, groups, group_size)
+    rng = random.Random(1)
+    targets = [f"user{rng.randrange(users)}" for _ in range(operations)]
+    group_ids = list(server.groups)
+    print(f"{users} users, {groups} groups of {group_size}, "
+          f"{sum(map(len, server.session_groups.values())) / users:.1f} memberships per user")
+
+    timed("username lookup (scan)", operations,
+          lambda i: next(s for s, d in server.clients.items() if d['username'] == targets[i]))
+    timed("username lookup (index)", operations, lambda i: server.sessions.get(targets[i]))
+    timed("memberships of a session (scan)", operations,
+          lambda i: [gid for gid, g in server.groups.items() if sockets[i] in g['members']])
+    timed("memberships of a session (index)", operations, lambda i: server.session_groups.get(sockets[i], ()))
+
+    def rebuild_initial_data(i):
+        server.groups_version += 1
+        server._initial_data_frame()
+    with server.client_lock:
+        timed("initial_data snapshot (re-encoded)", 5, rebuild_initial_data)
+        timed("initial_data snapshot (cached)", operations, lambda i: server._initial_data_frame())
+    print(f"{'initial_data frame size':<34} {len(server._initial_data_frame()) / 1024:10.1f} KiB")
+
+    def invite(i):
+        group_id = group_ids[i % len(group_ids)]
+        admin = server.sessions[server.groups[group_id]['admin']]
+        server.handle_invite_to_group(admin, {'group_id': group_id, 'username': targets[i]})
+    timed("handle_invite_to_group", operations, invite)
+
+    def kick(i):
+        group_id = group_ids[i % len(group_ids)]
+        group = server.groups[group_id]
+        admin = server.sessions[group['admin']]
+        victim = next(iter(group['members'] - {admin}), None)
+        if victim:
+            server.handle_kick_from_group(admin, {'group_id': group_id, 'username': server.clients[victim]['username']})
+    timed("handle_kick_from_group", operations, kick)
+
+    timed("disconnect_client", operations, lambda i: server.disconnect_client(sockets[-1 - i]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Username/membership index benchmark")
+    parser.add_argument('--users', type=int, default=50000)
+    parser.add_argument('--groups', type=int, default=10000)
+    parser.add_argument('--group-size', type=int, default=20)
+    parser.add_argument('--operations', type=int, default=200)
+    args = parser.parse_args()
+
+    # The server keeps its chat history under the working directory.
+    os.chdir(tempfile.mkdtemp(prefix='bench_indexes_'))
+    run(args.users, args.groups, args.group_size, args.operations)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+Measures server CPU spent by the MCU mixer per call participant.
+
+Every participant is treated as an active speaker sending 20 ms frames of
+48 kHz int16 PCM, which is the worst case for the mixer. Packets are sent to
+a no-op sink so only mixing and encoding is measured.
+
+    python server/tools/bench_mixer.py --participants 5 10 20 50 --ticks 500
+"""
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from mixer import CallMixer, FRAME_INTERVAL
+
+
+def run(participants, ticks, samples):
+    sent = []
+    mixer = CallMixer(lambda packet, addr: sent.append(len(packet)))
+    addrs = tuple(('10.0.0.1', 20000 + i) for i in range(participants))
+    rng = np.random.default_rng(0)
+    frames = [rng.integers(-3000, 3000, samples, dtype=np.int16).tobytes() for _ in addrs]
+    calls = {'bench': addrs}
+
+    start = time.process_time()
+    for _ in range(ticks):
+        for addr, frame in zip(addrs, frames):
+            mixer.push('bench', addr, frame)
+        mixer.tick(calls)
+    elapsed = time.process_time() - start
+
+    per_tick = elapsed / ticks
+    print(f"{participants:>4} participants: {per_tick * 1e3:7.3f} ms/tick, "
+          f"{per_tick / participants * 1e6:7.1f} us/participant/tick, "
+          f"{per_tick / FRAME_INTERVAL * 100:5.1f}% of one core, "
+          f"{len(sent) // ticks} packets/tick")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MCU mixer CPU benchmark")
+    parser.add_argument('--participants', type=int, nargs='+', default=[2, 5, 10, 20, 50, 100])
+    parser.add_argument('--ticks', type=int, default=500)
+    parser.add_argument('--sample-rate', type=int, default=48000)
+    args = parser.parse_args()
+
+    samples = int(args.sample_rate * FRAME_INTERVAL)
+    for participants in args.participants:
+        run(participants, args.ticks, samples)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Measures search_history on one large group.
+
+Generates --messages synthetic chat messages (words drawn from a Zipf-like
+vocabulary, like real chat), builds the group's search index from them in
+a temporary directory, and times queries from rare to very common words,
+multi-word queries and deep pages. The messages come from an in-memory
+stand-in for the HistoryStore, so only the index is measured:
+
+    python server/tools/bench_search.py --messages 1000000
+"""
+import argparse
+import itertools
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from search_index import SearchIndex
+
+GROUP = 'bench-group'
+
+
+class MemoryHistory:
+    """The two HistoryStore calls the index makes, over a list."""
+
+    def __init__(self, messages):
+        self.messages = messages
+
+    def next_id(self, chat_id):
+        return len(self.messages)
+
+    def read(self, chat_id, before_id=None, limit=50):
+        end = len(self.messages) if before_id is None else min(before_id, len(self.messages))
+        start = max(0, end - limit)
+        return start, self.messages[start:end]
+
+
+def build_history(messages, vocabulary, words_per_message):
+    rng = random.Random(0)
+    words = [f"w{i}" for i in range(vocabulary)]
+    cumulative = list(itertools.accumulate(1 / (rank + 1) for rank in range(vocabulary)))
+    return MemoryHistory([{'sender': 'bench', 'text': ' '.join(rng.choices(words, cum_weights=cumulative, k=words_per_message))}
+                          for _ in range(messages)])
+
+
+def timed(label, index, query, offset=0, repeat=20):
+    index.search(GROUP, query, offset)  # Warm the page cache
+    start = time.perf_counter()
+    for _ in range(repeat):
+        total, hits = index.search(GROUP, query, offset)
+    elapsed = (time.perf_counter() - start) / repeat
+    print(f"{label:<34} {elapsed * 1000:8.2f} ms  ({total} matches, {len(hits)} returned)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--vocabulary', type=int, default=50000)
+    parser.add_argument('--words', type=int, default=8, help="words per message")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        history = build_history(args.messages, args.vocabulary, args.words)
+        index = SearchIndex(os.path.join(directory, 'search'), history)
+        start = time.perf_counter()
+        index.update(GROUP)  # What the indexer thread does after new messages
+        print(f"indexed {args.messages} messages in {time.perf_counter() - start:.1f} s", flush=True)
+        shard = index._shard(GROUP)
+        size = sum(os.path.getsize(segment.path) for segment in shard.segments)
+        print(f"index: {len(shard.segments)} segments, {size / 1024 / 1024:.1f} MiB "
+              f"({size / args.messages:.1f} bytes per message)")
+
+        timed("rare word", index, f"w{args.vocabulary - 1}")
+        timed("mid-frequency word", index, "w500")
+        timed("most common word", index, "w0")
+        timed("two common words", index, "w0 w1")
+        timed("common + rare word", index, f"w0 w{args.vocabulary // 2}")
+        timed("three words", index, "w1 w2 w3")
+        timed("most common word, page 100", index, "w0", offset=100 * 20)
+        timed("no match", index, "nothing")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,407 @@
+"""
+Synthetic load generator for the server.
+
+Spawns a server on localhost (or targets a running one with --port) and
+drives it with thousands of simulated clients spread across worker
+processes. Each worker runs its clients on one asyncio loop, speaking the
+real protocol (msgpack + zstd framing, trained dictionary included when the
+server announces one):
+
+1. clients log in, with a bounded number of logins in flight;
+2. they form groups of --group-size (the first member creates the group and
+   invites the rest);
+3. every client sends group_message at --msg-rate messages per second;
+4. the first --calls groups of every worker start a call and all members
+   stream 20 ms UDP audio packets into it, of which --talkers members per
+   call mark their frames as speech (see common.audio_level). A call
+   relayed elsewhere than the server's own port (a group worker, another
+   cluster node) is streamed to the address its 'call_relay' names.
+
+Messages and packets carry their send time, so the report gives delivery
+latency percentiles next to throughput. Every --interval seconds a line
+with the server's RSS and CPU use is printed, and a summary follows at the end.
+The run fails if calls streamed audio but none came back from the relay:
+
+    python server/tools/loadgen.py --clients 2000 --workers 4 --msg-rate 0.5 --calls 10 --duration 30
+    python server/tools/loadgen.py --port 12345 --server-pid 4242 --clients 500
+    python server/tools/loadgen.py --group-size 50 --calls 1 --talkers 8 --server-config speakers.json
+    python server/tools/loadgen.py --server-workers 4 --clients 2000 --calls 10
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import resource
+import signal
+import socket
+import struct
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from common.framing import FrameDecoder, FrameError, encode_frame, RECV_BUFFER_SIZE
+from common.dictionary import dictionary_from_bytes, make_compressor
+from common.audio_level import HEADER_SIZE, SILENCE, encode_level
+
+AUDIO_HEADER = struct.Struct('!d')  # send timestamp, after the audio level byte
+AUDIO_PACKET_SIZE = 160  # a 20 ms Opus frame
+PACKET_INTERVAL = 0.02
+MAX_SAMPLES = 20000  # latency samples a worker reports per interval
+SETUP_COMMANDS = frozenset({'initial_data', 'group_created', 'group_invite', 'group_invite_response',
+                            'incoming_group_call', 'user_joined_call'})
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def serve(port, config):
+    """Child process running the server under test."""
+    raise_fd_limit()
+    sys.stdout = open(os.devnull, 'w')
+    # Exit normally on terminate(), so multiprocessing stops the server's own workers too.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    from server import Server
+
+    class LoadServer(Server):
+        @staticmethod
+        def load_config():
+            return config
+
+    LoadServer('127.0.0.1', port).start()
+
+
+class Stats:
+    """Counters and latency samples of one worker for the current interval."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.logins = 0
+        self.errors = 0
+        self.chat_sent = 0
+        self.chat_received = 0
+        self.chat_latency = []
+        self.audio_sent = 0
+        self.audio_received = 0
+        self.audio_latency = []
+
+    def take(self):
+        snapshot = dict(vars(self))
+        for key in ('chat_latency', 'audio_latency'):
+            if len(snapshot[key]) > MAX_SAMPLES:
+                snapshot[key] = random.sample(snapshot[key], MAX_SAMPLES)
+        self.reset()
+        return snapshot
+
+
+class AudioProtocol(asyncio.DatagramProtocol):
+    def __init__(self, stats):
+        self.stats = stats
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.stats.audio_received += 1
+        self.stats.audio_latency.append(time.time() - AUDIO_HEADER.unpack_from(data, HEADER_SIZE)[0])
+
+
+class SimClient:
+    """One simulated user on a real TCP connection."""
+
+    def __init__(self, username, stats):
+        self.username = username
+        self.stats = stats
+        self.decoder = FrameDecoder()
+        self.compressor = make_compressor()
+        self.setup = {}  # {command: asyncio.Queue of payloads}
+        self.writer = None
+        self.audio = None
+        self.relay_addr = None  # Where the call's audio goes, if not the server's own port
+        self.group_id = None
+
+    async def connect(self, host, port, udp=False):
+        loop = asyncio.get_running_loop()
+        reader, self.writer = await asyncio.open_connection(host, port)
+        payload = {'username': self.username}
+        if udp:
+            _, self.audio = await loop.create_datagram_endpoint(lambda: AudioProtocol(self.stats), local_addr=(host, 0))
+            payload['udp_addr'] = list(self.audio.transport.get_extra_info('sockname'))
+        asyncio.create_task(self.read_loop(reader))
+        self.send('login', payload)
+        await self.expect('initial_data')
+        self.stats.logins += 1
+
+    def send(self, command, payload=None):
+        self.writer.write(encode_frame({'command': command, 'payload': payload or {}}, self.compressor))
+
+    def _queue(self, command):
+        queue = self.setup.get(command)
+        if queue is None:
+            queue = self.setup[command] = asyncio.Queue()
+        return queue
+
+    async def expect(self, command, timeout=30):
+        return await asyncio.wait_for(self._queue(command).get(), timeout)
+
+    async def read_loop(self, reader):
+        try:
+            while True:
+                data = await reader.read(RECV_BUFFER_SIZE)
+                if not data:
+                    break
+                for message in self.decoder.feed(data):
+                    self.handle(message.get('command'), message.get('payload') or {})
+        except (ConnectionError, FrameError):
+            self.stats.errors += 1
+
+    def handle(self, command, payload):
+        if command == 'group_message':
+            self.stats.chat_received += 1
+            self.stats.chat_latency.append(time.time() - payload['message_data']['sent'])
+        elif command == 'ping':
+            self.send('pong')  # Listeners only talk to the server when asked.
+        elif command == 'call_relay':
+            self.relay_addr = tuple(payload['relay_addr'])
+        elif command == 'login_success' and payload.get('zstd_dictionary'):
+            dictionary = dictionary_from_bytes(payload['zstd_dictionary'])
+            self.decoder.set_dictionary(dictionary)
+            self.compressor = make_compressor(dictionary)
+        elif command in SETUP_COMMANDS:
+            self._queue(command).put_nowait(payload)
+
+
+async def form_group(host, port, members, name, call):
+    admin = members[0]
+    admin.send('create_group', {'group_name': name})
+    group_id = (await admin.expect('group_created'))['group_id']
+    for member in members[1:]:
+        admin.send('invite_to_group', {'group_id': group_id, 'username': member.username})
+        await member.expect('group_invite')
+        member.send('group_invite_response', {'group_id': group_id, 'accepted': True})
+        await admin.expect('group_invite_response')
+    if call:
+        admin.send('start_group_call', {'group_id': group_id, 'sample_rate': 48000})
+        for member in members[1:]:
+            await member.expect('incoming_group_call')
+            member.send('join_group_call', {'group_id': group_id,
+                                            'udp_addr': list(member.audio.transport.get_extra_info('sockname'))})
+    for member in members:
+        member.group_id = group_id
+
+
+async def chat_loop(clients, rate, deadline):
+    """Sends group messages from random clients at `rate` messages per second in total."""
+    budget = 0.0
+    last = time.monotonic()
+    while time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+        now = time.monotonic()
+        budget += rate * (now - last)
+        last = now
+        while budget >= 1:
+            budget -= 1
+            client = random.choice(clients)
+            client.send('group_message', {'group_id': client.group_id,
+                                          'message_data': {'sender': client.username, 'sent': time.time(), 'text': 'load test'}})
+            client.stats.chat_sent += 1
+
+
+async def audio_loop(speakers, relay_addr, deadline, stats):
+    """Streams a packet per member every 20 ms; talkers send speech at their own loudness, the rest silence."""
+    padding = b'\x00' * (AUDIO_PACKET_SIZE - HEADER_SIZE - AUDIO_HEADER.size)
+    levels = [encode_level(random.randint(15, 40), True) if talking else encode_level(SILENCE, False)
+              for _, talking in speakers]
+    next_tick = time.monotonic()
+    while next_tick < deadline:
+        for (speaker, _), level in zip(speakers, levels):
+            speaker.audio.transport.sendto(level + AUDIO_HEADER.pack(time.time()) + padding, speaker.relay_addr or relay_addr)
+        stats.audio_sent += len(speakers)
+        next_tick += PACKET_INTERVAL
+        await asyncio.sleep(max(0.0, next_tick - time.monotonic()))
+
+
+async def report_loop(stats, results, worker, interval, deadline):
+    while time.monotonic() < deadline + interval:
+        await asyncio.sleep(interval)
+        results.put((worker, stats.take()))
+
+
+async def run_worker(worker, args, start_at, results):
+    stats = Stats()
+    reporting = asyncio.create_task(report_loop(stats, results, worker, args.interval,
+                                                start_at + args.duration))
+    share = args.clients // args.workers + (1 if worker < args.clients % args.workers else 0)
+    groups = [list(range(i, min(i + args.group_size, share))) for i in range(0, share, args.group_size)]
+    call_members = {i for group in groups[:args.calls] for i in group}
+    clients = [SimClient(f"load{worker}-{i}", stats) for i in range(share)]
+
+    logins_in_flight = asyncio.Semaphore(args.login_concurrency)
+
+    async def login(index):
+        async with logins_in_flight:
+            try:
+                await clients[index].connect(args.host, args.port, udp=index in call_members)
+            except (OSError, asyncio.TimeoutError):
+                stats.errors += 1
+
+    await asyncio.gather(*(login(i) for i in range(share)))
+    formed = await asyncio.gather(*(form_group(args.host, args.port, [clients[i] for i in group], f"load{worker}-{n}", n < args.calls)
+                                    for n, group in enumerate(groups) if len(group) > 1), return_exceptions=True)
+    stats.errors += sum(1 for result in formed if isinstance(result, BaseException))
+
+    await asyncio.sleep(max(0.0, start_at - time.monotonic()))  # All workers start the load together.
+    deadline = start_at + args.duration
+    chatters = [client for client in clients if client.group_id]
+    talkers = {i for group in groups[:args.calls] for i in group[:args.talkers]}
+    speakers = [(clients[i], i in talkers) for i in sorted(call_members) if clients[i].audio and clients[i].group_id]
+    tasks = []
+    if chatters and args.msg_rate > 0:
+        tasks.append(chat_loop(chatters, args.msg_rate * len(chatters), deadline))
+    if speakers:
+        tasks.append(audio_loop(speakers, (args.host, args.port), deadline, stats))
+    await asyncio.gather(*tasks)
+    await reporting
+
+
+def worker_main(worker, args, start_at, results):
+    raise_fd_limit()
+    asyncio.run(run_worker(worker, args, start_at, results))
+
+
+def process_usage(pid):
+    """Returns (RSS in MiB, CPU seconds) of a process from /proc, or (None, None)."""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            rss = next(int(line.split()[1]) / 1024 for line in f if line.startswith('VmRSS:'))
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+        return rss, cpu
+    except (OSError, StopIteration, IndexError, ValueError):
+        return None, None
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def summarize(label, totals, interval):
+    rss, cpu = totals.get('rss'), totals.get('cpu')
+    return (f"{label:>6} logins {totals['logins']:6d}  errors {totals['errors']:4d}  "
+            f"chat {totals['chat_sent'] / interval:7.0f}/s -> {totals['chat_received'] / interval:8.0f}/s "
+            f"p50 {percentile(totals['chat_latency'], .5) * 1e3:7.1f} p99 {percentile(totals['chat_latency'], .99) * 1e3:7.1f} ms  "
+            f"audio {totals['audio_sent'] / interval:6.0f}/s -> {totals['audio_received'] / interval:6.0f}/s "
+            f"p99 {percentile(totals['audio_latency'], .99) * 1e3:6.1f} ms  "
+            + (f"server {rss:6.0f} MiB" if rss is not None else "")
+            + (f" {cpu:5.0%} CPU" if cpu is not None else ""))
+
+
+def merge(into, stats):
+    for key, value in stats.items():
+        into[key] = into.get(key, [] if isinstance(value, list) else 0) + value
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Synthetic load generator")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, help="target a running server instead of spawning one")
+    parser.add_argument('--server-pid', type=int, help="pid of the running server, for RSS/CPU reporting")
+    parser.add_argument('--engine', default='asyncio', choices=['threaded', 'asyncio'], help="engine of a spawned server")
+    parser.add_argument('--server-config', help="JSON file merged into the spawned server's config")
+    parser.add_argument('--server-workers', type=int, help="group worker processes of a spawned server")
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 2) - 1))
+    parser.add_argument('--group-size', type=int, default=10)
+    parser.add_argument('--msg-rate', type=float, default=0.2, help="group messages per client per second")
+    parser.add_argument('--calls', type=int, default=2, help="groups per worker that hold a call")
+    parser.add_argument('--talkers', type=int, default=1000000, help="members per call that speak (default: all)")
+    parser.add_argument('--login-concurrency', type=int, default=50, help="logins in flight per worker")
+    parser.add_argument('--duration', type=float, default=30.0, help="seconds of load after setup")
+    parser.add_argument('--setup-time', type=float, default=10.0, help="seconds allowed for logins and groups")
+    parser.add_argument('--interval', type=float, default=5.0, help="seconds between report lines")
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context('fork')
+    server = None
+    server_pid = args.server_pid
+    if args.port is None:
+        with socket.socket() as probe:
+            probe.bind((args.host, 0))
+            args.port = probe.getsockname()[1]
+        config = {"engine": args.engine, "max_clients": args.clients + 128,
+                  "history": {"directory": tempfile.mkdtemp(prefix='loadgen_history_')}}
+        if args.server_config:
+            with open(args.server_config, encoding='utf-8') as f:
+                config.update(json.load(f))
+        if args.server_workers:
+            config["workers"] = args.server_workers
+        # Not a daemon: the server forks group and relay workers of its own.
+        server = ctx.Process(target=serve, args=(args.port, config))
+        server.start()
+        server_pid = server.pid
+        time.sleep(1.0)
+    try:
+        total = run(args, ctx, server_pid)
+    finally:
+        if server:
+            server.terminate()
+            server.join()
+    if total.get('audio_sent') and not total.get('audio_received'):
+        print("No audio came back: the calls' relay dropped or never received it.")
+        sys.exit(1)
+
+
+def run(args, ctx, server_pid):
+
+    results = ctx.Queue()
+    start_at = time.monotonic() + args.setup_time
+    workers = [ctx.Process(target=worker_main, args=(i, args, start_at, results), daemon=True) for i in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    print(f"{args.clients} clients in {args.workers} workers, groups of {args.group_size}, "
+          f"{args.msg_rate} msg/s per client, {args.calls} calls per worker, server pid {server_pid}")
+
+    total = {}
+    last_cpu, last_time = process_usage(server_pid)[1] if server_pid else None, time.monotonic()
+    started = time.monotonic()
+    while any(worker.is_alive() for worker in workers) or not results.empty():
+        interval_totals, deadline = {}, time.monotonic() + args.interval
+        while time.monotonic() < deadline:
+            try:
+                _, stats = results.get(timeout=max(0.01, deadline - time.monotonic()))
+            except Exception:
+                continue
+            merge(interval_totals, stats)
+        if not interval_totals:
+            continue
+        merge(total, interval_totals)
+        if server_pid:
+            rss, cpu = process_usage(server_pid)
+            now = time.monotonic()
+            if rss is not None:
+                interval_totals['rss'] = rss
+                interval_totals['cpu'] = (cpu - last_cpu) / (now - last_time) if last_cpu is not None else 0
+                total['rss'] = max(total.get('rss', 0), rss)
+                last_cpu, last_time = cpu, now
+        print(summarize(f"{time.monotonic() - started:5.0f}s", interval_totals, args.interval))
+
+    total.pop('cpu', None)
+    print(summarize("total", total, max(args.duration, 1e-9)) + ("  (peak RSS)" if 'rss' in total else ""))
+    return total
+
+
+if __name__ == "__main__":
+    main()
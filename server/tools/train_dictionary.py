@@ -0,0 +1,68 @@
+"""
+Trains a zstd dictionary from captured protocol traffic and reports how many
+bytes it saves on the wire.
+
+Capture traffic by adding to server_config.json
+
+    "traffic_capture": {"path": "traffic.capture", "max_samples": 100000}
+
+then train and point the server at the result:
+
+    python server/tools/train_dictionary.py traffic.capture -o server/messages.dict
+    "zstd_dictionary": "server/messages.dict"
+
+A random 20% of the samples is held out of training and used to measure the
+reduction, so the report reflects messages the dictionary has not seen.
+"""
+import argparse
+import os
+import random
+import sys
+import zstandard as zstd
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+from common.dictionary import read_capture, dictionary_from_bytes, make_compressor
+from common.framing import HEADER
+
+
+def wire_bytes(samples, compressor):
+    return sum(HEADER.size + len(compressor.compress(sample)) for sample in samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train a zstd dictionary for protocol messages")
+    parser.add_argument('captures', nargs='+', help='Files written by the server traffic capture.')
+    parser.add_argument('-o', '--output', default='messages.dict', help='Where to write the dictionary.')
+    parser.add_argument('--size', type=int, default=16 * 1024, help='Dictionary size in bytes.')
+    parser.add_argument('--holdout', type=float, default=0.2, help='Fraction of samples used only for evaluation.')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    samples = [sample for path in args.captures for sample in read_capture(path)]
+    if len(samples) < 100:
+        print(f"Only {len(samples)} samples captured; capture more traffic before training.")
+        sys.exit(1)
+
+    random.Random(args.seed).shuffle(samples)
+    split = int(len(samples) * (1 - args.holdout))
+    training, holdout = samples[:split], samples[split:]
+
+    trained = zstd.train_dictionary(args.size, training)
+    with open(args.output, 'wb') as f:
+        f.write(trained.as_bytes())
+    dictionary = dictionary_from_bytes(trained.as_bytes())
+
+    raw = sum(HEADER.size + len(sample) for sample in holdout)
+    plain = wire_bytes(holdout, make_compressor())
+    with_dict = wire_bytes(holdout, make_compressor(dictionary))
+    print(f"Trained dictionary {dictionary.dict_id()} ({len(trained.as_bytes())} bytes) "
+          f"on {len(training)} samples -> {args.output}")
+    print(f"Held-out samples: {len(holdout)}, average {raw / len(holdout) - HEADER.size:.0f} bytes of msgpack")
+    print(f"  uncompressed:    {raw:>12,} bytes")
+    print(f"  zstd:            {plain:>12,} bytes ({plain / raw:6.1%} of uncompressed)")
+    print(f"  zstd+dictionary: {with_dict:>12,} bytes ({with_dict / raw:6.1%} of uncompressed)")
+    print(f"Bytes on the wire reduced by {1 - with_dict / plain:.1%} compared to plain zstd.")
+
+
+if __name__ == "__main__":
+    main()
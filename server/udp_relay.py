@@ -0,0 +1,179 @@
+import multiprocessing
+import selectors
+import socket
+from rate_limit import RateLimiter
+
+RECV_BURST = 64
+MAX_DATAGRAM = 2048
+
+
+class BatchedRelay:
+    """
+    Zero-copy relay loop ("udp_engine": "batched").
+
+    Datagrams are received with recvfrom_into into a preallocated ring of
+    fixed-size slots, a whole burst per wakeup, and forwarded straight from
+    memoryviews of those slots, so no packet payload is ever copied into a
+    new bytes object. `routes` is the live {udp_addr: destinations} table;
+    it is only read. An optional per-sender RateLimiter drops floods before
+    they are multiplied across the call.
+    """
+
+    def __init__(self, sock, routes, limiter=None, slots=RECV_BURST, slot_size=MAX_DATAGRAM):
+        self.sock = sock
+        self.routes = routes
+        self.limiter = limiter
+        self.buffer = bytearray(slots * slot_size)
+        view = memoryview(self.buffer)
+        self.slots = [view[i * slot_size:(i + 1) * slot_size] for i in range(slots)]
+        self.packets = 0  # Total datagrams read, for metrics
+
+    def drain(self):
+        """Relays up to one burst of pending datagrams and returns how many were read."""
+        recv_into = self.sock.recvfrom_into
+        sendto = self.sock.sendto
+        lookup = self.routes.get
+        admit = self.limiter.admit if self.limiter else None
+        count = 0
+        for slot in self.slots:
+            try:
+                size, sender_addr = recv_into(slot)
+            except BlockingIOError:
+                break
+            except OSError:
+                continue
+            count += 1
+            destinations = lookup(sender_addr)
+            if destinations and (admit is None or admit(sender_addr)):
+                packet = slot[:size]
+                for addr in destinations:
+                    try:
+                        sendto(packet, addr)
+                    except OSError:
+                        pass
+        self.packets += count
+        return count
+
+    def run(self):
+        self.sock.setblocking(False)
+        selector = selectors.DefaultSelector()
+        selector.register(self.sock, selectors.EVENT_READ)
+        while True:
+            selector.select()
+            while self.drain() == len(self.slots):
+                pass
+
+
+def relay_packets(sock, routes, limiter=None):
+    """The plain relay loop: one recvfrom and one bytes object per packet."""
+    for _ in range(RECV_BURST):
+        try:
+            data, sender_addr = sock.recvfrom(MAX_DATAGRAM)
+        except BlockingIOError:
+            break
+        except OSError:
+            continue
+        destinations = routes.get(sender_addr)
+        if destinations and (limiter is None or limiter.admit(sender_addr)):
+            for addr in destinations:
+                try:
+                    sock.sendto(data, addr)
+                except OSError:
+                    pass
+
+
+def relay_worker(host, port, conn, engine='recvfrom', udp_limit=None):
+    """
+    Entry point of a relay worker process.
+
+    Binds the shared audio port with SO_REUSEPORT, so the kernel spreads
+    senders across workers by flow hash, and relays with its own copy of the
+    route table. Route updates arrive from the control process on `conn` as
+    lists of (udp_addr, destinations) pairs; destinations of None removes
+    the route. The worker exits when the control process goes away.
+
+    The kernel keeps a sender on the same worker, so a per-worker rate
+    limiter ("udp_packets" in "rate_limits") sees all of its packets.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.setblocking(False)
+
+    routes = {}
+    limiter = RateLimiter('udp', udp_limit["rate"], udp_limit.get("burst")) if udp_limit else None
+    if engine == 'batched':
+        relay = BatchedRelay(sock, routes, limiter).drain
+    else:
+        relay = lambda: relay_packets(sock, routes, limiter)
+    selector = selectors.DefaultSelector()
+    selector.register(sock, selectors.EVENT_READ)
+    selector.register(conn, selectors.EVENT_READ)
+
+    while True:
+        for key, _ in selector.select():
+            if key.fileobj is conn:
+                try:
+                    updates = conn.recv()
+                except (EOFError, OSError):
+                    return
+                for udp_addr, destinations in updates:
+                    if destinations is None:
+                        routes.pop(udp_addr, None)
+                        if limiter:
+                            limiter.forget(udp_addr)
+                    else:
+                        routes[udp_addr] = destinations
+                continue
+            relay()
+
+
+class RelayWorkerPool:
+    """
+    Shards the UDP audio relay across processes ("udp_workers" > 1).
+
+    The TCP control process keeps the authoritative route table and publishes
+    every change to all workers over a pipe; each worker holds the full table
+    because any sender may hash to any of them.
+    """
+
+    def __init__(self, host, port, workers, engine='recvfrom', udp_limit=None):
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.engine = engine
+        self.udp_limit = udp_limit
+        self.processes = []
+        self.pipes = []
+
+    @staticmethod
+    def supported():
+        return hasattr(socket, 'SO_REUSEPORT')
+
+    def start(self, routes=None):
+        for _ in range(self.workers):
+            parent_conn, child_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=relay_worker, args=(self.host, self.port, child_conn, self.engine, self.udp_limit),
+                                              daemon=True)
+            process.start()
+            child_conn.close()
+            self.processes.append(process)
+            self.pipes.append(parent_conn)
+        if routes:
+            self.publish(list(routes.items()))
+
+    def publish(self, updates):
+        """Sends a batch of (udp_addr, destinations or None) route changes to every worker."""
+        for pipe in self.pipes:
+            try:
+                pipe.send(updates)
+            except OSError as e:
+                print(f"Failed to publish routes to relay worker: {e}")
+
+    def stop(self):
+        for pipe in self.pipes:
+            pipe.close()
+        for process in self.processes:
+            process.join(timeout=1)
+            if process.is_alive():
+                process.terminate()